@@ -0,0 +1,54 @@
+#python3.8.4
+"""
+Rows/sec of batch_scoring.score_shards for a grid of worker counts and batch
+sizes. Every run writes to its own output directory, so no shard is skipped
+as already scored.
+
+    python -m benchmarks.batch_scoring_benchmark '<data dir>/*.parquet' \
+        --model-dir <serving model dir>
+"""
+
+# %%
+import argparse
+import glob
+import itertools
+import os
+import tempfile
+from consumer_complaint.config import config
+from practice_example import batch_scoring
+
+
+# %%
+def run_benchmark(shard_paths, model_dir, worker_counts, batch_sizes):
+    results = []
+    with tempfile.TemporaryDirectory() as output_root:
+        for num_workers, batch_size in itertools.product(worker_counts, batch_sizes):
+            output_dir = os.path.join(output_root, '{}-{}'.format(num_workers, batch_size))
+            num_rows, seconds = batch_scoring.score_shards(
+                shard_paths, output_dir, model_dir,
+                num_workers = num_workers, batch_size = batch_size)
+            results.append({
+                'num_workers': num_workers,
+                'batch_size': batch_size,
+                'rows': num_rows,
+                'seconds': seconds,
+                'rows_per_sec': num_rows / seconds,
+            })
+    return results
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('patterns', nargs = '+', help = 'shard file patterns')
+    parser.add_argument('--model-dir', default = config.SERVING_MODEL_DIR)
+    parser.add_argument('--worker-counts', type = int, nargs = '+', default = [1, 2, 4])
+    parser.add_argument('--batch-sizes', type = int, nargs = '+',
+                        default = [1024, config.BATCH_SCORING_BATCH_SIZE])
+    args = parser.parse_args()
+
+    shard_paths = sorted(path for pattern in args.patterns for path in glob.glob(pattern))
+    for result in run_benchmark(shard_paths, args.model_dir, args.worker_counts, args.batch_sizes):
+        print("num_workers={num_workers:<3} batch_size={batch_size:<6} rows={rows:<9} "
+            "seconds={seconds:8.1f} rows/sec={rows_per_sec:10.1f}".format(**result))
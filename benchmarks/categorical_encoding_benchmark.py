@@ -0,0 +1,77 @@
+#python3.8.4
+"""
+Dense one-hots against int64 ids for the categorical features
+(config.CATEGORICAL_ENCODING). The suite's transform and training scenarios
+run once per encoding on the same synthetic complaints. Each run is a
+separate process with the encoding set through its environment variable,
+since the feature contract is read once at import. Reports bytes per
+transformed example, raw and gzip compressed, and train steps/sec. With ids
+the high cardinality features (config.HIGH_CARDINALITY_VOCAB_SIZES) are read
+too, so those examples carry more features. Other arguments are passed on to
+benchmarks.suite.
+
+    python -m benchmarks.categorical_encoding_benchmark --rows 50000
+"""
+
+# %%
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from consumer_complaint.config import config
+from practice_example.feature_config import FeatureConfigTransform
+from practice_example.features import CATEGORICAL_ENCODINGS
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# %%
+def run_suite(encoding, output_path, suite_args):
+    environment = dict(os.environ, **{config.ENV_PREFIX + 'CATEGORICAL_ENCODING': encoding})
+    subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--scenarios', 'training',
+                    '--output', output_path, *suite_args],
+                    cwd = ROOT_DIR, env = environment, check = True)
+    with open(output_path) as output_file:
+        scenarios = json.load(output_file)['scenarios']
+    return {
+        'encoding': encoding,
+        **{key: value for key, value in scenarios['transform']['train_examples'].items()
+            if key != 'examples'},
+        'transform_seconds': scenarios['transform']['component_seconds'][FeatureConfigTransform.get_id()],
+        'steps_per_sec': scenarios['training']['steps_per_sec'],
+    }
+
+
+def run_benchmark(encodings, suite_args):
+    with tempfile.TemporaryDirectory() as output_dir:
+        return [run_suite(encoding, os.path.join(output_dir, encoding + '.json'), suite_args)
+                for encoding in encodings]
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--encodings', nargs = '+', choices = CATEGORICAL_ENCODINGS,
+                        default = list(CATEGORICAL_ENCODINGS))
+    parser.add_argument('--output', help = 'also write the results to this json file')
+    args, suite_args = parser.parse_known_args()
+
+    results = run_benchmark(args.encodings, suite_args)
+    for result in results:
+        print("encoding={encoding:<8} bytes/example={bytes_per_example:8.1f} "
+            "gzip bytes/example={gzip_bytes_per_example:8.1f} transform={transform_seconds:7.1f}s "
+            "steps/sec={steps_per_sec:8.1f}".format(**result))
+    if len(results) > 1:
+        base = results[0]
+        for result in results[1:]:
+            print("{} against {}: {:.2f}x bytes/example, {:.2f}x gzip bytes/example, {:.2f}x steps/sec".format(
+                result['encoding'], base['encoding'],
+                result['bytes_per_example'] / base['bytes_per_example'],
+                result['gzip_bytes_per_example'] / base['gzip_bytes_per_example'],
+                result['steps_per_sec'] / base['steps_per_sec']))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent = 2)
@@ -0,0 +1,212 @@
+#python3.8.4
+"""
+Latency and memory of the full model against the compact model of
+practice_example/compact_model.py, as a SavedModel and as its quantized
+TFLite export. Every variant runs in a fresh process, so its memory is its
+own: peak RSS after loading the model and after predicting, on top of the
+interpreter with tensorflow imported. Latency is measured for single example
+requests and for batches. The compact variants' predictions are compared
+with the full model's, agreement is the share of examples on the same side
+of 0.5.
+
+The SavedModels take serialized tf.Examples. The TFLite model takes the
+transformed features, so it only runs with --transform-graph, and the
+Transform step is not part of its latency.
+
+    python -m benchmarks.compact_model_benchmark \
+        --transform-graph <pipeline_root>/Transform/transform_graph/<id>
+"""
+
+# %%
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from consumer_complaint.config import config
+from practice_example.features import LABEL_KEY, SERVING_FEATURES
+from benchmarks import synthetic_data
+
+
+# %%
+def _peak_rss_mb():
+    #ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _latest_version_dir(model_dir):
+    """the newest version Pusher wrote to model_dir, or model_dir itself"""
+    versions = [int(name) for name in os.listdir(model_dir) if name.isdigit()]
+    return os.path.join(model_dir, str(max(versions))) if versions else model_dir
+
+
+def _size_mb(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 2 ** 20
+    return sum(os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(path) for name in names) / 2 ** 20
+
+
+def _take(inputs, start, size):
+    if isinstance(inputs, dict):
+        return {name: value[start:start + size] for name, value in inputs.items()}
+    return inputs[start:start + size]
+
+
+def _load_saved_model(model_path):
+    import tensorflow as tf
+
+    signature = tf.saved_model.load(model_path).signatures['serving_default']
+
+    def predict(examples):
+        return signature(examples = tf.constant(examples))['outputs'].numpy()
+    return predict
+
+
+def _load_tflite(model_path, input_names):
+    import tensorflow as tf
+
+    interpreter = tf.lite.Interpreter(model_path = model_path)
+    #tflite input names carry the signature's prefix, match the longest feature name
+    input_indices = {}
+    for detail in interpreter.get_input_details():
+        name = detail['name'].split(':')[0]
+        input_indices[max((key for key in input_names if name.endswith(key)), key = len)] = detail['index']
+    output_index = interpreter.get_output_details()[0]['index']
+    input_shapes = {}
+
+    def predict(features):
+        for name, value in features.items():
+            #resizing reallocates the tensors, only do it when the batch size changes
+            if input_shapes.get(name) != value.shape:
+                interpreter.resize_tensor_input(input_indices[name], value.shape)
+                input_shapes[name] = value.shape
+                interpreter.allocate_tensors()
+            interpreter.set_tensor(input_indices[name], value)
+        interpreter.invoke()
+        return interpreter.get_tensor(output_index).copy()
+    return predict
+
+
+def measure_variant(kind, model_path, inputs, num_requests, batch_size):
+    """run in a fresh process, see run_benchmark"""
+    import tensorflow  # noqa: F401, part of the baseline memory
+
+    base_mb = _peak_rss_mb()
+    start = time.perf_counter()
+    if kind == 'tflite':
+        predict = _load_tflite(model_path, list(inputs))
+    else:
+        predict = _load_saved_model(model_path)
+    load_seconds = time.perf_counter() - start
+    loaded_mb = _peak_rss_mb()
+
+    num_examples = len(next(iter(inputs.values()))) if isinstance(inputs, dict) else len(inputs)
+    #the first calls include tracing and allocation
+    for index in range(3):
+        predict(_take(inputs, index, 1))
+    latencies = []
+    for index in range(num_requests):
+        request = _take(inputs, index % num_examples, 1)
+        start = time.perf_counter()
+        predict(request)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    predictions = np.concatenate([np.reshape(predict(_take(inputs, batch_start, batch_size)), [-1])
+                                for batch_start in range(0, num_examples, batch_size)])
+    batch_seconds = time.perf_counter() - start
+
+    latencies_ms = 1000 * np.array(latencies)
+    return {
+        'load_seconds': load_seconds,
+        'model_mb': loaded_mb - base_mb,
+        'peak_mb': _peak_rss_mb() - base_mb,
+        'file_mb': _size_mb(model_path),
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'batch_examples_per_sec': num_examples / batch_seconds,
+        'predictions': predictions.tolist(),
+    }
+
+
+# %%
+def transformed_inputs(transform_graph, examples, input_names):
+    """the transformed features of examples, shaped like the compact model's inputs"""
+    import tensorflow as tf
+    import tensorflow_transform as tft
+
+    tf_transform_output = tft.TFTransformOutput(transform_graph)
+    feature_spec = tf_transform_output.raw_feature_spec()
+    feature_spec.pop(LABEL_KEY)
+    features = tf_transform_output.transform_features_layer()(
+        tf.io.parse_example(tf.constant(examples), feature_spec))
+    inputs = {}
+    for name in input_names:
+        value = features[name].numpy()
+        inputs[name] = value[:, None] if value.ndim == 1 else value
+    return inputs
+
+
+def run_benchmark(full_model_dir, compact_model_dir, transform_graph = None,
+                num_examples = 1000, num_requests = 500, batch_size = 256):
+    from practice_example import inference_server
+
+    rows = synthetic_data.generate_complaints(num_examples)[SERVING_FEATURES].to_dict('records')
+    examples = [inference_server.instance_to_example(row) for row in rows]
+    compact_path = _latest_version_dir(compact_model_dir)
+    variants = [
+        ('full', 'saved_model', _latest_version_dir(full_model_dir), examples),
+        ('compact', 'saved_model', compact_path, examples),
+    ]
+    tflite_path = os.path.join(compact_path, config.COMPACT_TFLITE_FILE_NAME)
+    if transform_graph and os.path.exists(tflite_path):
+        import tensorflow as tf
+
+        input_specs = tf.saved_model.load(compact_path).signatures[
+            config.COMPACT_SIGNATURE_NAME].structured_input_signature[1]
+        variants.append(('compact_tflite', 'tflite', tflite_path,
+                        transformed_inputs(transform_graph, examples, list(input_specs))))
+
+    results = {}
+    for name, kind, model_path, inputs in variants:
+        #spawned processes start without the parent's tensorflow runtime state
+        with ProcessPoolExecutor(max_workers = 1,
+                                mp_context = multiprocessing.get_context('spawn')) as executor:
+            results[name] = executor.submit(measure_variant, kind, model_path, inputs,
+                                            num_requests, batch_size).result()
+    full_predictions = np.array(results['full'].pop('predictions'))
+    for name in list(results)[1:]:
+        predictions = np.array(results[name].pop('predictions'))
+        results[name]['agreement'] = float(np.mean((predictions > 0.5) == (full_predictions > 0.5)))
+        results[name]['max_abs_diff'] = float(np.abs(predictions - full_predictions).max())
+    return results
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--full-model-dir', default = config.SERVING_MODEL_DIR)
+    parser.add_argument('--compact-model-dir', default = config.COMPACT_SERVING_MODEL_DIR)
+    parser.add_argument('--transform-graph', help = 'Transform output, needed for the TFLite model')
+    parser.add_argument('--examples', type = int, default = 1000)
+    parser.add_argument('--requests', type = int, default = 500)
+    parser.add_argument('--batch-size', type = int, default = 256)
+    parser.add_argument('--output', help = 'also write the results to this json file')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.full_model_dir, args.compact_model_dir, args.transform_graph,
+                            args.examples, args.requests, args.batch_size)
+    for name, result in results.items():
+        print("{:<15} p50 {p50_ms:7.2f} ms  p99 {p99_ms:7.2f} ms  batch {batch_examples_per_sec:9.1f} ex/sec  "
+            "model {model_mb:7.1f} MB  peak {peak_mb:7.1f} MB  file {file_mb:7.1f} MB".format(name, **result))
+        if 'agreement' in result:
+            print("{:<15} agreement with full {agreement:.4f}  max abs diff {max_abs_diff:.4f}".format(
+                '', **result))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent = 2)
@@ -0,0 +1,100 @@
+#python3.8.4
+"""
+Wall time of every Beam component of the pipeline (ExampleGen through
+Transform) under each beam execution profile, on a sample of the complaint
+csv. Components are run one by one in an InteractiveContext with caching off,
+so each time is one component only. Use the results to fill
+config.BEAM_COMPONENT_PROFILES.
+
+    python -m benchmarks.component_benchmark --sample-rows 50000 \
+        --profiles in_memory multi_threading multi_processing --worker-counts 2 4 8
+"""
+
+# %%
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import time
+import pandas as pd
+from tfx.orchestration import metadata
+from tfx.orchestration.experimental.interactive.interactive_context import InteractiveContext
+from consumer_complaint.config import config
+from practice_example import practice_pipeline
+from practice_example.feature_config import FeatureConfigTransform
+
+#init_components order, the components after Transform run no Beam job
+LAST_COMPONENT = FeatureConfigTransform.get_id()
+
+
+# %%
+def write_sample(file_path, sample_rows, data_dir):
+    pd.read_csv(file_path, encoding = 'utf-8', nrows = sample_rows).to_csv(
+        os.path.join(data_dir, os.path.basename(file_path)), index = False)
+
+
+def profile_pipeline_root(output_root, profile, num_workers):
+    return os.path.join(output_root, '{}-{}'.format(profile, num_workers))
+
+
+def time_components(data_dir, profile, num_workers, output_root):
+    """time ExampleGen through Transform in a fresh pipeline root"""
+    pipeline_root = profile_pipeline_root(output_root, profile, num_workers)
+    context = InteractiveContext(
+        pipeline_name = config.PIPELINE_NAME,
+        pipeline_root = pipeline_root,
+        metadata_connection_config = metadata.sqlite_metadata_connection_config(
+            os.path.join(pipeline_root, 'metadata.sqlite')))
+    beam_args = practice_pipeline.beam_pipeline_args(profile, num_workers)
+    components = practice_pipeline.init_components(
+        data_dir, config.MODULE_FILE_PATH, os.path.join(pipeline_root, 'serving_model'))
+
+    results = []
+    for component in components:
+        start = time.perf_counter()
+        context.run(component, enable_cache = False, beam_pipeline_args = beam_args)
+        results.append({
+            'profile': profile,
+            'num_workers': num_workers,
+            'component': component.id,
+            'seconds': time.perf_counter() - start,
+        })
+        if component.id == LAST_COMPONENT:
+            break
+    return results
+
+
+def run_benchmark(file_path, sample_rows, profiles, worker_counts):
+    results = []
+    with tempfile.TemporaryDirectory() as output_root:
+        data_dir = os.path.join(output_root, 'data')
+        os.makedirs(data_dir)
+        write_sample(file_path, sample_rows, data_dir)
+        for profile, num_workers in itertools.product(profiles, worker_counts):
+            #in_memory always runs one worker
+            if profile == 'in_memory' and num_workers != worker_counts[0]:
+                continue
+            results.extend(time_components(data_dir, profile, num_workers, output_root))
+    return results
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file-path', default = config.DATA_FILE_PATH)
+    parser.add_argument('--sample-rows', type = int, default = 50000)
+    parser.add_argument('--profiles', nargs = '+', choices = practice_pipeline.BEAM_PROFILES,
+                        default = list(practice_pipeline.DIRECT_RUNNING_MODES))
+    parser.add_argument('--worker-counts', type = int, nargs = '+', default = [os.cpu_count()])
+    parser.add_argument('--output', help = 'also write the results to this json file')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.file_path, args.sample_rows, args.profiles, args.worker_counts)
+    for result in results:
+        print("profile={profile:<17} num_workers={num_workers:<3} component={component:<20} "
+            "seconds={seconds:8.1f}".format(**result))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent = 2)
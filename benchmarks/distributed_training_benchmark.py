@@ -0,0 +1,97 @@
+#python3.8.4
+"""
+Scaling benchmark for multi worker mirrored CPU training on a single host.
+Trains a fixed number of steps on 1, 2, 4 and 8 local worker processes and
+reports examples/sec. The global batch size is kept fixed, so perfect scaling
+shows up as examples/sec growing with the number of workers.
+
+    python -m benchmarks.distributed_training_benchmark \
+        --transform-graph <pipeline_root>/Transform/transform_graph/<id> \
+        --examples '<pipeline_root>/Transform/transformed_examples/<id>/*train/*'
+"""
+
+# %%
+import argparse
+import json
+import os
+import tempfile
+import time
+import tensorflow as tf
+import tensorflow_transform as tft
+from practice_example import distributed, module
+
+
+# %%
+def timed_training(args):
+    """run on every worker by distributed.run_local_cluster, the chief writes the result"""
+    tf_transform_output = tft.TFTransformOutput(args.transform_output)
+    strategy = distributed.build_strategy(distributed.MULTI_WORKER_MIRRORED)
+    embedding_cache_dir = args.custom_config.get('embedding_cache_dir')
+
+    def dataset_fn(input_context):
+        return module._input_fn(args.train_files, tf_transform_output,
+                                batch_size = args.custom_config['batch_size'],
+                                embedding_cache_dir = embedding_cache_dir,
+                                input_context = input_context)
+
+    with strategy.scope():
+        model = module.get_model(show_summary = False,
+                                precomputed_embeddings = bool(embedding_cache_dir),
+                                feature_config = module.load_feature_config(args.transform_output))
+    dataset = strategy.distribute_datasets_from_function(dataset_fn)
+
+    #the first steps include tracing and collective setup
+    model.fit(dataset, epochs = 1, steps_per_epoch = args.custom_config['warmup_steps'], verbose = 0)
+    start = time.perf_counter()
+    model.fit(dataset, epochs = 1, steps_per_epoch = args.train_steps, verbose = 0)
+    seconds = time.perf_counter() - start
+
+    if distributed.is_chief():
+        with tf.io.gfile.GFile(args.result_path, 'w') as result_file:
+            json.dump({'seconds': seconds}, result_file)
+
+
+def run_benchmark(transform_graph, examples, worker_counts, num_steps = 100,
+                batch_size = 256, warmup_steps = 10, embedding_cache_dir = None):
+    results = []
+    for num_workers in worker_counts:
+        with tempfile.TemporaryDirectory() as output_dir:
+            result_path = os.path.join(output_dir, 'result.json')
+            args = {
+                'train_files': [examples],
+                'transform_output': transform_graph,
+                'train_steps': num_steps,
+                'result_path': result_path,
+                'custom_config': {'batch_size': batch_size,
+                                'warmup_steps': warmup_steps,
+                                'embedding_cache_dir': embedding_cache_dir},
+            }
+            distributed.run_local_cluster('benchmarks.distributed_training_benchmark.timed_training',
+                                        args, num_workers)
+            with open(result_path) as result_file:
+                seconds = json.load(result_file)['seconds']
+        results.append({
+            'num_workers': num_workers,
+            'seconds': seconds,
+            'examples_per_sec': num_steps * batch_size / seconds,
+        })
+    return results
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transform-graph', required = True)
+    parser.add_argument('--examples', required = True)
+    parser.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument('--num-steps', type = int, default = 100)
+    parser.add_argument('--batch-size', type = int, default = 256)
+    parser.add_argument('--embedding-cache-dir', default = None)
+    args = parser.parse_args()
+
+    for result in run_benchmark(args.transform_graph, args.examples, args.workers,
+                                args.num_steps, args.batch_size,
+                                embedding_cache_dir = args.embedding_cache_dir):
+        print("workers={num_workers:<3} seconds={seconds:8.2f} "
+            "examples/sec={examples_per_sec:10.1f}".format(**result))
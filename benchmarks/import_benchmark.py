@@ -0,0 +1,148 @@
+#python3.8.4
+"""
+Import time of the package's modules, each measured with `python -X importtime`
+in a fresh interpreter, and a guard against regressions: every module lists
+the heavy frameworks it must not pull in at import time (they belong inside
+the functions that need them).
+
+    python -m benchmarks.import_benchmark
+    python -m benchmarks.import_benchmark --check --output imports.json
+    python -m benchmarks.import_benchmark --check --baseline imports.json --tolerance 0.5
+
+--check exits with 1 when a module imports a forbidden framework, or with
+--baseline when its import got slower than the baseline by more than tolerance.
+"""
+
+# %%
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+HEAVY_FRAMEWORKS = ('tensorflow', 'tensorflow_transform', 'tensorflow_data_validation',
+                    'tensorflow_model_analysis', 'tensorflow_hub', 'tfx', 'apache_beam', 'sklearn')
+#module -> packages it must not import at import time
+FORBIDDEN_IMPORTS = {
+    'consumer_complaint.config.config': HEAVY_FRAMEWORKS + ('numpy', 'pandas', 'pyarrow'),
+    'consumer_complaint.data_connectors.google_bigquery': HEAVY_FRAMEWORKS,
+    'practice_example.features': HEAVY_FRAMEWORKS,
+    'practice_example.columnar_data': HEAVY_FRAMEWORKS,
+    'practice_example.data_ingestion': HEAVY_FRAMEWORKS + ('pandas',),
+    'practice_example.data_validation': HEAVY_FRAMEWORKS,
+    'practice_example.skew_monitor': HEAVY_FRAMEWORKS,
+    'practice_example.pipeline_metrics': HEAVY_FRAMEWORKS,
+    'practice_example.tfhub_store': HEAVY_FRAMEWORKS,
+    'practice_example.inference_server': ('tensorflow_transform', 'tensorflow_data_validation',
+                                        'tfx', 'apache_beam'),
+    'practice_example.practice_pipeline': ('tfx.extensions.google_cloud_ai_platform',
+                                        'tfx.orchestration.experimental.interactive'),
+}
+#a regression has to be this much slower on top of the relative tolerance
+MIN_REGRESSION_MS = 20.0
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# %%
+def parse_importtime(stderr):
+    """
+    [(package, self ms, cumulative ms, depth)] of `-X importtime` output,
+    depth 0 are the imports of the -c statement itself
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        package = name.strip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((package, int(self_us) / 1000, int(cumulative_us) / 1000, depth))
+    return imports
+
+
+def _forbidden(packages, forbidden):
+    return sorted({package for package in packages for prefix in forbidden
+                    if package == prefix or package.startswith(prefix + '.')})
+
+
+def measure_import(module, repeats = 3):
+    """fastest of repeats imports of module, each in a fresh interpreter"""
+    environment = dict(os.environ, PYTHONPATH = os.pathsep.join(
+        filter(None, [ROOT_DIR, os.environ.get('PYTHONPATH')])))
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                    cwd = ROOT_DIR, env = environment, capture_output = True, text = True)
+        wall_ms = 1000 * (time.perf_counter() - start)
+        if completed.returncode:
+            error = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else ''
+            return {'module': module, 'error': error}
+        imports = parse_importtime(completed.stderr)
+        cumulative_ms = sum(cumulative for _, _, cumulative, depth in imports if depth == 0)
+        if best is None or cumulative_ms < best['cumulative_ms']:
+            children = sorted(((package, cumulative) for package, _, cumulative, depth in imports
+                                if depth == 1), key = lambda item: -item[1])
+            best = {
+                'module': module,
+                'cumulative_ms': cumulative_ms,
+                'wall_ms': wall_ms,
+                'num_modules': len(imports),
+                'heaviest': children[:5],
+                'forbidden': _forbidden([package for package, _, _, _ in imports],
+                                        FORBIDDEN_IMPORTS.get(module, ())),
+            }
+    return best
+
+
+def find_regressions(results, baseline, tolerance):
+    baseline = {result['module']: result for result in baseline if 'cumulative_ms' in result}
+    regressions = []
+    for result in results:
+        base = baseline.get(result['module'])
+        if base is None or 'cumulative_ms' not in result:
+            continue
+        limit = max(base['cumulative_ms'] * (1 + tolerance), base['cumulative_ms'] + MIN_REGRESSION_MS)
+        if result['cumulative_ms'] > limit:
+            regressions.append((result['module'], base['cumulative_ms'], result['cumulative_ms']))
+    return regressions
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs = '+', default = list(FORBIDDEN_IMPORTS))
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--check', action = 'store_true')
+    parser.add_argument('--baseline', help = 'results json of an earlier run')
+    parser.add_argument('--tolerance', type = float, default = 0.5,
+                        help = 'allowed relative slowdown against the baseline')
+    parser.add_argument('--output', help = 'also write the results to this json file')
+    args = parser.parse_args()
+
+    results = [measure_import(module, args.repeats) for module in args.modules]
+    failures = []
+    for result in results:
+        if 'error' in result:
+            failures.append("{} import failed: {}".format(result['module'], result['error']))
+            continue
+        print("{module:<52} {cumulative_ms:9.1f} ms {num_modules:5d} modules  wall {wall_ms:7.1f} ms".format(
+            **result))
+        print("    heaviest: {}".format(", ".join(
+            "{} {:.0f} ms".format(package, cumulative) for package, cumulative in result['heaviest'])))
+        if result['forbidden']:
+            failures.append("{} imports {}".format(result['module'], ", ".join(result['forbidden'])))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            for module, base_ms, ms in find_regressions(results, json.load(baseline_file), args.tolerance):
+                failures.append("{} import went from {:.1f} ms to {:.1f} ms".format(module, base_ms, ms))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent = 2)
+    for failure in failures:
+        print(failure)
+    if args.check and failures:
+        sys.exit(1)
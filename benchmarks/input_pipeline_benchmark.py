@@ -0,0 +1,63 @@
+#python3.8.4
+"""
+Steps/sec of module._input_fn over the transformed examples of a Transform run,
+for a grid of batch sizes and parallel read settings. No model is involved,
+so this is the ceiling the input pipeline puts on training throughput.
+
+    python -m benchmarks.input_pipeline_benchmark \
+        --transform-graph <pipeline_root>/Transform/transform_graph/<id> \
+        --examples '<pipeline_root>/Transform/transformed_examples/<id>/*train/*'
+"""
+
+# %%
+import argparse
+import itertools
+import time
+import tensorflow_transform as tft
+from practice_example import module
+
+
+# %%
+def time_steps(dataset, num_steps, warmup_steps):
+    iterator = iter(dataset)
+    for _ in range(warmup_steps):
+        next(iterator)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        next(iterator)
+    return num_steps / (time.perf_counter() - start)
+
+
+def run_benchmark(transform_graph, examples, batch_sizes, parallel_reads,
+                num_steps = 200, warmup_steps = 20):
+    tf_transform_output = tft.TFTransformOutput(transform_graph)
+    results = []
+    for batch_size, num_parallel_reads in itertools.product(batch_sizes, parallel_reads):
+        dataset = module._input_fn(examples, tf_transform_output,
+                                batch_size = batch_size,
+                                num_parallel_reads = num_parallel_reads)
+        steps_per_sec = time_steps(dataset, num_steps, warmup_steps)
+        results.append({
+            'batch_size': batch_size,
+            'num_parallel_reads': num_parallel_reads,
+            'steps_per_sec': steps_per_sec,
+            'examples_per_sec': steps_per_sec * batch_size,
+        })
+    return results
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transform-graph', required = True)
+    parser.add_argument('--examples', required = True)
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [64, 256, 1024])
+    parser.add_argument('--parallel-reads', type = int, nargs = '+', default = [1, module.AUTOTUNE])
+    parser.add_argument('--num-steps', type = int, default = 200)
+    args = parser.parse_args()
+
+    for result in run_benchmark(args.transform_graph, args.examples, args.batch_sizes,
+                                args.parallel_reads, args.num_steps):
+        print("batch_size={batch_size:<6} num_parallel_reads={num_parallel_reads:<4} "
+            "steps/sec={steps_per_sec:10.1f} examples/sec={examples_per_sec:12.1f}".format(**result))
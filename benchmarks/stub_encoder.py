@@ -0,0 +1,43 @@
+#python3.8.4
+"""
+Offline stand-in for the Universal Sentence Encoder. A hashed bag of words
+with fixed random word vectors, same input (a batch of strings) and output
+(a batch of EMBEDDING_DIM float vectors) as the TF-Hub module, so the model,
+its signatures and the embedding cache work unchanged without a download.
+Costs far less than the real encoder, so training and serving numbers
+measured with it are upper bounds.
+"""
+
+# %%
+import tensorflow as tf
+from consumer_complaint.config import config
+from practice_example import tfhub_store
+
+NUM_BUCKETS = 2 ** 14
+
+
+# %%
+class StubEncoder(tf.Module):
+
+    def __init__(self, embedding_dim = config.EMBEDDING_DIM, num_buckets = NUM_BUCKETS, seed = 0):
+        super().__init__()
+        self._num_buckets = num_buckets
+        self.word_vectors = tf.Variable(
+            tf.random.stateless_normal([num_buckets, embedding_dim], seed = [seed, 0]),
+            trainable = False)
+
+    @tf.function(input_signature = [tf.TensorSpec([None], tf.string)])
+    def __call__(self, texts):
+        word_ids = tf.strings.to_hash_bucket_fast(tf.strings.split(tf.strings.lower(texts)),
+                                                self._num_buckets)
+        vectors = tf.ragged.map_flat_values(tf.gather, self.word_vectors, word_ids)
+        #empty texts get the zero vector instead of a division by zero
+        counts = tf.maximum(tf.cast(word_ids.row_lengths(), tf.float32), 1.0)
+        return tf.math.l2_normalize(tf.reduce_sum(vectors, axis = 1) / counts[:, None], axis = 1)
+
+
+def install_stub_encoder(handle = config.USE_MODULE_URL):
+    """serve the stub for handle from tfhub_store in this process, e.g. to get_model"""
+    encoder = StubEncoder()
+    tfhub_store._LOADED_MODULES[handle] = encoder
+    return encoder
@@ -0,0 +1,266 @@
+#python3.8.4
+"""
+End to end benchmark suite on synthetic complaints, runs offline on a CPU only
+box: the TF-Hub encoder is replaced by benchmarks.stub_encoder.
+Scenarios, each runs the ones it reads the outputs of:
+    ingestion   csv into sharded tfrecords and into parquet parts, rows/sec
+    statistics  tfdv statistics of the csv, rows/sec
+    transform   ExampleGen through Transform, seconds per component and
+                bytes per transformed example
+    training    module._input_fn into get_model, steps/sec
+    serving     single example latency, direct and through the micro batcher
+    scoring     batch_scoring over the parquet parts, rows/sec
+Every run writes one json file to config.BENCHMARK_RESULTS_DIR_PATH, so
+results can be compared over time.
+
+    python -m benchmarks.suite --rows 50000 --scenarios ingestion training
+"""
+
+# %%
+import argparse
+import glob
+import json
+import math
+import os
+import platform
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tensorflow as tf
+import tensorflow_data_validation as tfdv
+import tensorflow_transform as tft
+from apache_beam.options.pipeline_options import PipelineOptions
+from consumer_complaint.config import config
+from practice_example import (batch_scoring, columnar_data, data_ingestion, inference_server,
+                            module, practice_pipeline)
+from practice_example.features import CATEGORICAL_ENCODING, SERVING_FEATURES
+from benchmarks import component_benchmark, stub_encoder, synthetic_data
+
+SCENARIOS = ('ingestion', 'statistics', 'transform', 'training', 'serving', 'scoring')
+#scenario -> scenarios whose outputs it reads
+REQUIREMENTS = {
+    'training': ('transform',),
+    'serving': ('transform', 'training'),
+    'scoring': ('ingestion', 'transform', 'training'),
+}
+
+
+# %%
+def ingestion(workspace, args):
+    num_rows = len(workspace['data'])
+    start = time.perf_counter()
+    data_ingestion.sharded_tfrecord_data_writer(
+        workspace['csv_path'], num_shards = args.num_workers,
+        record_dir_path = os.path.join(workspace['work_dir'], 'tfrecord'))
+    tfrecord_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    workspace['parquet_paths'] = columnar_data.csv_to_parquet_writer(
+        workspace['csv_path'], os.path.join(workspace['work_dir'], 'parquet'),
+        rows_per_partition = math.ceil(num_rows / args.num_workers))
+    parquet_seconds = time.perf_counter() - start
+    return {
+        'tfrecord_seconds': tfrecord_seconds,
+        'tfrecord_rows_per_sec': num_rows / tfrecord_seconds,
+        'parquet_seconds': parquet_seconds,
+        'parquet_rows_per_sec': num_rows / parquet_seconds,
+    }
+
+
+def statistics(workspace, args):
+    pipeline_options = PipelineOptions(
+        practice_pipeline.beam_pipeline_args(args.profile, args.num_workers))
+    start = time.perf_counter()
+    tfdv.generate_statistics_from_csv(data_location = workspace['csv_path'],
+                                    pipeline_options = pipeline_options)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'rows_per_sec': len(workspace['data']) / seconds}
+
+
+def transformed_example_sizes(file_pattern):
+    """serialized and gzip compressed bytes per transformed example"""
+    file_paths = glob.glob(file_pattern)
+    num_examples = num_bytes = 0
+    for record in tf.data.TFRecordDataset(file_paths, compression_type = 'GZIP').as_numpy_iterator():
+        num_examples += 1
+        num_bytes += len(record)
+    return {
+        'examples': num_examples,
+        'bytes_per_example': num_bytes / num_examples,
+        'gzip_bytes_per_example': sum(os.path.getsize(path) for path in file_paths) / num_examples,
+    }
+
+
+def transform(workspace, args):
+    results = component_benchmark.time_components(
+        workspace['data_dir'], args.profile, args.num_workers, workspace['work_dir'])
+    pipeline_root = component_benchmark.profile_pipeline_root(
+        workspace['work_dir'], args.profile, args.num_workers)
+    transform_dir = os.path.join(pipeline_root, component_benchmark.LAST_COMPONENT)
+    workspace['transform_graph'] = sorted(glob.glob(os.path.join(transform_dir, 'transform_graph', '*')))[-1]
+    examples_dir = sorted(glob.glob(os.path.join(transform_dir, 'transformed_examples', '*')))[-1]
+    workspace['train_files'] = os.path.join(examples_dir, '*train', '*')
+    return {
+        'component_seconds': {result['component']: result['seconds'] for result in results},
+        'train_examples': transformed_example_sizes(workspace['train_files']),
+    }
+
+
+def training(workspace, args):
+    tf_transform_output = tft.TFTransformOutput(workspace['transform_graph'])
+    model = module.get_model(show_summary = False,
+                            feature_config = module.load_feature_config(workspace['transform_graph']))
+    dataset = module._input_fn(workspace['train_files'], tf_transform_output,
+                            batch_size = args.batch_size)
+    #the first steps include tracing
+    model.fit(dataset, epochs = 1, steps_per_epoch = args.warmup_steps, verbose = 0)
+    start = time.perf_counter()
+    model.fit(dataset, epochs = 1, steps_per_epoch = args.train_steps, verbose = 0)
+    seconds = time.perf_counter() - start
+
+    workspace['model_dir'] = os.path.join(workspace['work_dir'], 'serving_model')
+    model.save(os.path.join(workspace['model_dir'], '1'), save_format = 'tf',
+            signatures = module._serving_signatures(model, tf_transform_output))
+    return {
+        'batch_size': args.batch_size,
+        'steps_per_sec': args.train_steps / seconds,
+        'examples_per_sec': args.train_steps * args.batch_size / seconds,
+    }
+
+
+def _latency_summary(latencies, wall_seconds):
+    latencies_ms = 1000 * np.array(latencies)
+    return {
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p90_ms': float(np.percentile(latencies_ms, 90)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'mean_ms': float(latencies_ms.mean()),
+        'requests_per_sec': len(latencies) / wall_seconds,
+    }
+
+
+def serving(workspace, args):
+    model_manager = inference_server.ModelManager(workspace['model_dir'], poll_seconds = 0)
+    rows = workspace['data'][SERVING_FEATURES].head(args.serving_requests).to_dict('records')
+    examples = [inference_server.instance_to_example(row) for row in rows]
+    for example in examples[:10]:
+        model_manager.predict([example])
+
+    def timed(predict_one, example):
+        start = time.perf_counter()
+        predict_one(example)
+        return time.perf_counter() - start
+
+    def predict_direct(example):
+        return model_manager.predict([example])
+
+    start = time.perf_counter()
+    direct = [timed(predict_direct, example) for example in examples]
+    direct_seconds = time.perf_counter() - start
+
+    batcher = inference_server.MicroBatcher(model_manager.predict)
+
+    def predict_batched(example):
+        return batcher.submit([example]).result()
+
+    with ThreadPoolExecutor(max_workers = args.serving_concurrency) as executor:
+        start = time.perf_counter()
+        batched = list(executor.map(lambda example: timed(predict_batched, example), examples))
+        batched_seconds = time.perf_counter() - start
+    return {
+        'direct': _latency_summary(direct, direct_seconds),
+        'micro_batched': {'concurrency': args.serving_concurrency,
+                        **_latency_summary(batched, batched_seconds)},
+    }
+
+
+def scoring(workspace, args):
+    num_rows, seconds = batch_scoring.score_shards(
+        workspace['parquet_paths'], os.path.join(workspace['work_dir'], 'predictions'),
+        workspace['model_dir'], num_workers = args.num_workers)
+    return {'seconds': seconds, 'rows_per_sec': num_rows / seconds}
+
+
+SCENARIO_FNS = {
+    'ingestion': ingestion,
+    'statistics': statistics,
+    'transform': transform,
+    'training': training,
+    'serving': serving,
+    'scoring': scoring,
+}
+
+
+# %%
+def _with_requirements(scenarios):
+    selected = set(scenarios)
+    for scenario in scenarios:
+        selected.update(REQUIREMENTS.get(scenario, ()))
+    return [scenario for scenario in SCENARIOS if scenario in selected]
+
+
+def run_suite(args, work_dir):
+    stub_encoder.install_stub_encoder()
+    cardinalities = synthetic_data.parse_cardinalities(args.cardinality)
+    data_dir = os.path.join(work_dir, 'data')
+    csv_path = os.path.join(data_dir, config.FILE_NAME)
+    workspace = {
+        'work_dir': work_dir,
+        'data_dir': data_dir,
+        'csv_path': csv_path,
+        'data': synthetic_data.write_complaints_csv(csv_path, args.rows, cardinalities, args.seed),
+    }
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'rows': args.rows,
+        'seed': args.seed,
+        'cardinalities': {**synthetic_data.CARDINALITIES, **cardinalities},
+        'categorical_encoding': CATEGORICAL_ENCODING,
+        'profile': args.profile,
+        'num_workers': args.num_workers,
+        'host': {'cpu_count': os.cpu_count(), 'platform': platform.platform(),
+                'python': platform.python_version()},
+        'scenarios': {},
+    }
+    for scenario in _with_requirements(args.scenarios):
+        print("running {}".format(scenario))
+        results['scenarios'][scenario] = SCENARIO_FNS[scenario](workspace, args)
+    return results
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs = '+', choices = SCENARIOS, default = list(SCENARIOS))
+    parser.add_argument('--rows', type = int, default = 50000)
+    parser.add_argument('--cardinality', action = 'append', metavar = 'COLUMN=COUNT')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--profile', choices = practice_pipeline.BEAM_PROFILES,
+                        default = 'multi_processing')
+    parser.add_argument('--num-workers', type = int, default = os.cpu_count())
+    parser.add_argument('--batch-size', type = int, default = 64)
+    parser.add_argument('--train-steps', type = int, default = 200)
+    parser.add_argument('--warmup-steps', type = int, default = 20)
+    parser.add_argument('--serving-requests', type = int, default = 1000)
+    parser.add_argument('--serving-concurrency', type = int, default = 16)
+    parser.add_argument('--work-dir', help = 'keep the generated data and artifacts here')
+    parser.add_argument('--output', help = 'results json, by default a new file in {}'.format(
+                        config.BENCHMARK_RESULTS_DIR_PATH))
+    args = parser.parse_args()
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok = True)
+        results = run_suite(args, args.work_dir)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_suite(args, work_dir)
+
+    output = args.output or os.path.join(config.BENCHMARK_RESULTS_DIR_PATH,
+                                        '{}.json'.format(time.strftime('%Y%m%dT%H%M%S')))
+    os.makedirs(os.path.dirname(output) or '.', exist_ok = True)
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent = 2)
+    print(json.dumps(results['scenarios'], indent = 2))
+    print("results written to {}".format(output))
@@ -0,0 +1,111 @@
+#python3.8.4
+"""
+Synthetic consumer complaints with the columns of the CFPB export that
+tfrecord_data_writer and the pipeline read, so benchmarks run without the
+downloaded file. Categorical columns draw from a fixed number of distinct
+values (CARDINALITIES, overridable per column) with a skewed distribution,
+zip codes are masked like the export ("294XX") and a few are missing.
+consumer_disputed depends on product and company_response, so a model
+has something to learn.
+
+    python -m benchmarks.synthetic_data --rows 100000 --cardinality company=2000
+"""
+
+# %%
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from consumer_complaint.config import config
+
+CARDINALITIES = {
+    'product': 11,
+    'sub_product': 45,
+    'issue': 90,
+    'sub_issue': 60,
+    'company': 500,
+    'state': 60,
+    'company_response': 5,
+}
+NARRATIVE_VOCABULARY_SIZE = 5000
+NARRATIVE_WORDS = (20, 200)
+MISSING_ZIP_CODE_RATE = 0.05
+TIMELY_RESPONSE_RATE = 0.97
+
+
+# %%
+def _categorical(rng, column, cardinality, num_rows):
+    """values with a zipf like frequency, like most real categorical columns"""
+    weights = 1.0 / np.arange(1, cardinality + 1)
+    codes = rng.choice(cardinality, size = num_rows, p = weights / weights.sum())
+    return codes, np.array(['{} {}'.format(column, code) for code in range(cardinality)], dtype = object)[codes]
+
+
+def _narratives(rng, num_rows):
+    vocabulary = np.array(['word{}'.format(index) for index in range(NARRATIVE_VOCABULARY_SIZE)], dtype = object)
+    lengths = rng.integers(*NARRATIVE_WORDS, size = num_rows)
+    words = vocabulary[rng.integers(NARRATIVE_VOCABULARY_SIZE, size = lengths.sum())]
+    return [' '.join(row_words) for row_words in np.split(words, np.cumsum(lengths)[:-1])]
+
+
+def _zip_codes(rng, num_rows):
+    zip_codes = np.array(['{:03d}XX'.format(prefix) for prefix in rng.integers(1000, size = num_rows)],
+                        dtype = object)
+    zip_codes[rng.random(num_rows) < MISSING_ZIP_CODE_RATE] = ''
+    return zip_codes
+
+
+def generate_complaints(num_rows, cardinalities = None, seed = 0):
+    """DataFrame of num_rows synthetic complaints, the same seed gives the same rows"""
+    cardinalities = {**CARDINALITIES, **(cardinalities or {})}
+    rng = np.random.default_rng(seed)
+    columns, codes = {config.COMPLAINT_ID_COLUMN: np.arange(num_rows)}, {}
+    for column, cardinality in cardinalities.items():
+        codes[column], columns[column] = _categorical(rng, column, cardinality, num_rows)
+    columns['consumer_complaint_narrative'] = _narratives(rng, num_rows)
+    columns['zip_code'] = _zip_codes(rng, num_rows)
+    columns['timely_response'] = np.where(rng.random(num_rows) < TIMELY_RESPONSE_RATE, 'Yes', 'No')
+
+    #a fixed dispute rate per product and per company response
+    product_rates = rng.uniform(0.05, 0.4, size = cardinalities['product'])
+    response_rates = rng.uniform(-0.05, 0.15, size = cardinalities['company_response'])
+    dispute_rate = product_rates[codes['product']] + response_rates[codes['company_response']]
+    columns['consumer_disputed'] = (rng.random(num_rows) < dispute_rate).astype(np.int64)
+
+    data = pd.DataFrame(columns)
+    return data[[config.COMPLAINT_ID_COLUMN, 'product', 'sub_product', 'issue', 'sub_issue',
+                'consumer_complaint_narrative', 'company', 'state', 'zip_code',
+                'company_response', 'timely_response', 'consumer_disputed']]
+
+
+def write_complaints_csv(file_path, num_rows, cardinalities = None, seed = 0):
+    """write the synthetic complaints where the csv readers expect DATA_FILE_PATH"""
+    os.makedirs(os.path.dirname(file_path), exist_ok = True)
+    data = generate_complaints(num_rows, cardinalities, seed)
+    data.to_csv(file_path, index = False, encoding = 'utf-8')
+    return data
+
+
+def parse_cardinalities(values):
+    """['company=2000', ...] into {'company': 2000, ...}"""
+    cardinalities = {}
+    for value in values or []:
+        column, cardinality = value.split('=')
+        if column not in CARDINALITIES:
+            raise ValueError("{} is not one of the categorical columns {}".format(column, list(CARDINALITIES)))
+        cardinalities[column] = int(cardinality)
+    return cardinalities
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type = int, default = 100000)
+    parser.add_argument('--cardinality', action = 'append', metavar = 'COLUMN=COUNT')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--file-path', default = config.DATA_FILE_PATH)
+    args = parser.parse_args()
+
+    write_complaints_csv(args.file_path, args.rows, parse_cardinalities(args.cardinality), args.seed)
+    print("wrote {} rows to {}".format(args.rows, args.file_path))
@@ -0,0 +1,62 @@
+#python3.8.4
+"""
+Throughput benchmark for the single threaded tfrecord_data_writer against
+the sharded, multi-process sharded_tfrecord_data_writer.
+
+    python -m benchmarks.tfrecord_writer_benchmark --num-shards 8
+"""
+
+# %%
+import argparse
+import csv
+import os
+import tempfile
+import time
+from consumer_complaint.config import config
+from practice_example import data_ingestion
+
+
+# %%
+def count_rows(file_path):
+    with open(file_path, encoding = 'utf-8') as csv_file:
+        return sum(1 for _ in csv.DictReader(csv_file))
+
+
+def time_writer(writer_fn):
+    start = time.perf_counter()
+    writer_fn()
+    return time.perf_counter() - start
+
+
+def run_benchmark(file_path, num_shards):
+    num_rows = count_rows(file_path)
+    with tempfile.TemporaryDirectory() as output_dir:
+        single_seconds = time_writer(lambda: data_ingestion.tfrecord_data_writer(
+            file_path, record_file_path = os.path.join(output_dir, config.RECORD_NAME)))
+        sharded_seconds = time_writer(lambda: data_ingestion.sharded_tfrecord_data_writer(
+            file_path, num_shards = num_shards,
+            record_dir_path = os.path.join(output_dir, 'shards')))
+
+    results = {
+        'rows': num_rows,
+        'num_shards': num_shards,
+        'single_seconds': single_seconds,
+        'single_rows_per_sec': num_rows / single_seconds,
+        'sharded_seconds': sharded_seconds,
+        'sharded_rows_per_sec': num_rows / sharded_seconds,
+        'speedup': single_seconds / sharded_seconds,
+    }
+    return results
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file-path', default = config.DATA_FILE_PATH)
+    parser.add_argument('--num-shards', type = int, default = os.cpu_count())
+    args = parser.parse_args()
+
+    results = run_benchmark(args.file_path, args.num_shards)
+    for key, value in results.items():
+        print("{:<22}{}".format(key, value))
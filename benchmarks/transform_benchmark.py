@@ -0,0 +1,125 @@
+#python3.8.4
+"""
+Wall clock of the Transform analysis (practice_example/data_preprocessing.py)
+with per feature and with fused analyzers (config.TRANSFORM_ANALYZERS), on
+synthetic complaints written as tfrecord shards, split into spans. Every mode
+runs in its own process with its own analyzer cache, three times:
+    cold         all spans, empty cache
+    unchanged    the same spans again, every span comes from the cache
+    new_span     the same spans and one more, only that one is read
+With both modes the cold transform graphs are then checked for parity, on
+rows of the first span written the way the tfrecord shards are, every
+transformed feature should be the same.
+Other arguments are passed on to the Beam pipeline, e.g.
+--direct_running_mode=multi_processing --direct_num_workers=8.
+
+    python -m benchmarks.transform_benchmark --rows 1000000 --spans 4
+"""
+
+# %%
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from consumer_complaint.config import config
+from practice_example import data_ingestion
+from practice_example.features import TRANSFORM_ANALYZERS_MODES
+from benchmarks import synthetic_data
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# %%
+def write_spans(data_dir, num_rows, num_spans, num_shards):
+    """num_spans + 1 spans of tfrecord shards, the last one is the new span"""
+    rows_per_span = num_rows // num_spans
+    patterns = []
+    for span in range(num_spans + 1):
+        span_dir = os.path.join(data_dir, 'export-{}'.format(span))
+        csv_path = os.path.join(span_dir, 'complaints.csv')
+        synthetic_data.write_complaints_csv(csv_path, rows_per_span, seed = span)
+        data_ingestion.sharded_tfrecord_data_writer(csv_path, num_shards,
+                                                    record_dir_path = os.path.join(span_dir, 'records'))
+        os.remove(csv_path)
+        patterns.append(os.path.join(span_dir, 'records', config.RECORD_SHARD_PATTERN))
+    return patterns, rows_per_span
+
+
+def run_analysis(mode, patterns, output_dir, cache_dir, beam_args):
+    environment = dict(os.environ, **{config.ENV_PREFIX + 'TRANSFORM_ANALYZERS': mode})
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-m', 'practice_example.data_preprocessing', *patterns,
+                                '--output-dir', output_dir, '--cache-dir', cache_dir, *beam_args],
+                                cwd = ROOT_DIR, env = environment, check = True,
+                                capture_output = True, text = True)
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result['wall_seconds'] = time.perf_counter() - start
+    return result
+
+
+def analyzers_parity(per_feature_dir, fused_dir, num_rows):
+    """numpy_transform.analyzers_parity_report of the two transform graphs"""
+    import tensorflow_transform as tft
+    from practice_example import numpy_transform
+
+    data = synthetic_data.generate_complaints(num_rows, seed = 0)
+    #the columns as data_ingestion._serialize_row writes them
+    data = data.astype({column: str for column in data.columns if column != 'zip_code'})
+    data['zip_code'] = data['zip_code'].map(
+        lambda zip_code: data_ingestion.convert_zipcode_to_int(data_ingestion.clean_rows(
+            {'zip_code': zip_code})['zip_code']))
+    return numpy_transform.analyzers_parity_report(
+        data, tft.TFTransformOutput(per_feature_dir), tft.TFTransformOutput(fused_dir))
+
+
+def run_benchmark(modes, num_rows, num_spans, num_shards, beam_args, parity_rows = 10000):
+    results, parity = [], None
+    with tempfile.TemporaryDirectory() as work_dir:
+        patterns, rows_per_span = write_spans(os.path.join(work_dir, 'data'), num_rows, num_spans, num_shards)
+        runs = [('cold', patterns[:-1]), ('unchanged', patterns[:-1]), ('new_span', patterns)]
+        for mode in modes:
+            cache_dir = os.path.join(work_dir, 'cache', mode)
+            for run, run_patterns in runs:
+                result = run_analysis(mode, run_patterns, os.path.join(work_dir, 'output', mode, run),
+                                    cache_dir, beam_args)
+                results.append({'mode': mode, 'run': run, 'rows': rows_per_span * len(run_patterns),
+                                'rows_read': rows_per_span * result['spans_read'], **result})
+        if 'per_feature' in modes and 'fused' in modes:
+            parity = analyzers_parity(os.path.join(work_dir, 'output', 'per_feature', 'cold'),
+                                    os.path.join(work_dir, 'output', 'fused', 'cold'),
+                                    min(parity_rows, rows_per_span))
+    return results, parity
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs = '+', choices = TRANSFORM_ANALYZERS_MODES,
+                        default = list(TRANSFORM_ANALYZERS_MODES))
+    parser.add_argument('--rows', type = int, default = 1000000, help = 'rows of the cold run')
+    parser.add_argument('--spans', type = int, default = 4)
+    parser.add_argument('--shards', type = int, default = os.cpu_count(), help = 'tfrecord shards per span')
+    parser.add_argument('--parity-rows', type = int, default = 10000)
+    parser.add_argument('--output', help = 'also write the results to this json file')
+    args, beam_args = parser.parse_known_args()
+
+    results, parity = run_benchmark(args.modes, args.rows, args.spans, args.shards, beam_args,
+                                    args.parity_rows)
+    for result in results:
+        print("{mode:<12} {run:<10} spans read {spans_read}/{spans}  rows read {rows_read:>8}/{rows:<8} "
+            "analysis {seconds:7.1f}s  wall {wall_seconds:7.1f}s".format(**result))
+    cold = {result['mode']: result for result in results if result['run'] == 'cold'}
+    if 'per_feature' in cold and 'fused' in cold:
+        print("fused against per_feature, cold: {:.2f}x faster".format(
+            cold['per_feature']['seconds'] / cold['fused']['seconds']))
+    if parity is not None:
+        differences = {name: difference for name, difference in parity.items() if difference}
+        print("fused against per_feature, parity: {}".format(
+            ", ".join("{} differs by {}".format(*item) for item in differences.items()) or "identical"))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'runs': results, 'parity': parity}, output_file, indent = 2)
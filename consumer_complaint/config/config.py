@@ -1,42 +1,209 @@
 #python 3.8.4
 #./venv/bin/python
-import os 
+"""
+Every setting below can be overridden without editing this file, first match wins:
+    CONSUMER_COMPLAINT_<NAME> environment variable, e.g.
+        CONSUMER_COMPLAINT_PIPELINE_ROOT=/tmp/pipeline_root
+    the json object in the file CONSUMER_COMPLAINT_CONFIG points to, e.g.
+        {"INFERENCE_HTTP_PORT": 8601, "BEAM_PROFILE": "in_memory"}
+Values are parsed as json when they parse, so numbers, lists, dicts and null
+work from the environment too. Paths derived from an overridden setting follow
+it. Only the standard library is imported here, importing config stays cheap.
+"""
+import functools
+import json
+import os
+
+ENV_PREFIX = 'CONSUMER_COMPLAINT_'
+CONFIG_FILE_ENV = ENV_PREFIX + 'CONFIG'
+
+
+@functools.lru_cache(maxsize = None)
+def _file_overrides():
+    """the override file is only read if it is set, and only once"""
+    config_file_path = os.environ.get(CONFIG_FILE_ENV)
+    if not config_file_path:
+        return {}
+    with open(config_file_path, encoding = 'utf-8') as config_file:
+        return json.load(config_file)
+
+
+def _setting(name, default):
+    value = os.environ.get(ENV_PREFIX + name)
+    if value is None:
+        return _file_overrides().get(name, default)
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
 #Project Paths
 PACKAGE_DIR = os.path.dirname(os.path.dirname(__file__))
 ROOT_DIR = os.path.dirname(PACKAGE_DIR)
-FILE_NAME = 'consumer_complaints_with_narrative.csv'
+FILE_NAME = _setting('FILE_NAME', 'consumer_complaints_with_narrative.csv')
 
 #Data Paths
-DATA_DIR_PATH = os.path.join(PACKAGE_DIR, 'files', 'data')
-DATA_FILE_PATH = os.path.join(DATA_DIR_PATH, FILE_NAME)
+DATA_DIR_PATH = _setting('DATA_DIR_PATH', os.path.join(PACKAGE_DIR, 'files', 'data'))
+DATA_FILE_PATH = _setting('DATA_FILE_PATH', os.path.join(DATA_DIR_PATH, FILE_NAME))
 
 #Splitted Data Paths
-DATA_SPLITS_DIR_PATH = os.path.join(PACKAGE_DIR, 'files', 'data_splits')
-TRAIN_FILE_PATH = os.path.join(DATA_SPLITS_DIR_PATH, 'shuffled_train_data.csv')
-VAL_FILE_PATH = os.path.join(DATA_SPLITS_DIR_PATH, 'shuffled_val_data.csv')
+DATA_SPLITS_DIR_PATH = _setting('DATA_SPLITS_DIR_PATH', os.path.join(PACKAGE_DIR, 'files', 'data_splits'))
+TRAIN_FILE_PATH = _setting('TRAIN_FILE_PATH', os.path.join(DATA_SPLITS_DIR_PATH, 'shuffled_train_data.csv'))
+VAL_FILE_PATH = _setting('VAL_FILE_PATH', os.path.join(DATA_SPLITS_DIR_PATH, 'shuffled_val_data.csv'))
+
+#Statistics cache, keyed by input file fingerprint and statistics options
+STATISTICS_CACHE_DIR_PATH = _setting('STATISTICS_CACHE_DIR_PATH', os.path.join(PACKAGE_DIR, 'files', 'statistics_cache'))
 
 #TF Record Paths
-RECORD_NAME = 'consumer_complaint.tfrecord'
-RECORD_DIR_PATH = os.path.join(PACKAGE_DIR, 'files','tf_record')
-RECORD_FILE_PATH = os.path.join(RECORD_DIR_PATH, RECORD_NAME)
+RECORD_NAME = _setting('RECORD_NAME', 'consumer_complaint.tfrecord')
+RECORD_DIR_PATH = _setting('RECORD_DIR_PATH', os.path.join(PACKAGE_DIR, 'files','tf_record'))
+RECORD_FILE_PATH = _setting('RECORD_FILE_PATH', os.path.join(RECORD_DIR_PATH, RECORD_NAME))
+
+#Sharded TF Record Paths (gzip compressed, readable by ImportExampleGen)
+RECORD_SHARDS_DIR_PATH = _setting('RECORD_SHARDS_DIR_PATH', os.path.join(PACKAGE_DIR, 'files', 'tf_record_shards'))
+RECORD_SHARD_NAME = _setting('RECORD_SHARD_NAME', 'consumer_complaint-{:05d}-of-{:05d}.tfrecord.gz')
+RECORD_SHARD_PATTERN = _setting('RECORD_SHARD_PATTERN', 'consumer_complaint-*-of-*.tfrecord.gz')
+
+#Parquet Paths (columnar copy of DATA_FILE_PATH)
+PARQUET_DIR_PATH = _setting('PARQUET_DIR_PATH', os.path.join(PACKAGE_DIR, 'files', 'parquet'))
+PARQUET_PART_NAME = _setting('PARQUET_PART_NAME', 'part-{:05d}.parquet')
+PARQUET_ROWS_PER_PARTITION = _setting('PARQUET_ROWS_PER_PARTITION', 100000)
+#csv bytes parsed at a time, the column types are inferred from the first block
+PARQUET_CSV_BLOCK_BYTES = _setting('PARQUET_CSV_BLOCK_BYTES', 64 << 20)
+CATEGORICAL_COLUMNS = _setting('CATEGORICAL_COLUMNS', ['product', 'sub_product', 'issue', 'state', 'company_response'])
 
 #TFX Pipeline
-PIPELINE_ROOT = os.path.join(ROOT_DIR, 'pipeline_root')
-PIPELINE_NAME = "consumer_complaint_pipeline"
-METADATA_PATH = os.path.join(PIPELINE_ROOT, "metadata.sqlite")
+PIPELINE_ROOT = _setting('PIPELINE_ROOT', os.path.join(ROOT_DIR, 'pipeline_root'))
+PIPELINE_NAME = _setting('PIPELINE_NAME', "consumer_complaint_pipeline")
+METADATA_PATH = _setting('METADATA_PATH', os.path.join(PIPELINE_ROOT, "metadata.sqlite"))
+
+#Beam Execution, see practice_pipeline.beam_pipeline_args
+#in_memory, multi_threading, multi_processing, flink, spark or portable
+BEAM_PROFILE = _setting('BEAM_PROFILE', 'multi_processing')
+#{component id: {"profile": ..., "num_workers": ...}}, pick them with
+#`python -m benchmarks.component_benchmark`
+BEAM_COMPONENT_PROFILES = _setting('BEAM_COMPONENT_PROFILES', {})
+#embedded job servers of the local flink and spark runners, or a running one
+BEAM_FLINK_MASTER = _setting('BEAM_FLINK_MASTER', '[local]')
+BEAM_SPARK_MASTER_URL = _setting('BEAM_SPARK_MASTER_URL', 'local[{num_workers}]')
+BEAM_JOB_ENDPOINT = _setting('BEAM_JOB_ENDPOINT', 'localhost:8099')
+
+#Incremental (span based) ingestion, data_dir holds export-<span> snapshots
+SPAN_INPUT_PATTERN = _setting('SPAN_INPUT_PATTERN', 'export-{SPAN}/*')
+SPAN_VERSION_INPUT_PATTERN = _setting('SPAN_VERSION_INPUT_PATTERN', 'export-{SPAN}/ver-{VERSION}/*')
+CUMULATIVE_STATS_DIR_PATH = _setting('CUMULATIVE_STATS_DIR_PATH', os.path.join(PIPELINE_ROOT, "CumulativeStatistics"))
+TRANSFORM_SPAN_WINDOW = _setting('TRANSFORM_SPAN_WINDOW', 30)
+
+#Categorical features, part of the Transform/Trainer contract, see practice_example/features.py
+#one_hot writes dense float one-hots to the transformed examples, ids writes int64
+#vocabulary ids the model looks its weights up with. Changing these changes the
+#transformed examples, so rerun Transform without the pipeline cache
+CATEGORICAL_ENCODING = _setting('CATEGORICAL_ENCODING', "one_hot")
+#feature name -> most values kept, the rest are out of vocabulary. Once FeatureConfigGen
+#has run, the vocabulary sizes derived from the statistics are used instead, capped by these,
+#see practice_example/feature_config.py
+CATEGORICAL_VOCAB_SIZES = _setting('CATEGORICAL_VOCAB_SIZES', {
+    "product": 11,
+    "sub_product": 45,
+    "company_response": 5,
+    "state": 60,
+    "issue": 90,
+})
+#too many values for dense one-hots, only used with CATEGORICAL_ENCODING = ids
+HIGH_CARDINALITY_VOCAB_SIZES = _setting('HIGH_CARDINALITY_VOCAB_SIZES', {
+    "company": 2000,
+    "sub_issue": 200,
+})
+#values seen fewer times than this in the train split are out of vocabulary
+CATEGORICAL_MIN_FREQUENCY = _setting('CATEGORICAL_MIN_FREQUENCY', 5)
+#out of vocabulary values are hashed into this many ids, at least 1 with ids
+CATEGORICAL_OOV_BUCKETS = _setting('CATEGORICAL_OOV_BUCKETS', 1)
+
+#Transform analyzers, see practice_example/features.py. per_feature runs one vocabulary
+#and one quantiles analyzer per feature, fused one vocabulary shared by all the categorical
+#features and one quantiles analyzer per bucket count. The transformed examples are the same
+TRANSFORM_ANALYZERS = _setting('TRANSFORM_ANALYZERS', "per_feature")
+#Transform outside of the pipeline, see practice_example/data_preprocessing.py, its
+#analyzer cache is keyed by the fingerprint of every span's files
+TRANSFORM_OUTPUT_DIR_PATH = _setting('TRANSFORM_OUTPUT_DIR_PATH', os.path.join(PIPELINE_ROOT, "Transform_Output"))
+ANALYZER_CACHE_DIR_PATH = _setting('ANALYZER_CACHE_DIR_PATH', os.path.join(PIPELINE_ROOT, "Analyzer_Cache"))
+
+#Universal Sentence Encoder and the precomputed narrative embeddings
+USE_MODULE_URL = _setting('USE_MODULE_URL', "https://tfhub.dev/google/universal-sentence-encoder/4")
+EMBEDDING_DIM = _setting('EMBEDDING_DIM', 512)
+#local TF-Hub module store, filled once by `python -m practice_example.tfhub_store prefetch`
+TFHUB_MODULE_STORE_PATH = _setting('TFHUB_MODULE_STORE_PATH', os.path.join(PACKAGE_DIR, 'files', 'tfhub_modules'))
+EMBEDDING_CACHE_DIR_PATH = _setting('EMBEDDING_CACHE_DIR_PATH', os.path.join(PACKAGE_DIR, 'files', 'embedding_cache'))
+
+#Skew and drift monitoring, daily distribution summaries per dataset name
+SKEW_SUMMARY_STORE_PATH = _setting('SKEW_SUMMARY_STORE_PATH', os.path.join(PIPELINE_ROOT, "Skew_Summaries"))
 
 #Model Directory
-SERVING_MODEL_DIR = os.path.join(PIPELINE_ROOT, "Serving_Model", PIPELINE_NAME)
+SERVING_MODEL_DIR = _setting('SERVING_MODEL_DIR', os.path.join(PIPELINE_ROOT, "Serving_Model", PIPELINE_NAME))
+
+#Compact model for CPU serving, distilled from the full model, see practice_example/compact_model.py
+COMPACT_SERVING_MODEL_DIR = _setting('COMPACT_SERVING_MODEL_DIR', os.path.join(PIPELINE_ROOT, "Serving_Model", PIPELINE_NAME + "_compact"))
+COMPACT_NGRAM_BUCKETS = _setting('COMPACT_NGRAM_BUCKETS', 2 ** 17)
+COMPACT_EMBEDDING_DIM = _setting('COMPACT_EMBEDDING_DIM', 32)
+COMPACT_NGRAM_WIDTH = _setting('COMPACT_NGRAM_WIDTH', 2)
+#weight of the labels in the distillation loss, the rest goes to the full model's predictions
+COMPACT_DISTILLATION_ALPHA = _setting('COMPACT_DISTILLATION_ALPHA', 0.3)
+#int8 or float16 weights of the TFLite export, None for no TFLite export
+COMPACT_QUANTIZATION = _setting('COMPACT_QUANTIZATION', "int8")
+COMPACT_TFLITE_FILE_NAME = _setting('COMPACT_TFLITE_FILE_NAME', "model.tflite")
+#signature taking the transformed features, the one converted to TFLite
+COMPACT_SIGNATURE_NAME = _setting('COMPACT_SIGNATURE_NAME', "serving_transformed")
+#the Evaluator blesses the compact model when its accuracy is at most this much below the full model's
+COMPACT_ACCURACY_TOLERANCE = _setting('COMPACT_ACCURACY_TOLERANCE', 0.01)
+
+#Local Inference Server
+INFERENCE_MODEL_NAME = _setting('INFERENCE_MODEL_NAME', "consumer_complaint")
+#signature taking the raw features as named tensors instead of tf.Examples
+RAW_SIGNATURE_NAME = _setting('RAW_SIGNATURE_NAME', "serving_raw")
+INFERENCE_HTTP_PORT = _setting('INFERENCE_HTTP_PORT', 8501)
+INFERENCE_GRPC_PORT = _setting('INFERENCE_GRPC_PORT', 8500)
+INFERENCE_MAX_BATCH_SIZE = _setting('INFERENCE_MAX_BATCH_SIZE', 64)
+INFERENCE_MAX_WAIT_MS = _setting('INFERENCE_MAX_WAIT_MS', 5)
+INFERENCE_NUM_WORKERS = _setting('INFERENCE_NUM_WORKERS', 2)
+INFERENCE_POLL_SECONDS = _setting('INFERENCE_POLL_SECONDS', 30)
+#statistics of the served traffic, see practice_example/serving_stats.py
+SERVING_STATS_DIR_PATH = _setting('SERVING_STATS_DIR_PATH', os.path.join(PIPELINE_ROOT, "Serving_Statistics"))
+SERVING_STATS_EXPORT_SECONDS = _setting('SERVING_STATS_EXPORT_SECONDS', 300)
+SERVING_STATS_TOP_K = _setting('SERVING_STATS_TOP_K', 1000)
+SERVING_STATS_RELATIVE_ACCURACY = _setting('SERVING_STATS_RELATIVE_ACCURACY', 0.01)
+
+#Batch Scoring
+COMPLAINT_ID_COLUMN = _setting('COMPLAINT_ID_COLUMN', 'complaint_id')
+BATCH_PREDICTIONS_DIR_PATH = _setting('BATCH_PREDICTIONS_DIR_PATH', os.path.join(PIPELINE_ROOT, "Batch_Predictions"))
+BATCH_SCORING_BATCH_SIZE = _setting('BATCH_SCORING_BATCH_SIZE', 4096)
+
+#Benchmark Suite, one json file of results per run
+BENCHMARK_RESULTS_DIR_PATH = _setting('BENCHMARK_RESULTS_DIR_PATH', os.path.join(PIPELINE_ROOT, "Benchmarks"))
 
 #GOOGLE BIG QUERY
-GCP_PROJECT_ID = 'consumer-complaint-310721'
+GCP_PROJECT_ID = _setting('GCP_PROJECT_ID', 'consumer-complaint-310721')
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-GOOGLE_APPLICATION_CREDENTIALS = "consumer-complaint-service.json"
-TEMP_GCS_LOCATION = "gs://tfx_test_04142021"
-GOOGLE_CREDENTIAL_PATH = os.path.join(PROJECT_DIR, 'credentials', GOOGLE_APPLICATION_CREDENTIALS)
+GOOGLE_APPLICATION_CREDENTIALS = _setting('GOOGLE_APPLICATION_CREDENTIALS', "consumer-complaint-service.json")
+TEMP_GCS_LOCATION = _setting('TEMP_GCS_LOCATION', "gs://tfx_test_04142021")
+GOOGLE_CREDENTIAL_PATH = _setting('GOOGLE_CREDENTIAL_PATH', os.path.join(PROJECT_DIR, 'credentials', GOOGLE_APPLICATION_CREDENTIALS))
+#BigQuery Storage Read API streaming, see data_connectors/google_bigquery.py
+BIGQUERY_MAX_READ_STREAMS = _setting('BIGQUERY_MAX_READ_STREAMS', 4)
+BIGQUERY_MAX_BUFFERED_BATCHES = _setting('BIGQUERY_MAX_BUFFERED_BATCHES', 16)
+BIGQUERY_EXPORT_DIR_PATH = _setting('BIGQUERY_EXPORT_DIR_PATH', os.path.join(PACKAGE_DIR, 'files', 'bigquery_export'))
+BIGQUERY_SHARD_NAME = _setting('BIGQUERY_SHARD_NAME', 'bigquery-{:05d}-of-{:05d}')
+#BigQueryConnection.bulk_load, parquet chunks of the csv wait in the staging dir until loaded
+BIGQUERY_LOAD_CHUNK_BYTES = _setting('BIGQUERY_LOAD_CHUNK_BYTES', 64 << 20)
+BIGQUERY_LOAD_NUM_WORKERS = _setting('BIGQUERY_LOAD_NUM_WORKERS', 4)
+BIGQUERY_LOAD_MAX_RETRIES = _setting('BIGQUERY_LOAD_MAX_RETRIES', 3)
+BIGQUERY_LOAD_RETRY_SECONDS = _setting('BIGQUERY_LOAD_RETRY_SECONDS', 2)
+BIGQUERY_LOAD_STAGING_DIR_PATH = _setting('BIGQUERY_LOAD_STAGING_DIR_PATH', os.path.join(PACKAGE_DIR, 'files', 'bigquery_load'))
+BIGQUERY_SPAN_COLUMN = _setting('BIGQUERY_SPAN_COLUMN', 'span')
+#endpoints of a local fake BigQuery server (REST and gRPC), None for Google Cloud
+BIGQUERY_API_ENDPOINT = _setting('BIGQUERY_API_ENDPOINT', None)
+BIGQUERY_STORAGE_API_ENDPOINT = _setting('BIGQUERY_STORAGE_API_ENDPOINT', None)
 
 #Practice_Example Paths
-PRACTICE_EXAMPLE_DIR_PATH = os.path.join(ROOT_DIR, 'practice_example')
-MODULE_FILE_PATH = os.path.join(PRACTICE_EXAMPLE_DIR_PATH, 'module.py')
+PRACTICE_EXAMPLE_DIR_PATH = _setting('PRACTICE_EXAMPLE_DIR_PATH', os.path.join(ROOT_DIR, 'practice_example'))
+MODULE_FILE_PATH = _setting('MODULE_FILE_PATH', os.path.join(PRACTICE_EXAMPLE_DIR_PATH, 'module.py'))
 
 
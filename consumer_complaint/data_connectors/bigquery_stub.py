@@ -0,0 +1,252 @@
+#python 3.8.4
+#./venv/bin/python
+"""
+In memory stand-ins for bigquery.Client and bigquery_storage.BigQueryReadClient,
+so BigQueryConnection runs without network, e.g. in CI:
+
+    client = StubBigQueryClient.from_recordings(recording_dir)
+    connection = BigQueryConnection(config.GCP_PROJECT_ID, client = client,
+                                    storage_client = StubBigQueryReadClient(client))
+
+Tables are pyarrow Tables keyed by "dataset.table". Query results are either
+registered directly or recorded once from the real service with
+record_query_results, as one parquet file per query. Parquet load jobs, copy
+jobs and the MERGE statement of google_bigquery.merge_query run against the
+tables, fail_next_jobs makes the next jobs fail to exercise retries.
+Only the calls BigQueryConnection makes are implemented.
+"""
+
+# %%
+import glob
+import hashlib
+import itertools
+import os
+import re
+import threading
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import Conflict, InternalServerError, NotFound
+
+STUB_PROJECT_ID = 'stub-project'
+RESULTS_DATASET_ID = '_stub_query_results'
+MERGE_PATTERN = re.compile(r'MERGE `([^`]+)` AS target USING `([^`]+)` AS source ON (.+) '
+                            r'WHEN NOT MATCHED THEN INSERT ROW')
+
+
+# %%
+def query_key(query):
+    """queries that only differ in whitespace share their recording"""
+    return hashlib.sha1(' '.join(query.split()).encode('utf-8')).hexdigest()
+
+
+def record_query_results(connection, queries, recording_dir):
+    """run queries through a real BigQueryConnection and keep their results"""
+    os.makedirs(recording_dir, exist_ok = True)
+    for query in queries:
+        pq.write_table(connection.query_to_arrow(query),
+                        os.path.join(recording_dir, query_key(query) + '.parquet'))
+
+
+def _table_key(table):
+    """"dataset.table" of a table id with or without project, or of a table reference"""
+    if not isinstance(table, str):
+        return '{}.{}'.format(table.dataset_id, table.table_id)
+    return '.'.join(table.strip('`').split('.')[-2:])
+
+
+# %%
+class StubTableReference:
+    def __init__(self, project, dataset_id, table_id):
+        self.project, self.dataset_id, self.table_id = project, dataset_id, table_id
+
+
+class StubJob:
+    def __init__(self, job_id, destination = None, error = None):
+        self.job_id = job_id
+        self.destination = destination
+        self.error_result = error and {'message': str(error)}
+        #stub jobs finish when they are created, failed or not
+        self.state = 'DONE'
+        self._error = error
+
+    def result(self):
+        if self._error is not None:
+            raise self._error
+        return self
+
+
+class StubTable:
+    def __init__(self, table_id, table):
+        self.table_id = table_id
+        self.num_rows = table.num_rows
+        self.schema = table.schema
+
+
+class StubBigQueryClient:
+    def __init__(self, project = STUB_PROJECT_ID, tables = None, query_results = None):
+        """
+        tables: {"dataset.table": pyarrow.Table}
+        query_results: {query: pyarrow.Table}
+        """
+        self.project = project
+        self.tables = dict(tables or {})
+        self.query_results = {query_key(query): table for query, table in (query_results or {}).items()}
+        self.jobs = {}
+        self.failing_jobs = 0
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_recordings(cls, recording_dir, project = STUB_PROJECT_ID, tables = None):
+        client = cls(project, tables)
+        for path in glob.glob(os.path.join(recording_dir, '*.parquet')):
+            client.query_results[os.path.basename(path)[:-len('.parquet')]] = pq.read_table(path)
+        return client
+
+    def fail_next_jobs(self, num_jobs):
+        self.failing_jobs = num_jobs
+
+    def _run_job(self, job_id, run):
+        """jobs run at submission, a job id can only be used once"""
+        with self._lock:
+            job_id = job_id or 'stub_job_{}'.format(next(self._job_ids))
+            if job_id in self.jobs:
+                raise Conflict("Already Exists: Job {}".format(job_id))
+            if self.failing_jobs:
+                self.failing_jobs -= 1
+                job = StubJob(job_id, error = InternalServerError("Stub job {} failed".format(job_id)))
+            else:
+                job = StubJob(job_id, destination = run())
+            self.jobs[job_id] = job
+            return job
+
+    def get_job(self, job_id):
+        if job_id not in self.jobs:
+            raise NotFound("Not found: Job {}".format(job_id))
+        return self.jobs[job_id]
+
+    def get_table(self, table):
+        key = _table_key(table)
+        if key not in self.tables:
+            raise NotFound("Not found: Table {}".format(key))
+        return StubTable(key, self.tables[key])
+
+    def delete_table(self, table, not_found_ok = False):
+        if self.tables.pop(_table_key(table), None) is None and not not_found_ok:
+            raise NotFound("Not found: Table {}".format(_table_key(table)))
+
+    def _append(self, key, table, write_disposition):
+        if key in self.tables and write_disposition != 'WRITE_TRUNCATE':
+            table = pa.concat_tables([self.tables[key], table])
+        self.tables[key] = table
+
+    def load_table_from_file(self, file_obj, destination, job_id = None, job_config = None):
+        table = pq.read_table(file_obj)
+
+        def run():
+            self._append(_table_key(destination), table, job_config.write_disposition)
+        return self._run_job(job_id, run)
+
+    def copy_table(self, sources, destination, job_id = None, job_config = None):
+        def run():
+            self._append(_table_key(destination), self.tables[_table_key(sources)],
+                        job_config.write_disposition if job_config else 'WRITE_EMPTY')
+        return self._run_job(job_id, run)
+
+    def _merge(self, match):
+        destination, source = _table_key(match.group(1)), _table_key(match.group(2))
+        key_columns = re.findall(r'target\.(\w+) = source\.\1', match.group(3))
+        existing = set(zip(*[self.tables[destination].column(column).to_pylist()
+                            for column in key_columns]))
+        source_table = self.tables[source]
+        is_new = [key not in existing for key in
+                zip(*[source_table.column(column).to_pylist() for column in key_columns])]
+        self._append(destination, source_table.filter(pa.array(is_new, type = pa.bool_())),
+                    'WRITE_APPEND')
+
+    def query(self, query, job_id = None):
+        merge = MERGE_PATTERN.match(' '.join(query.split()))
+        if merge:
+            return self._run_job(job_id, lambda: self._merge(merge))
+        key = query_key(query)
+        if key not in self.query_results:
+            raise KeyError("No recorded result for query: {}".format(' '.join(query.split())))
+
+        def run():
+            #like BigQuery, every query writes its result to an anonymous table
+            table_id = 'anon_{}'.format(next(self._job_ids))
+            self.tables['{}.{}'.format(RESULTS_DATASET_ID, table_id)] = self.query_results[key]
+            return StubTableReference(self.project, RESULTS_DATASET_ID, table_id)
+        return self._run_job(job_id, run)
+
+
+# %%
+class StubReadSession:
+    def __init__(self, name, streams):
+        self.name = name
+        self.streams = streams
+
+
+class StubReadStream:
+    def __init__(self, name):
+        self.name = name
+
+
+class _StubPage:
+    def __init__(self, record_batch):
+        self._record_batch = record_batch
+
+    def to_arrow(self):
+        return self._record_batch
+
+
+class _StubRowsIterable:
+    def __init__(self, table, page_size):
+        self._table = table
+        self._page_size = page_size
+
+    @property
+    def pages(self):
+        for start in range(0, self._table.num_rows, self._page_size):
+            for record_batch in self._table.slice(start, self._page_size).to_batches():
+                yield _StubPage(record_batch)
+
+
+class _StubReadRowsStream:
+    def __init__(self, table, page_size):
+        self._table = table
+        self._page_size = page_size
+
+    def rows(self, read_session = None):
+        return _StubRowsIterable(self._table, self._page_size)
+
+
+class StubBigQueryReadClient:
+    """splits a table of the StubBigQueryClient into contiguous row ranges, one per stream"""
+
+    def __init__(self, bigquery_client, page_size = 1024):
+        self.bigquery_client = bigquery_client
+        self.page_size = page_size
+        self._streams = {}
+        self._session_ids = itertools.count()
+
+    def create_read_session(self, parent, read_session, max_stream_count = 1):
+        #projects/<project>/datasets/<dataset>/tables/<table>
+        _, _, _, dataset_id, _, table_id = read_session.table.split('/')
+        table = self.bigquery_client.tables['{}.{}'.format(dataset_id, table_id)]
+        selected_fields = list(read_session.read_options.selected_fields)
+        if selected_fields:
+            table = pa.Table.from_arrays([table.column(field) for field in selected_fields],
+                                        names = selected_fields)
+        session_name = '{}/locations/stub/sessions/{}'.format(parent, next(self._session_ids))
+        num_streams = max(min(max_stream_count or 1, table.num_rows), 1)
+        rows_per_stream = -(-table.num_rows // num_streams)
+        streams = []
+        for index in range(num_streams):
+            stream = StubReadStream('{}/streams/{}'.format(session_name, index))
+            self._streams[stream.name] = table.slice(index * rows_per_stream, rows_per_stream)
+            streams.append(stream)
+        return StubReadSession(session_name, streams)
+
+    def read_rows(self, name, offset = 0):
+        return _StubReadRowsStream(self._streams[name].slice(offset), self.page_size)
@@ -1,51 +1,449 @@
 #python 3.8.4
 #./venv/bin/python
+"""
+Query results are streamed as Arrow record batches through the BigQuery
+Storage Read API instead of being paged through the REST api. A query runs
+once, its result table is read by up to max_streams parallel read streams and
+at most max_buffered_batches batches are held in memory at any time. The
+batches can be consumed with the async iterator stream_record_batches or
+written straight to one parquet or tfrecord shard per read stream.
+Uploads go through bulk_load: the csv is staged as parquet chunks by parallel
+load jobs that resume after a failure, then appended, replaced or merged.
+Both clients are created once per connection and reused by every query,
+pass client / storage_client (e.g. bigquery_stub) to run without network.
+"""
+
 # %%
+import asyncio
+import functools
+import hashlib
+import itertools
+import json
 import os
-import pandas as pd 
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from google.api_core.exceptions import Conflict, NotFound
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import bigquery
-from pandas.io import gbq
+from google.cloud import bigquery_storage
 from consumer_complaint.config import config
 
+BULK_LOAD_WRITE_MODES = ('append', 'replace', 'merge')
+
 # %%
 class BigQueryConnection:
-    def __init__(self, project_id):
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config.GOOGLE_CREDENTIAL_PATH
-        self.client = bigquery.Client()
+    def __init__(self, project_id, client = None, storage_client = None,
+                api_endpoint = config.BIGQUERY_API_ENDPOINT,
+                storage_api_endpoint = config.BIGQUERY_STORAGE_API_ENDPOINT):
         self.project_id = project_id
+        self._storage_api_endpoint = storage_api_endpoint
+        if client is None:
+            if api_endpoint:
+                client = bigquery.Client(project = project_id, credentials = AnonymousCredentials(),
+                                        client_options = {'api_endpoint': api_endpoint})
+            else:
+                os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config.GOOGLE_CREDENTIAL_PATH
+                client = bigquery.Client(project = project_id)
+        self.client = client
+        self._storage_client = storage_client
+        self._storage_client_lock = threading.Lock()
+
+    @property
+    def storage_client(self):
+        """the read client, created on first use and shared by all queries"""
+        with self._storage_client_lock:
+            if self._storage_client is None:
+                if self._storage_api_endpoint:
+                    self._storage_client = bigquery_storage.BigQueryReadClient(
+                        credentials = AnonymousCredentials(),
+                        client_options = {'api_endpoint': self._storage_api_endpoint})
+                else:
+                    self._storage_client = bigquery_storage.BigQueryReadClient()
+            return self._storage_client
 
     def get_public_sql_result(self, query):
-        query_job = self.client.query(query = query)
         print("The query data:")
-        for row in query_job:
-            # Row values can be accessed by field name or index.
-            print("name={}, count={}".format(row[0], row["total_people"]))
+        for batch in self.iter_record_batches(query):
+            counts = batch.column(batch.schema.get_field_index("total_people"))
+            for name, count in zip(batch.column(0).to_pylist(), counts.to_pylist()):
+                print("name={}, count={}".format(name, count))
 
     def get_private_sql_df(self, query):
-        data_df = gbq.read_gbq(query = query, 
-                                project_id = self.project_id)
-        return data_df
+        return self.query_to_arrow(query).to_pandas()
+
+    # read sessions
+    def read_session(self, query, max_streams = config.BIGQUERY_MAX_READ_STREAMS, columns = None):
+        """run query and open an Arrow read session over its result table"""
+        query_job = self.client.query(query)
+        query_job.result()
+        destination = query_job.destination
+        table_path = "projects/{}/datasets/{}/tables/{}".format(
+            destination.project, destination.dataset_id, destination.table_id)
+        requested_session = bigquery_storage.types.ReadSession(
+            table = table_path, data_format = bigquery_storage.types.DataFormat.ARROW)
+        if columns:
+            requested_session.read_options.selected_fields.extend(columns)
+        return self.storage_client.create_read_session(
+            parent = "projects/{}".format(self.project_id),
+            read_session = requested_session,
+            max_stream_count = max_streams)
+
+    def _start_readers(self, session, max_buffered_batches):
+        """
+        Drain every read stream of session in its own thread into one queue of
+        (stream index, batch) holding at most max_buffered_batches, so a slow
+        consumer holds the readers back instead of filling the memory. A stream
+        ends with (index, None), or (index, error) and then (index, None).
+        Setting the returned event makes the readers give up.
+        """
+        streams = list(session.streams)
+        batches = queue.Queue(maxsize = max_buffered_batches)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout = 0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read(index, stream_name):
+            try:
+                for page in self.storage_client.read_rows(stream_name).rows(session).pages:
+                    if not put((index, page.to_arrow())):
+                        return
+            except Exception as error:
+                put((index, error))
+            finally:
+                put((index, None))
+
+        for index, stream in enumerate(streams):
+            threading.Thread(target = read, args = (index, stream.name), daemon = True).start()
+        return batches, stop, len(streams)
+
+    # streaming
+    async def stream_record_batches(self, query, max_streams = config.BIGQUERY_MAX_READ_STREAMS,
+                                    max_buffered_batches = config.BIGQUERY_MAX_BUFFERED_BATCHES,
+                                    columns = None):
+        """
+        Async iterator of (stream index, pyarrow.RecordBatch) of the query result.
+        Batches of one stream come in order, streams are interleaved.
+        """
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(
+            None, functools.partial(self.read_session, query, max_streams, columns))
+        batches, stop, remaining = self._start_readers(session, max_buffered_batches)
+        #a short timeout, so no executor thread stays blocked when the consumer stops early
+        get = functools.partial(batches.get, timeout = 1)
+        try:
+            while remaining:
+                try:
+                    index, batch = await loop.run_in_executor(None, get)
+                except queue.Empty:
+                    continue
+                if batch is None:
+                    remaining -= 1
+                elif isinstance(batch, Exception):
+                    raise batch
+                else:
+                    yield index, batch
+        finally:
+            stop.set()
+
+    def iter_record_batches(self, query, max_streams = config.BIGQUERY_MAX_READ_STREAMS,
+                            max_buffered_batches = config.BIGQUERY_MAX_BUFFERED_BATCHES,
+                            columns = None):
+        """stream_record_batches for synchronous callers, batches only"""
+        session = self.read_session(query, max_streams, columns)
+        batches, stop, remaining = self._start_readers(session, max_buffered_batches)
+        try:
+            while remaining:
+                _, batch = batches.get()
+                if batch is None:
+                    remaining -= 1
+                elif isinstance(batch, Exception):
+                    raise batch
+                else:
+                    yield batch
+        finally:
+            stop.set()
+
+    def query_to_arrow(self, query, **stream_options):
+        batches = list(self.iter_record_batches(query, **stream_options))
+        if not batches:
+            return pa.table({})
+        return pa.Table.from_batches(batches)
+
+    # shards
+    async def _write_shards(self, query, output_dir, open_writer, write_batch, extension,
+                            **stream_options):
+        """one shard per read stream, opened at its first batch"""
+        os.makedirs(output_dir, exist_ok = True)
+        max_streams = stream_options.get('max_streams', config.BIGQUERY_MAX_READ_STREAMS)
+        writers, shard_paths = {}, {}
+        try:
+            async for index, batch in self.stream_record_batches(query, **stream_options):
+                if index not in writers:
+                    shard_paths[index] = os.path.join(
+                        output_dir, config.BIGQUERY_SHARD_NAME.format(index, max_streams) + extension)
+                    writers[index] = open_writer(shard_paths[index], batch.schema)
+                write_batch(writers[index], batch)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        return [shard_paths[index] for index in sorted(shard_paths)]
+
+    def query_to_parquet(self, query, output_dir = config.BIGQUERY_EXPORT_DIR_PATH, **stream_options):
+        """write the result as snappy parquet shards, returns the shard paths"""
+        def open_writer(shard_path, schema):
+            return pq.ParquetWriter(shard_path, schema, compression = 'snappy')
+
+        def write_batch(writer, batch):
+            writer.write_table(pa.Table.from_batches([batch]))
+
+        return asyncio.run(self._write_shards(query, output_dir, open_writer, write_batch,
+                                            '.parquet', **stream_options))
+
+    def query_to_tfrecord(self, query, output_dir = config.BIGQUERY_EXPORT_DIR_PATH, **stream_options):
+        """write the result as gzip tfrecord shards of tf.train.Examples, returns the shard paths"""
+        import tensorflow as tf
+
+        def open_writer(shard_path, schema):
+            return tf.io.TFRecordWriter(shard_path, options = tf.io.TFRecordOptions(compression_type = 'GZIP'))
+
+        def write_batch(writer, batch):
+            for example in record_batch_to_examples(batch):
+                writer.write(example.SerializeToString())
+
+        return asyncio.run(self._write_shards(query, output_dir, open_writer, write_batch,
+                                            '.tfrecord.gz', **stream_options))
+
+
+    # bulk loads
+    def _table_id(self, table):
+        """project.dataset.table for table given as dataset.table or project.dataset.table"""
+        return table if table.count('.') == 2 else '{}.{}'.format(self.project_id, table)
+
+    def _run_job(self, start_job, job_id, max_retries, retry_seconds):
+        """
+        start_job(job_id) and wait for it, retried with exponential backoff.
+        Job ids are deterministic, so a job an interrupted run already started
+        is waited for instead of being run a second time. Jobs that failed in
+        an earlier run are skipped, the next attempt id starts a fresh job.
+        """
+        failures = 0
+        for attempt in itertools.count():
+            attempt_job_id = '{}_{}'.format(job_id, attempt)
+            try:
+                try:
+                    job = start_job(attempt_job_id)
+                except Conflict:
+                    job = self.client.get_job(attempt_job_id)
+                    if job.state == 'DONE' and job.error_result:
+                        continue
+                job.result()
+                return attempt_job_id
+            except Exception:
+                if failures == max_retries:
+                    raise
+                time.sleep(retry_seconds * 2 ** failures)
+                failures += 1
+
+    def _load_chunk(self, chunk_path, staging_table, job_id, max_retries, retry_seconds):
+        job_config = bigquery.LoadJobConfig(source_format = bigquery.SourceFormat.PARQUET,
+                                            write_disposition = bigquery.WriteDisposition.WRITE_APPEND)
+
+        def start_job(attempt_job_id):
+            with open(chunk_path, 'rb') as chunk_file:
+                return self.client.load_table_from_file(chunk_file, staging_table,
+                                                        job_id = attempt_job_id, job_config = job_config)
+
+        return self._run_job(start_job, job_id, max_retries, retry_seconds)
+
+    def _finalize_load(self, staging_table, destination_table, write_mode, key_columns,
+                        job_id, max_retries, retry_seconds):
+        """move the staged rows into destination_table in one job"""
+        if write_mode == 'merge':
+            try:
+                self.client.get_table(destination_table)
+            except NotFound:
+                #nothing to merge with yet
+                write_mode = 'append'
+        if write_mode == 'merge':
+            query = merge_query(self._table_id(destination_table), self._table_id(staging_table),
+                                key_columns)
+            start_job = functools.partial(self.client.query, query)
+        else:
+            job_config = bigquery.CopyJobConfig(write_disposition = (
+                bigquery.WriteDisposition.WRITE_TRUNCATE if write_mode == 'replace'
+                else bigquery.WriteDisposition.WRITE_APPEND))
+            start_job = functools.partial(self.client.copy_table, staging_table, destination_table,
+                                        job_config = job_config)
+        self._run_job(lambda attempt_job_id: start_job(job_id = attempt_job_id),
+                    job_id, max_retries, retry_seconds)
+
+    def bulk_load(self, file_path, destination_table, write_mode = 'append', span = None,
+                key_columns = (config.COMPLAINT_ID_COLUMN,), column_types = None,
+                chunk_bytes = config.BIGQUERY_LOAD_CHUNK_BYTES,
+                num_workers = config.BIGQUERY_LOAD_NUM_WORKERS,
+                max_retries = config.BIGQUERY_LOAD_MAX_RETRIES,
+                retry_seconds = config.BIGQUERY_LOAD_RETRY_SECONDS,
+                staging_dir = config.BIGQUERY_LOAD_STAGING_DIR_PATH):
+        """
+        Load a csv into destination_table ("dataset.table") without holding it in memory.
+        The csv is read in blocks of chunk_bytes, every block is written as a
+        snappy parquet chunk and loaded into a staging table by up to num_workers
+        parallel load jobs. Once all chunks are staged, one job moves them into
+        destination_table:
+            append   add all rows
+            replace  overwrite the table
+            merge    add only the rows whose key_columns are not in the table
+                    yet, e.g. the daily export-<span> snapshots
+        With span, every row gets the span in a config.BIGQUERY_SPAN_COLUMN column.
+        Loaded chunks are recorded in a manifest under staging_dir, so calling
+        bulk_load again after a failure only loads the remaining chunks. Job ids
+        derive from the file (path, size, mtime) and the arguments, so loading
+        an unchanged file again is a no-op.
+        column_types: {column: pyarrow type} for columns the first block infers
+        wrongly, e.g. a column that is empty in the first block.
+        Returns the number of rows staged by this call.
+        """
+        if write_mode not in BULK_LOAD_WRITE_MODES:
+            raise ValueError("write_mode must be one of {}, got {}".format(BULK_LOAD_WRITE_MODES, write_mode))
+        file_stat = os.stat(file_path)
+        run_key = json.dumps([os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns,
+                            destination_table, write_mode, span, chunk_bytes,
+                            sorted((column, str(column_type)) for column, column_type
+                                    in (column_types or {}).items())])
+        run_id = 'bulk_load_' + hashlib.blake2b(run_key.encode('utf-8'), digest_size = 8).hexdigest()
+        run_dir = os.path.join(staging_dir, run_id)
+        manifest_path = os.path.join(run_dir, 'manifest.json')
+        os.makedirs(run_dir, exist_ok = True)
+        manifest = {'loaded_chunks': []}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        loaded_chunks = set(manifest['loaded_chunks'])
+        staging_table = '{}__{}'.format(destination_table, run_id)
+
+        def save_manifest():
+            manifest['loaded_chunks'] = sorted(loaded_chunks)
+            with open(manifest_path + '.tmp', 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.replace(manifest_path + '.tmp', manifest_path)
+
+        def collect(done):
+            errors = []
+            for future in done:
+                index, chunk_path = pending.pop(future)
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    continue
+                loaded_chunks.add(index)
+                os.remove(chunk_path)
+            save_manifest()
+            if errors:
+                raise errors[0]
+
+        num_rows, pending = 0, {}
+        with ThreadPoolExecutor(max_workers = num_workers) as executor:
+            for index, chunk in enumerate(_csv_chunks(file_path, chunk_bytes, column_types)):
+                if index in loaded_chunks:
+                    continue
+                if span is not None:
+                    chunk = chunk.append_column(config.BIGQUERY_SPAN_COLUMN,
+                                                pa.array([span] * chunk.num_rows, type = pa.int64()))
+                chunk_path = os.path.join(run_dir, 'chunk-{:05d}.parquet'.format(index))
+                pq.write_table(chunk, chunk_path, compression = 'snappy')
+                num_rows += chunk.num_rows
+                future = executor.submit(self._load_chunk, chunk_path, staging_table,
+                                        '{}_chunk_{}'.format(run_id, index), max_retries, retry_seconds)
+                pending[future] = (index, chunk_path)
+                #at most two chunks per worker wait on disk
+                if len(pending) >= 2 * num_workers:
+                    collect(wait(pending, return_when = FIRST_COMPLETED).done)
+            collect(wait(pending).done)
+
+        self._finalize_load(staging_table, destination_table, write_mode, key_columns,
+                            '{}_finalize'.format(run_id), max_retries, retry_seconds)
+        self.client.delete_table(staging_table, not_found_ok = True)
+        shutil.rmtree(run_dir, ignore_errors = True)
+        return num_rows
 
 
 # %%
-if __name__ == '__main__':
-    consumer_complaint_df = pd.read_csv(config.FILE_PATH, encoding = 'utf-8')
+def merge_query(destination_table, source_table, key_columns):
+    """insert the source rows whose key_columns are not in destination_table yet"""
+    condition = ' AND '.join('target.{0} = source.{0}'.format(column) for column in key_columns)
+    return ("MERGE `{}` AS target USING `{}` AS source ON {} "
+            "WHEN NOT MATCHED THEN INSERT ROW".format(destination_table, source_table, condition))
+
+
+def _csv_chunks(file_path, chunk_bytes, column_types = None):
+    """the csv as pyarrow Tables of about chunk_bytes each, the types are fixed by the first block"""
+    reader = pa_csv.open_csv(
+        file_path,
+        read_options = pa_csv.ReadOptions(block_size = chunk_bytes),
+        parse_options = pa_csv.ParseOptions(newlines_in_values = True),
+        convert_options = pa_csv.ConvertOptions(column_types = column_types or {},
+                                                strings_can_be_null = True))
+    for batch in reader:
+        yield pa.Table.from_batches([batch])
+
 
 # %%
-    consumer_complaint_df.to_gbq(destination_table = "consumer_complaint.consumer_complaint_data",
-                                project_id = config.GCP_PROJECT_ID,
-                                if_exists = 'replace')
+def record_batch_to_examples(batch):
+    """
+    One tf.train.Example per row, strings as bytes_list, integers and booleans
+    as int64_list and floats as float_list. Nulls are left out of the example.
+    """
+    import tensorflow as tf
+
+    def feature(arrow_type, value):
+        if pa.types.is_integer(arrow_type) or pa.types.is_boolean(arrow_type):
+            return tf.train.Feature(int64_list = tf.train.Int64List(value = [int(value)]))
+        if pa.types.is_floating(arrow_type):
+            return tf.train.Feature(float_list = tf.train.FloatList(value = [value]))
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        elif not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        return tf.train.Feature(bytes_list = tf.train.BytesList(value = [value]))
+
+    columns = [(field.name, field.type, batch.column(index).to_pylist())
+                for index, field in enumerate(batch.schema)]
+    for row in range(batch.num_rows):
+        yield tf.train.Example(features = tf.train.Features(feature = {
+            name: feature(arrow_type, values[row])
+            for name, arrow_type, values in columns if values[row] is not None}))
 
 
 # %%
+if __name__ == '__main__':
     big_query = BigQueryConnection(project_id = config.GCP_PROJECT_ID)
+    big_query.bulk_load(config.DATA_FILE_PATH, "consumer_complaint.consumer_complaint_data",
+                        write_mode = 'replace')
+
+
+# %%
     query = """
-    SELECT * 
-    FROM `consumer-complaint-310721.consumer_complaint.consumer_complaint_data` 
+    SELECT *
+    FROM `consumer-complaint-310721.consumer_complaint.consumer_complaint_data`
     LIMIT 1000;
     """
     result_df = big_query.get_private_sql_df(query = query)
 
+# %%
+    shard_paths = big_query.query_to_parquet(query = query)
+
 
 
 # %%
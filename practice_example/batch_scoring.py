@@ -0,0 +1,172 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Offline batch scoring of complaint shards with the latest pushed model.
+Every worker process loads the SavedModel from config.SERVING_MODEL_DIR once
+and scores whole shards in large batches:
+    TFRecord shards (.tfrecord, .tfrecord.gz)  through serving_default
+    csv and parquet shards                     through serving_raw, reading only
+                                               the model's columns
+Each input shard becomes one parquet file of predictions with the complaint id
+and the model version. Finished shards are skipped, so a failed job is restarted by rerunning it.
+
+    python -m practice_example.batch_scoring '<data dir>/*.parquet'
+"""
+
+# %%
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tensorflow as tf
+from consumer_complaint.config import config
+from practice_example.features import SERVING_FEATURES
+from practice_example.inference_server import ModelManager
+
+#the model of the current worker process, see _init_worker
+_model_manager = None
+
+
+# %%
+def _init_worker(model_dir):
+    global _model_manager
+    _model_manager = ModelManager(model_dir, poll_seconds = 0)
+
+
+def _model_columns(data):
+    """
+    the columns cast to the dtypes of the raw features signature, missing
+    values become the empty strings and zeros fill_in_missing turns them into.
+    Dictionary encoded parquet columns arrive as pandas categoricals.
+    """
+    columns = {}
+    for key, spec in _model_manager.raw_input_specs().items():
+        values = data[key].astype(object)
+        missing = values.isna() | (values == '')
+        if spec.dtype == tf.string:
+            columns[key] = values.where(~missing, '').astype(str).tolist()
+        else:
+            #masked zip codes ("294XX") are read like data_ingestion.convert_zipcode_to_int
+            values = values.where(~missing, 0).astype(str).str.replace('X', '0')
+            columns[key] = pd.to_numeric(values).astype(spec.dtype.as_numpy_dtype).tolist()
+    return columns
+
+
+def _example_ids(serialized_examples, shard_path, id_column):
+    """the id_column value of every tf.Example, a shard without ids can't be scored"""
+    ids = []
+    for serialized_example in serialized_examples:
+        feature = tf.train.Example.FromString(serialized_example).features.feature
+        kind = feature[id_column].WhichOneof('kind') if id_column in feature else None
+        values = getattr(feature[id_column], kind).value if kind else []
+        if not values:
+            raise ValueError("{} has examples without a {} feature, the predictions "
+                            "could not be joined back".format(shard_path, id_column))
+        value = values[0]
+        ids.append(value.decode('utf-8') if isinstance(value, bytes) else value)
+    return np.array(ids)
+
+
+def _read_batches(shard_path, batch_size, id_column):
+    """
+    yield (complaint ids, predict function, inputs) per batch. csv and parquet
+    rows without an id column get their position in the shard as id, tf.Examples
+    must carry the id.
+    """
+    if shard_path.endswith('.tfrecord') or shard_path.endswith('.tfrecord.gz'):
+        compression_type = 'GZIP' if shard_path.endswith('.gz') else ''
+        dataset = tf.data.TFRecordDataset(shard_path, compression_type = compression_type)
+        for batch in dataset.batch(batch_size).as_numpy_iterator():
+            batch = list(batch)
+            yield _example_ids(batch, shard_path, id_column), _model_manager.predict, batch
+        return
+
+    if shard_path.endswith('.parquet'):
+        names = pq.read_schema(shard_path).names
+        columns = [column for column in SERVING_FEATURES + [id_column] if column in names]
+        table = pq.read_table(shard_path, columns = columns, memory_map = True)
+        chunks = (table.slice(start, batch_size).to_pandas()
+                for start in range(0, table.num_rows, batch_size))
+    else:
+        #dtypes inferred per chunk would turn all digit zip codes into ints and
+        #all missing narratives into floats, the text is cast by _model_columns
+        chunks = pd.read_csv(shard_path, encoding = 'utf-8', chunksize = batch_size,
+                            usecols = lambda column: column in SERVING_FEATURES + [id_column],
+                            dtype = {key: str for key in SERVING_FEATURES}, keep_default_na = False)
+    offset = 0
+    for data in chunks:
+        ids = data[id_column].to_numpy() if id_column in data else np.arange(offset, offset + len(data))
+        offset += len(data)
+        yield ids, _model_manager.predict_columns, _model_columns(data)
+
+
+def prediction_path(shard_path, output_dir):
+    return os.path.join(output_dir, os.path.basename(shard_path) + '.predictions.parquet')
+
+
+def score_shard(shard_path, output_dir, batch_size = config.BATCH_SCORING_BATCH_SIZE,
+                id_column = config.COMPLAINT_ID_COLUMN):
+    """score one shard in the current worker, returns the number of rows (0 when already done)"""
+    output_path = prediction_path(shard_path, output_dir)
+    if os.path.exists(output_path):
+        return 0
+    ids, predictions = [], []
+    for batch_ids, predict_fn, inputs in _read_batches(shard_path, batch_size, id_column):
+        batch_predictions, _ = predict_fn(inputs)
+        ids.append(batch_ids)
+        predictions.append(batch_predictions.reshape(-1))
+
+    table = pa.table({
+        id_column: np.concatenate(ids) if ids else np.zeros(0, dtype = np.int64),
+        'prediction': np.concatenate(predictions) if predictions else np.zeros(0, dtype = np.float32),
+        'model_version': np.full(sum(len(batch) for batch in ids), _model_manager.version),
+    })
+    #written under a temporary name, a shard only counts as done once complete
+    temp_path = output_path + '.tmp'
+    pq.write_table(table, temp_path)
+    os.replace(temp_path, output_path)
+    return table.num_rows
+
+
+# %%
+def score_shards(shard_paths, output_dir = config.BATCH_PREDICTIONS_DIR_PATH,
+                model_dir = config.SERVING_MODEL_DIR, num_workers = None,
+                batch_size = config.BATCH_SCORING_BATCH_SIZE,
+                id_column = config.COMPLAINT_ID_COLUMN):
+    """
+    Score the shards on a pool of worker processes.
+    Returns the number of rows scored and the wall time in seconds
+    """
+    os.makedirs(output_dir, exist_ok = True)
+    start = time.perf_counter()
+    #spawned workers start without the parent's tensorflow runtime state
+    with ProcessPoolExecutor(max_workers = num_workers or os.cpu_count(),
+                            mp_context = multiprocessing.get_context('spawn'),
+                            initializer = _init_worker, initargs = (model_dir,)) as executor:
+        futures = [executor.submit(score_shard, shard_path, output_dir, batch_size, id_column)
+                    for shard_path in shard_paths]
+        num_rows = sum(future.result() for future in futures)
+    return num_rows, time.perf_counter() - start
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('patterns', nargs = '+', help = 'shard file patterns')
+    parser.add_argument('--output-dir', default = config.BATCH_PREDICTIONS_DIR_PATH)
+    parser.add_argument('--model-dir', default = config.SERVING_MODEL_DIR)
+    parser.add_argument('--num-workers', type = int, default = None)
+    parser.add_argument('--batch-size', type = int, default = config.BATCH_SCORING_BATCH_SIZE)
+    args = parser.parse_args()
+
+    shard_paths = sorted(path for pattern in args.patterns for path in glob.glob(pattern))
+    num_rows, seconds = score_shards(shard_paths, args.output_dir, args.model_dir,
+                                    args.num_workers, args.batch_size)
+    print("scored {} rows in {:.1f}s, {:.0f} rows/sec".format(num_rows, seconds, num_rows / seconds))
@@ -0,0 +1,88 @@
+#python3.8.4
+#./venv/bin/python
+"""
+One-time conversion of the complaints csv into a partitioned parquet dataset,
+and the memory mapped loader every entry point uses to read it back.
+Categorical columns are stored dictionary encoded, so reading them back
+neither re-tokenizes the csv nor materializes one python string per row.
+"""
+
+# %%
+import os
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from consumer_complaint.config import config
+
+
+# %%
+def csv_to_parquet_writer(file_path, parquet_dir_path = config.PARQUET_DIR_PATH,
+                        rows_per_partition = config.PARQUET_ROWS_PER_PARTITION,
+                        block_bytes = config.PARQUET_CSV_BLOCK_BYTES):
+    """
+    Convert the csv into numbered parquet part files with dictionary encoded
+    categorical columns. The csv is streamed block by block, so only about
+    block_bytes of it are in memory at a time. Returns the list of part file paths.
+    """
+    column_types = {column: pa.dictionary(pa.int32(), pa.string())
+                    for column in config.CATEGORICAL_COLUMNS}
+    reader = pa_csv.open_csv(
+        file_path,
+        read_options = pa_csv.ReadOptions(block_size = block_bytes),
+        parse_options = pa_csv.ParseOptions(newlines_in_values = True),
+        convert_options = pa_csv.ConvertOptions(column_types = column_types,
+                                                strings_can_be_null = True))
+
+    os.makedirs(parquet_dir_path, exist_ok = True)
+    part_paths = []
+    writer, part_rows = None, 0
+    for batch in reader:
+        table = pa.Table.from_batches([batch])
+        start = 0
+        #a block can end one part file and start the next
+        while start < table.num_rows:
+            if writer is None:
+                part_paths.append(os.path.join(parquet_dir_path,
+                                            config.PARQUET_PART_NAME.format(len(part_paths))))
+                writer = pq.ParquetWriter(part_paths[-1], reader.schema,
+                                        use_dictionary = True, compression = 'snappy')
+            part = table.slice(start, rows_per_partition - part_rows)
+            writer.write_table(part)
+            start += part.num_rows
+            part_rows += part.num_rows
+            if part_rows == rows_per_partition:
+                writer.close()
+                writer, part_rows = None, 0
+    if writer is not None:
+        writer.close()
+    if not part_paths:
+        #a csv without rows still gets one, empty, part file
+        part_paths.append(os.path.join(parquet_dir_path, config.PARQUET_PART_NAME.format(0)))
+        pq.write_table(reader.schema.empty_table(), part_paths[-1],
+                        use_dictionary = True, compression = 'snappy')
+    return part_paths
+
+
+# %%
+def read_parquet_table(parquet_dir_path = config.PARQUET_DIR_PATH, columns = None):
+    """
+    Memory map the parquet dataset and read only the requested columns,
+    e.g. skip consumer_complaint_narrative for purely categorical passes.
+    """
+    read_dictionary = [column for column in config.CATEGORICAL_COLUMNS
+                        if columns is None or column in columns]
+    return pq.read_table(parquet_dir_path, columns = columns, memory_map = True,
+                        read_dictionary = read_dictionary)
+
+
+def read_parquet_df(parquet_dir_path = config.PARQUET_DIR_PATH, columns = None):
+    """read_parquet_table as a pandas DataFrame, categorical columns stay categorical"""
+    return read_parquet_table(parquet_dir_path, columns).to_pandas()
+
+
+# %%
+if __name__ == '__main__':
+    csv_to_parquet_writer(file_path = config.DATA_FILE_PATH)
+
+# %%
+    categorical_df = read_parquet_df(columns = config.CATEGORICAL_COLUMNS)
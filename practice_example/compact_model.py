@@ -0,0 +1,296 @@
+"""Compact model for CPU serving, distilled from the full model.
+
+The full model runs the Universal Sentence Encoder on every prediction. The
+compact model keeps its wide part and replaces the encoder with a hashed
+n-gram embedding and a small dense stack. It is trained by the Trainer with
+custom_config["compact_model"] set, against both the labels and the
+predictions of the full model passed in as the Trainer's base_model.
+
+Besides the signatures of the full model, the exported SavedModel has a
+signature taking the transformed features, config.COMPACT_SIGNATURE_NAME.
+The same function is converted to a TFLite model with int8 or float16
+weights, written next to the SavedModel as config.COMPACT_TFLITE_FILE_NAME.
+"""
+
+import os
+
+from absl import logging
+
+import tensorflow as tf
+
+from consumer_complaint.config import config
+from practice_example.features import (
+    TEXT_FEATURES,
+    transformed_name,
+    wide_inputs,
+)
+
+
+QUANTIZATIONS = ("int8", "float16")
+
+
+class HashedNgramEmbedding(tf.keras.layers.Layer):
+    """Mean of the embeddings of the hashed word n-grams of a text.
+
+    Every n-gram up to ngram_width words is hashed into one of num_buckets
+    rows, so there is no vocabulary to build or to ship with the model.
+    """
+
+    def __init__(
+        self,
+        num_buckets=config.COMPACT_NGRAM_BUCKETS,
+        embedding_dim=config.COMPACT_EMBEDDING_DIM,
+        ngram_width=config.COMPACT_NGRAM_WIDTH,
+        **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.num_buckets = num_buckets
+        self.embedding_dim = embedding_dim
+        self.ngram_width = ngram_width
+
+    def build(self, input_shape):
+        self.embeddings = self.add_weight(
+            name="embeddings",
+            shape=(self.num_buckets, self.embedding_dim),
+            initializer="uniform",
+        )
+        super().build(input_shape)
+
+    def call(self, texts):
+        words = tf.strings.split(tf.strings.lower(texts))
+        ngrams = tf.strings.ngrams(
+            words, ngram_width=list(range(1, self.ngram_width + 1))
+        )
+        ngram_ids = tf.strings.to_hash_bucket_fast(ngrams, self.num_buckets)
+        vectors = tf.ragged.map_flat_values(
+            tf.gather, self.embeddings, ngram_ids
+        )
+        # empty texts get the zero vector instead of a division by zero
+        counts = tf.maximum(tf.cast(ngram_ids.row_lengths(), tf.float32), 1.0)
+        return tf.reduce_sum(vectors, axis=1) / counts[:, None]
+
+    def get_config(self):
+        return {
+            **super().get_config(),
+            "num_buckets": self.num_buckets,
+            "embedding_dim": self.embedding_dim,
+            "ngram_width": self.ngram_width,
+        }
+
+
+def get_compact_model(
+    show_summary: bool = True,
+    num_buckets: int = config.COMPACT_NGRAM_BUCKETS,
+    embedding_dim: int = config.COMPACT_EMBEDDING_DIM,
+    ngram_width: int = config.COMPACT_NGRAM_WIDTH,
+    feature_config: dict = None,
+) -> tf.keras.models.Model:
+    """The student model, same inputs and output as module.get_model."""
+    input_features, wide = wide_inputs(16, feature_config)
+
+    input_texts = [
+        tf.keras.Input(shape=(1,), name=transformed_name(key), dtype=tf.string)
+        for key in TEXT_FEATURES.keys()
+    ]
+
+    reshaped_narrative = tf.reshape(input_texts[0], [-1])
+    deep = HashedNgramEmbedding(num_buckets, embedding_dim, ngram_width)(
+        reshaped_narrative
+    )
+    deep = tf.keras.layers.Dense(32, activation="relu")(deep)
+    deep = tf.keras.layers.Dense(16, activation="relu")(deep)
+
+    both = tf.keras.layers.concatenate([deep, wide])
+
+    output = tf.keras.layers.Dense(1, activation="sigmoid")(both)
+
+    keras_model = tf.keras.models.Model(input_features + input_texts, output)
+    if show_summary:
+        keras_model.summary()
+
+    return keras_model
+
+
+class Distiller(tf.keras.Model):
+    """Trains the student on the labels and on the teacher's predictions.
+
+    The loss is alpha * crossentropy(labels) + (1 - alpha) *
+    crossentropy(teacher predictions). Without a teacher it is trained on
+    the labels only. Metrics and the validation loss are computed against
+    the labels.
+    """
+
+    def __init__(
+        self, student, teacher=None, alpha=config.COMPACT_DISTILLATION_ALPHA
+    ):
+        super().__init__()
+        self.student = student
+        self.teacher = teacher
+        self.alpha = alpha if teacher is not None else 1.0
+        self._crossentropy = tf.keras.losses.BinaryCrossentropy(
+            reduction=tf.keras.losses.Reduction.NONE
+        )
+
+    def call(self, inputs, training=False):
+        return self.student(inputs, training=training)
+
+    def _labels_loss(self, labels, predictions):
+        return tf.nn.compute_average_loss(
+            self._crossentropy(labels, predictions)
+        )
+
+    def train_step(self, data):
+        features, labels = data
+        labels = tf.reshape(tf.cast(labels, tf.float32), [-1, 1])
+        if self.teacher is not None:
+            teacher_predictions = self.teacher(features, training=False)
+
+        with tf.GradientTape() as tape:
+            predictions = self.student(features, training=True)
+            labels_loss = self._labels_loss(labels, predictions)
+            loss = self.alpha * labels_loss
+            if self.teacher is not None:
+                distillation_loss = self._labels_loss(
+                    teacher_predictions, predictions
+                )
+                loss += (1 - self.alpha) * distillation_loss
+        gradients = tape.gradient(loss, self.student.trainable_variables)
+        self.optimizer.apply_gradients(
+            zip(gradients, self.student.trainable_variables)
+        )
+
+        self.compiled_metrics.update_state(labels, predictions)
+        results = {metric.name: metric.result() for metric in self.metrics}
+        results.update({"loss": loss, "labels_loss": labels_loss})
+        if self.teacher is not None:
+            results["distillation_loss"] = distillation_loss
+        return results
+
+    def test_step(self, data):
+        features, labels = data
+        labels = tf.reshape(tf.cast(labels, tf.float32), [-1, 1])
+        predictions = self.student(features, training=False)
+        self.compiled_metrics.update_state(labels, predictions)
+        results = {metric.name: metric.result() for metric in self.metrics}
+        results["loss"] = self._labels_loss(labels, predictions)
+        return results
+
+
+def load_teacher(base_model):
+    """The full model exported by the Trainer, or None without base_model."""
+    if not base_model:
+        logging.warning(
+            "No base_model to distill from, the compact model is trained "
+            "on the labels only"
+        )
+        return None
+    import tensorflow_hub as hub
+
+    teacher = tf.keras.models.load_model(
+        base_model, custom_objects={"KerasLayer": hub.KerasLayer}
+    )
+    teacher.trainable = False
+    return teacher
+
+
+def get_distiller(
+    base_model=None, custom_config=None, feature_config=None, show_summary=True
+):
+    """A compiled Distiller of a new student and the teacher at base_model.
+
+    custom_config may override the n-gram buckets, embedding dim, n-gram
+    width and alpha as "compact_ngram_buckets", "compact_embedding_dim",
+    "compact_ngram_width" and "compact_distillation_alpha". feature_config
+    is the one of the transform graph, see features.wide_inputs.
+    """
+    custom_config = custom_config or {}
+    student = get_compact_model(
+        show_summary=show_summary,
+        num_buckets=custom_config.get(
+            "compact_ngram_buckets", config.COMPACT_NGRAM_BUCKETS
+        ),
+        embedding_dim=custom_config.get(
+            "compact_embedding_dim", config.COMPACT_EMBEDDING_DIM
+        ),
+        ngram_width=custom_config.get(
+            "compact_ngram_width", config.COMPACT_NGRAM_WIDTH
+        ),
+        feature_config=feature_config,
+    )
+    distiller = Distiller(
+        student,
+        load_teacher(base_model),
+        alpha=custom_config.get(
+            "compact_distillation_alpha", config.COMPACT_DISTILLATION_ALPHA
+        ),
+    )
+    distiller.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=0.001),
+        metrics=[
+            tf.keras.metrics.BinaryAccuracy(),
+            tf.keras.metrics.TruePositives(),
+            tf.keras.metrics.AUC(),
+        ],
+    )
+    return distiller
+
+
+def transformed_input_specs(model):
+    """Named TensorSpecs of the model's inputs, the transformed features."""
+    return {
+        name: tf.TensorSpec(shape=tensor.shape, dtype=tensor.dtype, name=name)
+        for name, tensor in zip(model.input_names, model.inputs)
+    }
+
+
+def transformed_signature(model):
+    """Concrete function running the model on the transformed features."""
+
+    @tf.function
+    def serve_transformed_fn(**features):
+        """Returns the output to be used in the transformed signature."""
+        return {"outputs": model(features)}
+
+    return serve_transformed_fn.get_concrete_function(
+        **transformed_input_specs(model)
+    )
+
+
+def export_tflite(model, serving_model_dir, quantization="int8"):
+    """Writes the transformed features signature as a quantized TFLite model.
+
+    int8 quantizes the weights and runs the dense layers on int8 at
+    inference (dynamic range quantization), float16 halves the weights.
+    The string ops of the n-gram hashing run as select TensorFlow ops.
+    Returns the path of the TFLite model.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(
+            "Unknown quantization {}, choose one of {}".format(
+                quantization, QUANTIZATIONS
+            )
+        )
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [transformed_signature(model)]
+    )
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS,
+        tf.lite.OpsSet.SELECT_TF_OPS,
+    ]
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    tflite_model = converter.convert()
+
+    tflite_path = os.path.join(
+        serving_model_dir, config.COMPACT_TFLITE_FILE_NAME
+    )
+    with tf.io.gfile.GFile(tflite_path, "wb") as tflite_file:
+        tflite_file.write(tflite_model)
+    logging.info(
+        "Wrote the %s TFLite model to %s, %d bytes",
+        quantization,
+        tflite_path,
+        len(tflite_model),
+    )
+    return tflite_path
@@ -4,34 +4,30 @@
 This file serves as a practice for Chapter 3 Data Ingestion
 Make sure you change the /consumer_complaint/config/config.py
 to define your own directories and set your credentials. 
+tensorflow and tfx are imported by the functions using them, so the csv
+splitting helpers stay cheap to import, e.g. for data_validation workers.
 """
 
 # %%
 import os
-import tensorflow as tf
-import pandas as pd
-import tfx
 import csv
-import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from consumer_complaint.config import config
-from tfx.utils.dsl_utils import external_input
-from tfx.components import CsvExampleGen, ImportExampleGen
-from tfx.extensions.google_cloud_big_query.example_gen.component import BigQueryExampleGen
-from tfx.proto import example_gen_pb2
-from tfx.orchestration.experimental.interactive.interactive_context import InteractiveContext
-os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = config.GOOGLE_CREDENTIAL_PATH
 
 
 # %%
 def _bytes_feature(value):
-    if isinstance(value, type(tf.constant(0))):
+    import tensorflow as tf
+    if tf.is_tensor(value):
         value = value.numpy()
     return tf.train.Feature(bytes_list = tf.train.BytesList(value = [value]))
 
 def _float_feature(value):
+    import tensorflow as tf
     return tf.train.Feature(float_list = tf.train.FloatList(value = [value]))
 
 def _int64_feature(value):
+    import tensorflow as tf
     return tf.train.Feature(int64_list = tf.train.Int64List(value = [value]))
 
 def clean_rows(row):
@@ -47,36 +43,137 @@ def convert_zipcode_to_int(zipcode):
 
 
 # %%
-def tfrecord_data_writer(file_path):
-    tfrecord_filename = config.RECORD_FILE_PATH
-    tf_record_writer = tf.io.TFRecordWriter(tfrecord_filename)
+def _serialize_row(row):
+    """build a tf.train.Example from a csv row and serialize it"""
+    import tensorflow as tf
+    row = clean_rows(row)
+    example = tf.train.Example(features = tf.train.Features(feature = {
+        'product': _bytes_feature(row['product'].encode('utf-8')),
+        'sub_product': _bytes_feature(row['sub_product'].encode('utf-8')),
+        'issue': _bytes_feature(row['issue'].encode('utf-8')),
+        'sub_issue': _bytes_feature(row['sub_issue'].encode('utf-8')),
+        'consumer_complaint_narrative': _bytes_feature(row['consumer_complaint_narrative'].encode('utf-8')),
+        'company': _bytes_feature(row['company'].encode('utf-8')),
+        'state': _bytes_feature(row['state'].encode('utf-8')),
+        'zip_code': _int64_feature(convert_zipcode_to_int(row["zip_code"])),
+        'company_response': _bytes_feature(row['company_response'].encode('utf-8')),
+        'timely_response': _bytes_feature(row['timely_response'].encode('utf-8')),
+        'consumer_disputed': _bytes_feature(row['consumer_disputed'].encode('utf-8'))
+    }))
+    return example.SerializeToString()
+
+
+def tfrecord_data_writer(file_path, record_file_path = config.RECORD_FILE_PATH):
+    import tensorflow as tf
+    tf_record_writer = tf.io.TFRecordWriter(record_file_path)
 
     with open(file_path, encoding = 'utf-8') as csv_file:
         reader = csv.DictReader(csv_file, delimiter = ',', quotechar = '"')
         for row in reader:
-            row = clean_rows(row)
-            example = tf.train.Example(features = tf.train.Features(feature = {
-                'product': _bytes_feature(row['product'].encode('utf-8')),
-                'sub_product': _bytes_feature(row['sub_product'].encode('utf-8')),
-                'issue': _bytes_feature(row['issue'].encode('utf-8')),
-                'sub_issue': _bytes_feature(row['sub_issue'].encode('utf-8')),
-                'consumer_complaint_narrative': _bytes_feature(row['consumer_complaint_narrative'].encode('utf-8')),
-                'company': _bytes_feature(row['company'].encode('utf-8')),
-                'state': _bytes_feature(row['state'].encode('utf-8')),
-                'zip_code': _int64_feature(convert_zipcode_to_int(row["zip_code"])),
-                'company_response': _bytes_feature(row['company_response'].encode('utf-8')),
-                'timely_response': _bytes_feature(row['timely_response'].encode('utf-8')),
-                'consumer_disputed': _bytes_feature(row['consumer_disputed'].encode('utf-8'))
-            }))
-            tf_record_writer.write(example.SerializeToString())
+            tf_record_writer.write(_serialize_row(row))
         tf_record_writer.close()
 
     return tf_record_writer
 
 
+# %%
+def _csv_shard_offsets(file_path, num_shards):
+    """
+    Split the csv body into num_shards byte ranges of roughly equal size.
+    Offsets only land on a newline outside of a quoted field, so multi-line
+    narratives are never cut in half. Returns the header line and the
+    num_shards + 1 range boundaries.
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as csv_file:
+        header = csv_file.readline()
+        position = len(header)
+        offsets = [position]
+        shard_size = (file_size - position) / num_shards
+        in_quotes = False
+        for line in csv_file:
+            position += len(line)
+            #an odd number of quote characters toggles the quoting state,
+            #escaped quotes ("") always come in pairs
+            if line.count(b'"') % 2:
+                in_quotes = not in_quotes
+            if not in_quotes and position >= offsets[0] + shard_size * len(offsets):
+                offsets.append(position)
+                if len(offsets) == num_shards:
+                    break
+    #small files may run out of lines before every boundary is found
+    offsets += [file_size] * (num_shards + 1 - len(offsets))
+    return header.decode('utf-8'), offsets
+
+
+def _read_byte_range(file_path, start, end):
+    """yield the decoded lines of file_path between two record boundaries"""
+    with open(file_path, 'rb') as csv_file:
+        csv_file.seek(start)
+        position = start
+        while position < end:
+            line = csv_file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+
+def _write_tfrecord_shard(file_path, fieldnames, start, end, shard_path):
+    """encode one byte range of the csv into a gzip compressed tfrecord shard"""
+    import tensorflow as tf
+    options = tf.io.TFRecordOptions(compression_type = 'GZIP')
+    num_records = 0
+    with tf.io.TFRecordWriter(shard_path, options = options) as tf_record_writer:
+        reader = csv.DictReader(_read_byte_range(file_path, start, end),
+                                fieldnames = fieldnames,
+                                delimiter = ',', quotechar = '"')
+        for row in reader:
+            tf_record_writer.write(_serialize_row(row))
+            num_records += 1
+    return num_records
+
+
+def sharded_tfrecord_data_writer(file_path, num_shards = None, num_workers = None,
+                                record_dir_path = config.RECORD_SHARDS_DIR_PATH):
+    """
+    Parallel replacement for tfrecord_data_writer. The csv is split by byte
+    range and every range is encoded into its own gzip compressed shard
+    in a process pool, so later readers can also consume the shards in parallel.
+    Returns the list of shard paths.
+    """
+    num_shards = num_shards or os.cpu_count()
+    os.makedirs(record_dir_path, exist_ok = True)
+    header, offsets = _csv_shard_offsets(file_path, num_shards)
+    fieldnames = next(csv.reader([header]))
+    shard_paths = [os.path.join(record_dir_path, config.RECORD_SHARD_NAME.format(index, num_shards))
+                    for index in range(num_shards)]
+
+    with ProcessPoolExecutor(max_workers = num_workers or num_shards) as executor:
+        futures = [executor.submit(_write_tfrecord_shard, file_path, fieldnames,
+                                    offsets[index], offsets[index + 1], shard_path)
+                    for index, shard_path in enumerate(shard_paths)]
+        for future in futures:
+            future.result()
+
+    return shard_paths
+
+
+def sharded_import_example_gen(record_dir_path = config.RECORD_SHARDS_DIR_PATH):
+    """ImportExampleGen over the gzip shards written by sharded_tfrecord_data_writer"""
+    from tfx.components import ImportExampleGen
+    from tfx.proto import example_gen_pb2
+    input_config = example_gen_pb2.Input(splits = [
+        example_gen_pb2.Input.Split(name = 'single_split', pattern = config.RECORD_SHARD_PATTERN)
+    ])
+    return ImportExampleGen(input_base = record_dir_path, input_config = input_config)
+
+
 # %%
 def data_split(file_path):
     """splitting data before feeding into CsvExampleGen"""
+    from tfx.components import CsvExampleGen
+    from tfx.proto import example_gen_pb2
     output_config = example_gen_pb2.Output(
         split_config = example_gen_pb2.SplitConfig(splits = [
             example_gen_pb2.SplitConfig.Split(name = 'train', hash_buckets = 6),
@@ -90,6 +187,8 @@ def data_split(file_path):
 # %%
 def existing_data_split(file_path):
     """preserving existing data splits with existing subdirectories"""
+    from tfx.components import CsvExampleGen
+    from tfx.proto import example_gen_pb2
     input_config = example_gen_pb2.Input(splits = [
         example_gen_pb2.Input.Split(name = 'train', pattern = 'train/*'),
         example_gen_pb2.Input.Split(name = 'eval', pattern = 'eval/*'),
@@ -100,10 +199,16 @@ def existing_data_split(file_path):
 
 
 # %%
-def span_data_split(file_path):
-    """data split with span(data snapshot that can replicate existing data records"""
+def span_data_split(file_path, with_version = False):
+    """
+    data split with span(data snapshot that can replicate existing data records
+    only the latest span (and latest version within it) gets ingested
+    """
+    from tfx.components import CsvExampleGen
+    from tfx.proto import example_gen_pb2
+    pattern = config.SPAN_VERSION_INPUT_PATTERN if with_version else config.SPAN_INPUT_PATTERN
     input_config = example_gen_pb2.Input(splits = [
-        example_gen_pb2.Input.Split(pattern = 'export-{SPAN}/*')
+        example_gen_pb2.Input.Split(name = 'single_split', pattern = pattern)
     ])
     span_example = CsvExampleGen(input_base = file_path, input_config = input_config)
     return span_example
@@ -112,6 +217,9 @@ def span_data_split(file_path):
 # %%
 
 if __name__ == '__main__':
+    import pandas as pd
+    from tfx.components import CsvExampleGen, ImportExampleGen
+    from tfx.orchestration.experimental.interactive.interactive_context import InteractiveContext
     context = InteractiveContext(pipeline_root=config.PIPELINE_ROOT)
     
 # %%
@@ -122,6 +230,12 @@ if __name__ == '__main__':
     complaint_tfrecord = tfrecord_data_writer(file_path = config.DATA_FILE_PATH)
     example_gen = ImportExampleGen(input_base = config.RECORD_DIR_PATH)
     context.run(example_gen)
+
+# %%
+    #ImportExampleGen with sharded, gzip compressed TFRecords
+    complaint_shards = sharded_tfrecord_data_writer(file_path = config.DATA_FILE_PATH)
+    sharded_example_gen = sharded_import_example_gen()
+    context.run(sharded_example_gen)
     
 
 # %%
@@ -155,6 +269,8 @@ if __name__ == '__main__':
     FROM `consumer-complaint-310721.consumer_complaint.consumer_complaint_data` 
     LIMIT 100
     """
+    from tfx.extensions.google_cloud_big_query.example_gen.component import BigQueryExampleGen
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = config.GOOGLE_CREDENTIAL_PATH
     bigquery_example_gen = BigQueryExampleGen(query = query)
     context.run(bigquery_example_gen, beam_pipeline_args=["--project={}".format(config.GCP_PROJECT_ID), 
                                                         "--temp_location={}".format(config.TEMP_GCS_LOCATION)])
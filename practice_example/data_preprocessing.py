@@ -1,130 +1,136 @@
 #python3.8.4
 #./venv/bin/python
+"""
+tf.Transform outside of the pipeline, over the tfrecord shards written by
+data_ingestion.sharded_tfrecord_data_writer. Every file pattern is one span,
+analyzed as its own dataset with an analyzer cache keyed by the fingerprint
+of its files (path, size and modification time), so a span that has not
+changed since an earlier run is not read again, only its cached analyzer
+results are combined with those of the new spans.
+
+    python -m practice_example.data_preprocessing 'export-1/*.gz' 'export-2/*.gz'
+"""
 
 # %%
+import argparse
+import functools
+import hashlib
+import os
+import json
+import tempfile
+import time
+import apache_beam as beam
 import tensorflow as tf
-import tensorflow_transform as tft
-import tempfile 
-import tensorflow_transform.beam.impl as tft_beam
-from tensorflow_transform.tf_metadata import dataset_metadata
+import tensorflow_transform.beam as tft_beam
+from tensorflow_transform.beam import analysis_graph_builder, analyzer_cache
 from tensorflow_transform.tf_metadata import schema_utils
+from tfx_bsl.public import tfxio
+from tfx_bsl.tfxio import tensor_adapter
+from consumer_complaint.config import config
+from practice_example.data_validation import file_fingerprint
+#the feature spec and preprocessing_fn are shared with module.py,
+#ONE_HOT_FEATURES maps feature name to most values kept, the sizes derived
+#from the statistics by feature_config.py are passed in as feature_config
+#and BUCKET_FEATURES maps feature name to bucket count
+from practice_example.features import (
+    LABEL_KEY,
+    ONE_HOT_FEATURES,
+    BUCKET_FEATURES,
+    TEXT_FEATURES,
+    TRANSFORM_ANALYZERS,
+    FEATURE_CONFIG_FILE_NAME,
+    preprocessing_fn
+)
 
 
 # %%
-LABEL_KEY = 'consumer_disputed'
-
-#feature name, feature dimensionality
-#how do you calculate this dimensionality?
-ONE_HOT_FEATURES = {
-    'product': 11,
-    'sub_product': 45,
-    'company_response': 5,
-    'state': 60,
-    'issue': 90
-}
-
-#feature name, bucket count
-BUCKET_FEATURES = {
-    'zip_code': 10
-}
-
-TEXT_FEATURES = {
-    'consumer_complaint_narrative': None
-}
-
-# %%
-def transformed_name(key):
-    return key + '_xf'
-
-
-# %%
-def fill_in_missing(x):
-    """Replace missing values in a SparseTensor.
-
-    Fills in missing values of `x` with '' or 0, and converts to a
-    dense tensor.
-
-    Args:
-      x: A `SparseTensor` of rank 2.  Its dense shape should have
-        size at most 1 in the second dimension.
-        
-    Returns:
-      A rank 1 tensor where missing values of `x` have been filled in.
+def raw_feature_spec():
     """
-    default_value = "" if x.dtype == tf.string else 0
-
-    if type(x) == tf.SparseTensor:
-        x = tf.sparse.to_dense(
-            tf.SparseTensor(x.indices, x.values, [x.dense_shape[0], 1]),
-            default_value
-        )
-    return tf.squeeze(x, axis = 1)
-
-
-# %%
-def convert_num_to_one_hot(label_tensor, num_labels = 2):
-    one_hot_tensor = tf.one_hot(label_tensor, num_labels)
-    return tf.reshape(one_hot_tensor, [-1, num_labels])
-
-
-# %%
-def convert_zip_code(zip_code):
-    if zip_code =='':
-        zip_code = '00000'
-    zip_code = tf.strings.regex_replace(zip_code, r'X{0, 5}', "0")
-    zip_code = tf.strings.to_number(zip_code, out_type = tf.float32)
-    return zip_code
-
-
-# %%
-def preprocessing_fn(inputs: tf.Tensor) -> tf.Tensor:
-    """tf.transform's callback function for preprocessing inputs.
-
-    Args:
-      inputs: map from feature keys to raw not-yet-transformed features.
-
-    Returns:
-      Map from string feature key to transformed feature operations.
+    the records of data_ingestion._serialize_row, every column is bytes
+    but zip_code, which is int64
     """
-    outputs = {}
+    feature_spec = {key: tf.io.VarLenFeature(tf.string)
+                    for key in [*ONE_HOT_FEATURES, *TEXT_FEATURES, LABEL_KEY]}
+    feature_spec.update({key: tf.io.VarLenFeature(tf.int64) for key in BUCKET_FEATURES})
+    return feature_spec
 
-    for key in ONE_HOT_FEATURES.keys():
-        dim = ONE_HOT_FEATURES[key] 
-        #calling the fill_in_missing function
-        int_value = tft.compute_and_apply_vocabulary(
-            fill_in_missing(inputs[key]), top_k = dim + 1
-        )
-        outputs[transformed_name(key)] = convert_num_to_one_hot(
-            int_value, num_labels = dim + 1
-        )
 
-    for key, bucket_count in BUCKET_FEATURES.items():
-        dense_feature = fill_in_missing(inputs[key])
-        if key == 'zip_code' and dense_feature.dtype == tf.string:
-            dense_feature = convert_zip_code(dense_feature)
-        else:
-            dense_feature = tf.cast(dense_feature, tf.float32)
+def span_dataset_key(file_pattern):
+    """analyzer cache key of a span, changes with any of its files"""
+    fingerprint = json.dumps(file_fingerprint(file_pattern))
+    return analyzer_cache.DatasetKey(
+        'span-' + hashlib.blake2b(fingerprint.encode('utf-8'), digest_size = 16).hexdigest())
 
-        temp_feature = tft.bucketize(dense_feature, bucket_count,
-                                always_return_num_quantiles= False)
-        outputs[transformed_name(key)] = convert_num_to_one_hot(
-            temp_feature, num_labels = bucket_count + 1
-        )
-    
-    for key in TEXT_FEATURES.keys():
-        #it's probably clearer to separate function from dict key
-        outputs[transformed_name(key)] = fill_in_missing(inputs[key])
 
-    outputs[transformed_name(LABEL_KEY)] = fill_in_missing(inputs[LABEL_KEY])
+def analyze(file_patterns, output_dir = config.TRANSFORM_OUTPUT_DIR_PATH,
+            cache_dir = config.ANALYZER_CACHE_DIR_PATH, beam_args = None, feature_config = None):
+    """
+    run the analyzers of preprocessing_fn over the spans in file_patterns and
+    write the transform graph to output_dir, with the feature config next to
+    it like FeatureConfigTransform does. Without cache_dir every span is read.
+    Returns the number of spans that were read.
+    """
+    feature_config = feature_config or {}
+    span_preprocessing_fn = functools.partial(preprocessing_fn, feature_config = feature_config)
+    schema = schema_utils.schema_from_feature_spec(raw_feature_spec())
+    spans = {span_dataset_key(file_pattern): tfxio.TFExampleRecord(
+                file_pattern, schema = schema, telemetry_descriptors = ['consumer_complaint'])
+            for file_pattern in file_patterns}
+    tensor_adapter_config = next(iter(spans.values())).TensorAdapterConfig()
+
+    with beam.Pipeline(argv = beam_args) as pipeline:
+        with tft_beam.Context(temp_dir = tempfile.mkdtemp()):
+            input_cache = {}
+            read_keys = list(spans)
+            if cache_dir:
+                input_cache = pipeline | 'ReadCache' >> analyzer_cache.ReadAnalysisCacheFromFS(
+                    cache_dir, list(spans))
+                #spans whose analyzer results are all cached are not read
+                read_keys = analysis_graph_builder.get_analysis_dataset_keys(
+                    span_preprocessing_fn,
+                    tensor_adapter.TensorAdapter(tensor_adapter_config).OriginalTypeSpecs(),
+                    list(spans), input_cache, force_tf_compat_v1 = True)
+            datasets = {}
+            for index, (dataset_key, span) in enumerate(spans.items()):
+                if dataset_key in read_keys:
+                    datasets[dataset_key] = pipeline | 'ReadSpan{}'.format(index) >> span.BeamSource()
+                else:
+                    datasets[dataset_key] = pipeline | 'SkipSpan{}'.format(index) >> beam.Create([])
+
+            transform_fn, output_cache = (
+                (datasets, input_cache, tensor_adapter_config)
+                | 'Analyze' >> tft_beam.AnalyzeDatasetWithCache(span_preprocessing_fn, pipeline = pipeline))
+            _ = transform_fn | 'WriteTransformFn' >> tft_beam.WriteTransformFn(output_dir)
+            if cache_dir:
+                _ = output_cache | 'WriteCache' >> analyzer_cache.WriteAnalysisCacheToFS(
+                    pipeline, cache_dir, dataset_keys = list(spans))
+    with tf.io.gfile.GFile(os.path.join(output_dir, FEATURE_CONFIG_FILE_NAME), 'w') as feature_config_file:
+        json.dump(feature_config, feature_config_file, indent = 2)
+    return len(read_keys)
 
-    return outputs
 
 # %%
 if __name__ == '__main__':
-    pass
-
-
-
-
-
-
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file_patterns', nargs = '+', help = 'tfrecord shards, one pattern per span')
+    parser.add_argument('--output-dir', default = config.TRANSFORM_OUTPUT_DIR_PATH)
+    parser.add_argument('--cache-dir', default = config.ANALYZER_CACHE_DIR_PATH,
+                        help = "analyzer cache, '' to analyze every span")
+    parser.add_argument('--feature-config', help = 'written by practice_example.feature_config, '
+                        'without it the sizes of config.py are used')
+    args, beam_args = parser.parse_known_args()
+    feature_config = None
+    if args.feature_config:
+        with open(args.feature_config) as feature_config_file:
+            feature_config = json.load(feature_config_file)
+
+    start = time.perf_counter()
+    num_read = analyze(args.file_patterns, args.output_dir, args.cache_dir, beam_args, feature_config)
+    #the last line is read by benchmarks/transform_benchmark.py
+    print(json.dumps({
+        'transform_analyzers': TRANSFORM_ANALYZERS,
+        'spans': len(args.file_patterns),
+        'spans_read': num_read,
+        'seconds': time.perf_counter() - start,
+    }))
@@ -4,45 +4,262 @@
 # %%
 import pandas as pd
 import os
+import csv
+import glob
+import hashlib
+import io
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from tensorflow_metadata.proto.v0 import statistics_pb2
 from consumer_complaint.config import config
-import tensorflow_data_validation as tfdv 
-from sklearn.model_selection import train_test_split
-from tfx.orchestration import pipeline
-from tfx.components import CsvExampleGen, \
-                            StatisticsGen, \
-                            SchemaGen, \
-                            ExampleValidator
-from tfx.orchestration.experimental.interactive.interactive_context import InteractiveContext
+from practice_example import columnar_data, data_ingestion
+from practice_example.features import TEXT_FEATURES
+#tensorflow, tfdv, beam and sklearn are imported by the functions using them
 
 
 # %%
-def csv_statistics_generator(file_path):
+def file_fingerprint(file_pattern):
+    """path, size and modification time of every file matching the pattern"""
+    return [(os.path.abspath(path), os.path.getsize(path), os.stat(path).st_mtime_ns)
+            for path in sorted(glob.glob(file_pattern))]
+
+
+def _cache_path(cache_dir, file_path, options):
+    """statistics are cached per input files and statistics options"""
+    if cache_dir is None:
+        return None
+    key = json.dumps({'files': file_fingerprint(file_path), 'options': options}, sort_keys = True)
+    return os.path.join(cache_dir, hashlib.blake2b(key.encode('utf-8'), digest_size = 16).hexdigest() + '.stats')
+
+
+def _load_cached(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    with open(cache_path, 'rb') as stats_file:
+        return statistics_pb2.DatasetFeatureStatisticsList.FromString(stats_file.read())
+
+
+def _save_cached(stats, cache_path):
+    if cache_path is None:
+        return
+    os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+    with open(cache_path + '.tmp', 'wb') as stats_file:
+        stats_file.write(stats.SerializeToString())
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def _statistics_options(sample_rate = None, seed = 0, feature_allowlist = None,
+                        feature_denylist = None, length_only_features = None):
+    return {'sample_rate': sample_rate, 'seed': seed,
+            'feature_allowlist': sorted(feature_allowlist) if feature_allowlist is not None else None,
+            'feature_denylist': sorted(feature_denylist or []),
+            'length_only_features': sorted(length_only_features or [])}
+
+
+def _selected_features(features, options):
+    return [feature for feature in features
+            if (options['feature_allowlist'] is None or feature in options['feature_allowlist'])
+            and feature not in options['feature_denylist']]
+
+
+def _merge_shard_statistics(shard_stats):
+    """
+    merge per shard statistics with the span merge of incremental_statistics.
+    Counts, means and standard deviations are exact. Top values and the rank
+    histogram are approximate: every shard only keeps its own top k, so a value
+    that misses the top k of some shards is undercounted or left out, and
+    unique is a lower bound. Numeric histograms and medians come from a single
+    shard. The schema inferred from these statistics and the skew and drift
+    checks on categorical features see the approximate top values.
+    """
+    from practice_example import incremental_statistics
+
+    merged = statistics_pb2.DatasetFeatureStatisticsList()
+    for stats in shard_stats:
+        if stats is not None:
+            incremental_statistics.merge_statistics(
+                merged, statistics_pb2.DatasetFeatureStatisticsList.FromString(stats))
+    return merged
+
+
+# %%
+def _csv_columns(file_path):
+    with open(file_path, encoding = 'utf-8') as csv_file:
+        return next(csv.reader(csv_file))
+
+
+def _csv_shard_statistics(file_path, start, end, columns, selected, dtypes, options, seed):
+    """statistics of one byte range of the csv, serialized for the process pool"""
+    import tensorflow_data_validation as tfdv
+
+    if start >= end:
+        return None
+    data = pd.read_csv(io.StringIO(''.join(data_ingestion._read_byte_range(file_path, start, end))),
+                        header = None, names = columns, usecols = selected, dtype = dtypes)
+    if options['sample_rate']:
+        data = data.sample(frac = options['sample_rate'], random_state = seed)
+    if data.empty:
+        return None
+    for feature in options['length_only_features']:
+        if feature in data:
+            data[feature + '_length'] = data.pop(feature).str.len()
+    return tfdv.generate_statistics_from_dataframe(data).SerializeToString()
+
+
+def _csv_shard_tasks(file_path, num_shards, options):
+    columns = _csv_columns(file_path)
+    selected = _selected_features(columns, options)
+    #text columns are read as text in every shard, whatever a shard looks like
+    head = pd.read_csv(file_path, encoding = 'utf-8', usecols = selected, nrows = 10000)
+    dtypes = {column: str for column in selected if head[column].dtype == object}
+    _, offsets = data_ingestion._csv_shard_offsets(file_path, num_shards)
+    return [(file_path, offsets[index], offsets[index + 1], columns, selected, dtypes, options,
+            options['seed'] + index)
+            for index in range(num_shards)]
+
+
+def split_statistics_generator(file_paths, num_shards = None, num_workers = None, cache_dir = None,
+                            **statistics_options):
+    """
+    Statistics of several csv files, e.g. {'train': ..., 'val': ...}, in one
+    pass: the byte range shards of all files share one process pool and are
+    merged per file. Files with cached statistics are not read at all.
+    With more than one shard the top values, unique counts, histograms and
+    medians are approximate, see _merge_shard_statistics.
+    statistics_options: sample_rate, seed, feature_allowlist, feature_denylist
+    and length_only_features (text features replaced by <feature>_length).
+    Returns {name: DatasetFeatureStatisticsList}
+    """
+    options = _statistics_options(**statistics_options)
+    num_shards = num_shards or os.cpu_count()
+    cache_paths = {name: _cache_path(cache_dir, file_path, options)
+                    for name, file_path in file_paths.items()}
+    stats = {name: _load_cached(cache_path) for name, cache_path in cache_paths.items()}
+    pending = {name: file_paths[name] for name, cached in stats.items() if cached is None}
+    if not pending:
+        return stats
+
+    #tfdv and tensorflow are not fork safe, workers start from a fresh interpreter
+    with ProcessPoolExecutor(max_workers = num_workers or num_shards,
+                            mp_context = multiprocessing.get_context('spawn')) as executor:
+        futures = {name: [executor.submit(_csv_shard_statistics, *task)
+                        for task in _csv_shard_tasks(file_path, num_shards, options)]
+                    for name, file_path in pending.items()}
+        for name, shard_futures in futures.items():
+            stats[name] = _merge_shard_statistics([future.result() for future in shard_futures])
+            _save_cached(stats[name], cache_paths[name])
+    return stats
+
+
+def csv_statistics_generator(file_path, data_format = 'csv', columns = None, num_shards = None,
+                            cache_dir = None, **statistics_options):
     """
     Generate statistics for the csv dataset
+    With data_format = 'parquet', file_path is the parquet dataset directory
+    and only the given columns are read
+    With num_shards or length_only_features, the csv is computed in byte range
+    shards, see split_statistics_generator. statistics_options also apply to
+    the single tfdv run otherwise, and the result is cached in cache_dir.
     """
-    csv_stats = tfdv.generate_statistics_from_csv(data_location = file_path,
-                                                delimiter=',')
+    import tensorflow_data_validation as tfdv
+
+    if data_format != 'parquet' and (num_shards or statistics_options.get('length_only_features')):
+        csv_stats = split_statistics_generator({'data': file_path}, num_shards = num_shards,
+                                            cache_dir = cache_dir, **statistics_options)['data']
+    else:
+        options = _statistics_options(**statistics_options)
+        cache_path = _cache_path(cache_dir, file_path, {**options, 'columns': columns})
+        csv_stats = _load_cached(cache_path)
+        if csv_stats is None:
+            if data_format == 'parquet':
+                data = columnar_data.read_parquet_df(file_path, columns = columns)
+                #tfdv expects plain string columns rather than pandas categoricals
+                data = data.astype({column: object for column in data.columns
+                                    if column in config.CATEGORICAL_COLUMNS})
+                data = data[_selected_features(data.columns, options)]
+                csv_stats = tfdv.generate_statistics_from_dataframe(
+                    data, stats_options = tfdv.StatsOptions(sample_rate = options['sample_rate']))
+            else:
+                stats_options = tfdv.StatsOptions(
+                    sample_rate = options['sample_rate'],
+                    feature_allowlist = _selected_features(_csv_columns(file_path), options))
+                csv_stats = tfdv.generate_statistics_from_csv(data_location = file_path,
+                                                            delimiter=',',
+                                                            stats_options = stats_options)
+            _save_cached(csv_stats, cache_path)
     csv_schema = tfdv.infer_schema(csv_stats)
     tfdv.display_schema(csv_schema)
     return csv_stats, csv_schema
 
 
 # %%
-def tfrecord_statis_generator(file_path):
+def _tfrecord_features(file_path):
+    """feature names of the first example"""
+    import tensorflow as tf
+
+    compression_type = 'GZIP' if file_path.endswith('.gz') else ''
+    for record in tf.data.TFRecordDataset(file_path, compression_type = compression_type).take(1):
+        return list(tf.train.Example.FromString(record.numpy()).features.feature)
+    return []
+
+
+def _tfrecord_file_statistics(file_path, stats_options):
+    import tensorflow_data_validation as tfdv
+    from apache_beam.options.pipeline_options import PipelineOptions
+
+    pipeline_options = PipelineOptions(['--direct_running_mode=in_memory'])
+    return tfdv.generate_statistics_from_tfrecord(data_location = file_path,
+                                                stats_options = stats_options,
+                                                pipeline_options = pipeline_options).SerializeToString()
+
+
+def tfrecord_statis_generator(file_path, num_workers = None, cache_dir = None, **statistics_options):
     """
     Generate statistics for the tfrecord dataset
+    A file pattern matching several shards is computed one shard per worker
+    process and merged, with approximate top values, histograms and medians,
+    see _merge_shard_statistics. The result is cached in cache_dir.
     """
-    tfrecord_stats = tfdv.generate_statistics_from_tfrecord(data_location = file_path)
+    import tensorflow_data_validation as tfdv
+
+    options = _statistics_options(**statistics_options)
+    if options['length_only_features']:
+        raise ValueError("length_only_features needs csv input")
+    cache_path = _cache_path(cache_dir, file_path, options)
+    tfrecord_stats = _load_cached(cache_path)
+    if tfrecord_stats is None:
+        shard_paths = sorted(glob.glob(file_path))
+        if not shard_paths:
+            raise FileNotFoundError("No tfrecord files match {}".format(file_path))
+        stats_options = tfdv.StatsOptions(
+            sample_rate = options['sample_rate'],
+            feature_allowlist = _selected_features(_tfrecord_features(shard_paths[0]), options))
+        if len(shard_paths) == 1 or num_workers == 1:
+            tfrecord_stats = tfdv.generate_statistics_from_tfrecord(data_location = file_path,
+                                                                    stats_options = stats_options)
+        else:
+            with ProcessPoolExecutor(max_workers = num_workers or os.cpu_count(),
+                                    mp_context = multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(_tfrecord_file_statistics, shard_path, stats_options)
+                            for shard_path in shard_paths]
+                tfrecord_stats = _merge_shard_statistics([future.result() for future in futures])
+        _save_cached(tfrecord_stats, cache_path)
     tfrecord_schema = tfdv.infer_schema(tfrecord_stats)
     tfdv.display_schema(tfrecord_schema)
     return tfrecord_stats, tfrecord_schema
 
 # %%
-def train_val_split(file_path, shuffle_split = True):
+def train_val_split(file_path, shuffle_split = True, data_format = 'csv'):
     """
     Train test split from sklearn function
+    With data_format = 'parquet', file_path is the parquet dataset directory
     """    
-    data = pd.read_csv(file_path, encoding = 'utf-8')
+    from sklearn.model_selection import train_test_split
+    if data_format == 'parquet':
+        data = columnar_data.read_parquet_df(file_path)
+    else:
+        data = pd.read_csv(file_path, encoding = 'utf-8')
     if shuffle_split:
         train_data, val_data = train_test_split(data, test_size = 0.1, 
                                                 random_state= 42, shuffle= True)
@@ -55,11 +272,59 @@ def train_val_split(file_path, shuffle_split = True):
     return train_data, val_data
 
 
+# %%
+def _append_csv(data, file_path, header):
+    """write the first chunk with a header, append every later chunk"""
+    data.to_csv(file_path, mode = 'w' if header else 'a', header = header, index = False)
+
+
+def streaming_train_val_split(file_path, shuffle_split = True, chunksize = 100000,
+                            test_size = 0.1, random_state = 42, key_columns = None,
+                            tail_rows = 5000):
+    """
+    Out-of-core version of train_val_split, memory is bounded by chunksize
+    Shuffled split: every row goes to val when a seeded hash of its key_columns
+    (all columns by default) falls into the lowest test_size share of buckets,
+    so the split is deterministic for a given random_state, whatever the chunksize.
+    Non-shuffled split: the last tail_rows rows go to val, as in train_val_split.
+    Returns the train and val file paths
+    """
+    prefix = "shuffled" if shuffle_split else "loc"
+    train_path = os.path.join(config.DATA_SPLITS_DIR_PATH, "{}_train_data.csv".format(prefix))
+    val_path = os.path.join(config.DATA_SPLITS_DIR_PATH, "{}_val_data.csv".format(prefix))
+    hash_key = '{:016d}'.format(random_state)
+    num_buckets = 10000
+
+    #read everything as text so hashes do not depend on per chunk type inference
+    chunks = pd.read_csv(file_path, encoding = 'utf-8', dtype = str, chunksize = chunksize)
+    header, tail = True, None
+    for chunk in chunks:
+        if shuffle_split:
+            keys = chunk if key_columns is None else chunk[key_columns]
+            buckets = pd.util.hash_pandas_object(keys, index = False, hash_key = hash_key) % num_buckets
+            is_val = buckets < int(test_size * num_buckets)
+            _append_csv(chunk[~is_val], train_path, header)
+            _append_csv(chunk[is_val], val_path, header)
+            header = False
+            continue
+        #only the last tail_rows rows can still end up in val
+        tail = chunk if tail is None else pd.concat([tail, chunk])
+        if len(tail) > tail_rows:
+            _append_csv(tail.iloc[:-tail_rows], train_path, header)
+            tail, header = tail.iloc[-tail_rows:], False
+    if not shuffle_split and tail is not None:
+        if header:
+            _append_csv(tail.iloc[:0], train_path, header)
+        _append_csv(tail, val_path, True)
+    return train_path, val_path
+
+
 # %%
 def csv_statistics_validator(stats, schema):
     """
     Validate statistics from a csv dataset
     """
+    import tensorflow_data_validation as tfdv
     stats_anomalies = tfdv.validate_statistics(statistics = stats, schema = schema)
     tfdv.display_anomalies(stats_anomalies)
     return stats_anomalies
@@ -69,6 +334,7 @@ def tfdv_skew_validator(feature_name, train_stats, serve_stats, schema, threshol
     """
     Validate skew for the csv dataset
     """
+    import tensorflow_data_validation as tfdv
     #this doesn't display skew anomalies as the book shows
     tfdv.get_feature(schema, feature_name).skew_comparator.infinity_norm.threshold = threshold
     skew_anomalies = tfdv.validate_statistics(statistics = train_stats,
@@ -81,6 +347,7 @@ def tfdv_drift_validator(feature_name, train_stats, previous_stats, schema, thre
     """
     Validate drift for the csv dataset
     """
+    import tensorflow_data_validation as tfdv
     #this doesn't display drift anomalies as the book shows
     tfdv.get_feature(schema, feature_name).drift_comparator.infinity_norm.threshold = threshold
     drift_anomalies = tfdv.validate_statistics(statistics=train_stats, 
@@ -93,14 +360,22 @@ def tfdv_drift_validator(feature_name, train_stats, previous_stats, schema, thre
 
 # %%
 if __name__ == '__main__':
+    import tensorflow_data_validation as tfdv
     #train val split
     train_val_split(file_path = config.DATA_FILE_PATH)
+    #or stream it in chunks when the csv does not fit in memory
+    # streaming_train_val_split(file_path = config.DATA_FILE_PATH)
 
 # %%
     #generating train val stats and schema, and then visualize it
     # data_stats, data_schema = csv_statistics_generator(file_path = config.DATA_FILE_PATH)
-    train_stats, train_schema = csv_statistics_generator(file_path = config.TRAIN_FILE_PATH)
-    val_stats, val_schema = csv_statistics_generator(file_path = config.VAL_FILE_PATH)
+    #one pass over both splits, the narrative only gets length statistics
+    split_stats = split_statistics_generator({'train': config.TRAIN_FILE_PATH,
+                                            'val': config.VAL_FILE_PATH},
+                                            cache_dir = config.STATISTICS_CACHE_DIR_PATH,
+                                            length_only_features = list(TEXT_FEATURES))
+    train_stats, val_stats = split_stats['train'], split_stats['val']
+    train_schema, val_schema = tfdv.infer_schema(train_stats), tfdv.infer_schema(val_stats)
     tfdv.visualize_statistics(lhs_statistics = val_stats, rhs_statistics=train_stats,
                             lhs_name = 'VAL_DATASET', rhs_name = 'TRAIN_DATASET')    
 
@@ -0,0 +1,143 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Distributed CPU training helpers for module.run_fn.
+The cluster comes from TF_CONFIG when it is set (multiple hosts). Otherwise
+run_local_cluster starts every task as a local process with its own
+TF_CONFIG: collective ops have to be configured at process startup, so the
+workers can not share the Trainer's process.
+
+custom_config keys read by run_fn:
+    distribution  None, "multi_worker_mirrored" or "parameter_server"
+    num_workers   local worker processes when TF_CONFIG is not set
+    num_ps        local parameter servers in "parameter_server" mode
+"""
+
+# %%
+import argparse
+import importlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import types
+import tensorflow as tf
+
+MULTI_WORKER_MIRRORED = 'multi_worker_mirrored'
+PARAMETER_SERVER = 'parameter_server'
+
+#the parts of the TFX FnArgs the training code reads, they are passed to local tasks as json
+FN_ARGS_FIELDS = ['train_files', 'eval_files', 'transform_output', 'serving_model_dir',
+                'train_steps', 'eval_steps', 'custom_config', 'base_model']
+
+
+# %%
+def build_strategy(distribution = None):
+    """the tf.distribute strategy for a distribution name, the default strategy for None"""
+    if distribution == MULTI_WORKER_MIRRORED:
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    if distribution == PARAMETER_SERVER:
+        return tf.distribute.experimental.ParameterServerStrategy(
+            tf.distribute.cluster_resolver.TFConfigClusterResolver())
+    if distribution:
+        raise ValueError("Unknown distribution {}".format(distribution))
+    return tf.distribute.get_strategy()
+
+
+def task_info():
+    """(task type, task index) of this process, (None, 0) outside of a cluster"""
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    task = tf_config.get('task', {})
+    return task.get('type'), task.get('index', 0)
+
+
+def is_chief():
+    """the chief task, or worker 0 when the cluster has no chief"""
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    task_type, task_index = task_info()
+    if task_type is None or task_type == 'chief':
+        return True
+    return task_type == 'worker' and task_index == 0 and 'chief' not in tf_config.get('cluster', {})
+
+
+# %%
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def local_cluster_spec(num_workers, num_ps = 0):
+    """
+    Cluster of local processes. With parameter servers, a chief task is added
+    that coordinates the workers.
+    """
+    cluster = {'worker': ['localhost:{}'.format(_free_port()) for _ in range(num_workers)]}
+    if num_ps:
+        cluster['ps'] = ['localhost:{}'.format(_free_port()) for _ in range(num_ps)]
+        cluster['chief'] = ['localhost:{}'.format(_free_port())]
+    return cluster
+
+
+def fn_args_to_dict(fn_args):
+    return {field: getattr(fn_args, field) for field in FN_ARGS_FIELDS}
+
+
+def _start_task(cluster, task_type, task_index, target, args):
+    env = dict(os.environ, TF_CONFIG = json.dumps({
+        'cluster': cluster, 'task': {'type': task_type, 'index': task_index}}))
+    command = [sys.executable, '-m', 'practice_example.distributed', '--target', target or '',
+                '--args-json', json.dumps(args)]
+    return subprocess.Popen(command, env = env)
+
+
+def run_local_cluster(target, args, num_workers, num_ps = 0):
+    """
+    Run target (a "package.module.function" path) on a cluster of local processes.
+    Every worker runs target(args) in multi worker mirrored mode, in parameter
+    server mode only the chief does and workers and parameter servers just
+    serve. Blocks until the training tasks are done.
+    """
+    cluster = local_cluster_spec(num_workers, num_ps)
+    if num_ps:
+        servers = ([_start_task(cluster, 'worker', index, None, args) for index in range(num_workers)]
+                    + [_start_task(cluster, 'ps', index, None, args) for index in range(num_ps)])
+        trainers = [_start_task(cluster, 'chief', 0, target, args)]
+    else:
+        servers = []
+        trainers = [_start_task(cluster, 'worker', index, target, args) for index in range(num_workers)]
+
+    try:
+        return_codes = [trainer.wait() for trainer in trainers]
+    finally:
+        for server in servers:
+            server.terminate()
+    if any(return_codes):
+        raise RuntimeError("Distributed training failed with exit codes {}".format(return_codes))
+
+
+def _run_server():
+    """serve a worker or ps task of a parameter server cluster until terminated"""
+    cluster_resolver = tf.distribute.cluster_resolver.TFConfigClusterResolver()
+    server = tf.distribute.Server(cluster_resolver.cluster_spec(),
+                                job_name = cluster_resolver.task_type,
+                                task_index = cluster_resolver.task_id,
+                                protocol = cluster_resolver.rpc_layer or 'grpc',
+                                start = True)
+    server.join()
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run one task of a local training cluster')
+    parser.add_argument('--target', default = '')
+    parser.add_argument('--args-json', required = True)
+    args = parser.parse_args()
+
+    if not args.target:
+        _run_server()
+    else:
+        module_name, function_name = args.target.rsplit('.', 1)
+        target = getattr(importlib.import_module(module_name), function_name)
+        target(types.SimpleNamespace(**json.loads(args.args_json)))
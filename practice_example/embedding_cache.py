@@ -0,0 +1,143 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Precomputed Universal Sentence Encoder embeddings for the complaint narratives.
+The batch pre-embedding stage writes every distinct narrative once into a
+float16 memory mapped array, the trainer then reads embeddings from it
+instead of running the encoder on every step.
+
+Cache layout in cache_dir:
+    embeddings.f16  float16 rows of size EMBEDDING_DIM, in insertion order
+    index.npy       uint64 text keys, row i of the embeddings belongs to key i
+"""
+
+# %%
+import csv
+import hashlib
+import os
+import re
+import numpy as np
+import tensorflow as tf
+from consumer_complaint.config import config
+from practice_example import tfhub_store
+
+EMBEDDINGS_FILE_NAME = 'embeddings.f16'
+INDEX_FILE_NAME = 'index.npy'
+#the ascii whitespace tf.strings.split splits on, so normalize_text and
+#normalize_texts agree
+WHITESPACE_PATTERN = re.compile('[ \t\n\r\v\f]+')
+
+
+# %%
+def normalize_text(text):
+    """collapse whitespace, so the same narrative always maps to the same key"""
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    return ' '.join(part for part in WHITESPACE_PATTERN.split(text) if part)
+
+
+def normalize_texts(texts):
+    """normalize_text on a rank 1 string tensor, for the serving graph"""
+    return tf.strings.reduce_join(tf.strings.split(texts), axis = -1, separator = ' ')
+
+
+def text_key(text):
+    """64 bit hash of the normalized text"""
+    digest = hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size = 8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+# %%
+class EmbeddingCache:
+    def __init__(self, cache_dir = config.EMBEDDING_CACHE_DIR_PATH,
+                embedding_dim = config.EMBEDDING_DIM):
+        self.cache_dir = cache_dir
+        self.embedding_dim = embedding_dim
+        self.keys = np.load(os.path.join(cache_dir, INDEX_FILE_NAME))
+        #an empty file can't be memory mapped
+        self.embeddings = (np.memmap(os.path.join(cache_dir, EMBEDDINGS_FILE_NAME),
+                                    dtype = np.float16, mode = 'r',
+                                    shape = (len(self.keys), embedding_dim))
+                            if len(self.keys) else np.zeros((0, embedding_dim), dtype = np.float16))
+        self._order = np.argsort(self.keys)
+        self._sorted_keys = self.keys[self._order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, texts):
+        """float32 embeddings for a batch of narratives (str or bytes)"""
+        query = np.fromiter((text_key(text) for text in texts), dtype = np.uint64, count = len(texts))
+        #an empty cache has no last position to clip to, every narrative is missing
+        positions = np.minimum(np.searchsorted(self._sorted_keys, query), max(len(self.keys) - 1, 0))
+        missing = (self._sorted_keys[positions] != query if len(self.keys)
+                    else np.ones(len(query), dtype = bool))
+        if missing.any():
+            raise KeyError("{} narratives are not in the embedding cache at {}, "
+                            "rerun build_embedding_cache".format(int(missing.sum()), self.cache_dir))
+        return self.embeddings[self._order[positions]].astype(np.float32)
+
+
+# %%
+def load_encoder(module_url = config.USE_MODULE_URL):
+    return tfhub_store.load_module(module_url)
+
+
+def _load_index(cache_dir, embedding_dim):
+    """existing keys, with any rows a crashed run wrote past the index truncated"""
+    index_path = os.path.join(cache_dir, INDEX_FILE_NAME)
+    embeddings_path = os.path.join(cache_dir, EMBEDDINGS_FILE_NAME)
+    keys = np.load(index_path) if os.path.exists(index_path) else np.zeros(0, dtype = np.uint64)
+    with open(embeddings_path, 'ab') as embeddings_file:
+        embeddings_file.truncate(len(keys) * embedding_dim * np.dtype(np.float16).itemsize)
+    return keys
+
+
+def build_embedding_cache(texts, cache_dir = config.EMBEDDING_CACHE_DIR_PATH,
+                        batch_size = 256, encoder = None,
+                        embedding_dim = config.EMBEDDING_DIM):
+    """
+    Batch pre-embedding stage. Narratives already in the cache are skipped,
+    so retraining on overlapping data only embeds the new ones.
+    Returns the number of newly embedded narratives.
+    """
+    os.makedirs(cache_dir, exist_ok = True)
+    keys = _load_index(cache_dir, embedding_dim)
+    known_keys = set(keys.tolist())
+    encoder = encoder or load_encoder()
+    new_keys, batch = [], []
+
+    with open(os.path.join(cache_dir, EMBEDDINGS_FILE_NAME), 'ab') as embeddings_file:
+        def flush():
+            embeddings = encoder(tf.constant(batch)).numpy().astype(np.float16)
+            embeddings_file.write(embeddings.tobytes())
+            batch.clear()
+
+        for text in texts:
+            key = text_key(text)
+            if key in known_keys:
+                continue
+            known_keys.add(key)
+            new_keys.append(key)
+            batch.append(normalize_text(text))
+            if len(batch) == batch_size:
+                flush()
+        if batch:
+            flush()
+
+    #the index is written last, rows past its end are dropped on the next run
+    np.save(os.path.join(cache_dir, INDEX_FILE_NAME),
+            np.concatenate([keys, np.array(new_keys, dtype = np.uint64)]))
+    return len(new_keys)
+
+
+def read_narratives(file_path, column = 'consumer_complaint_narrative'):
+    with open(file_path, encoding = 'utf-8') as csv_file:
+        for row in csv.DictReader(csv_file):
+            yield row[column] or ''
+
+
+# %%
+if __name__ == '__main__':
+    num_embedded = build_embedding_cache(read_narratives(config.DATA_FILE_PATH))
+    print("embedded {} new narratives".format(num_embedded))
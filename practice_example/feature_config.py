@@ -0,0 +1,193 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Vocabulary sizes of the categorical features, derived from the statistics
+of the train split instead of being hard coded. A feature keeps the values
+seen at least min_frequency times, up to its size in config.py, and
+out of vocabulary values are hashed into oov_buckets ids.
+
+In the pipeline FeatureConfigGen generates the feature config from the
+(cumulative) statistics before Transform and writes it into the schema
+artifact it passes on to Transform. FeatureConfigTransform builds
+preprocessing_fn with the feature config of its schema artifact and copies
+it into the transform_graph artifact, where the Trainer reads it. Every
+run's sizes travel with its own artifacts, so the Trainer matches the
+transform graph on any host. Outside of the pipeline, for
+data_preprocessing.py:
+
+    python -m practice_example.feature_config <statistics file> --output feature_config.json
+
+The sizes are counted from the statistics' rank histogram (1000 values by
+default). When more values than that are frequent, the size falls back to
+the number of unique values, and tft's frequency_threshold trims the
+actual vocabulary.
+"""
+
+# %%
+import argparse
+import functools
+import hashlib
+import json
+import os
+import tensorflow as tf
+import tensorflow_data_validation as tfdv
+from absl import logging
+from tfx.components import Transform
+from tfx.components.transform import executor as transform_executor
+from tfx.dsl.component.experimental.annotations import InputArtifact, OutputArtifact
+from tfx.dsl.component.experimental.decorators import component
+from tfx.components.base import executor_spec
+from tfx.types import artifact_utils, standard_artifacts
+from consumer_complaint.config import config
+from practice_example import features
+from practice_example.features import FEATURE_CONFIG_FILE_NAME
+from practice_example.incremental_statistics import STATS_FILE_NAME
+
+SCHEMA_FILE_NAME = 'schema.pbtxt'
+
+
+# %%
+def configured_features():
+    """feature name -> most values kept, for every categorical feature of config.py"""
+    return {**config.CATEGORICAL_VOCAB_SIZES, **config.HIGH_CARDINALITY_VOCAB_SIZES}
+
+
+def statistics_fingerprint(stats):
+    return hashlib.blake2b(stats.SerializeToString(deterministic = True),
+                            digest_size = 16).hexdigest()
+
+
+def count_frequent_values(string_stats, min_frequency):
+    """number of distinct values seen at least min_frequency times"""
+    ranks = [(bucket.high_rank - bucket.low_rank + 1, bucket.sample_count)
+            for bucket in string_stats.rank_histogram.buckets]
+    if not ranks:
+        ranks = [(1, top_value.frequency) for top_value in string_stats.top_values]
+    num_frequent = sum(num_ranks for num_ranks, count in ranks if count >= min_frequency)
+    num_ranked = sum(num_ranks for num_ranks, _ in ranks)
+    #the histogram is truncated and frequent up to its end, only unique bounds it
+    if num_frequent == num_ranked and string_stats.unique > num_ranked:
+        return string_stats.unique
+    return num_frequent
+
+
+def derive_vocab_sizes(stats, feature_caps, min_frequency):
+    """{feature name: vocabulary size} from a DatasetFeatureStatisticsList"""
+    string_stats = {}
+    for feature in stats.datasets[0].features:
+        name = feature.path.step[-1] if feature.path.step else feature.name
+        if feature.HasField('string_stats'):
+            string_stats[name] = feature.string_stats
+    missing = sorted(set(feature_caps) - set(string_stats))
+    if missing:
+        raise ValueError("No string statistics for {}".format(', '.join(missing)))
+    return {name: min(count_frequent_values(string_stats[name], min_frequency), cap)
+            for name, cap in feature_caps.items()}
+
+
+def generate_feature_config(stats, feature_caps = None,
+                            min_frequency = config.CATEGORICAL_MIN_FREQUENCY,
+                            oov_buckets = config.CATEGORICAL_OOV_BUCKETS):
+    feature_caps = feature_caps or configured_features()
+    return {
+        'statistics_fingerprint': statistics_fingerprint(stats),
+        'min_frequency': min_frequency,
+        'oov_buckets': oov_buckets,
+        'vocab_caps': feature_caps,
+        'vocab_sizes': derive_vocab_sizes(stats, feature_caps, min_frequency),
+    }
+
+
+def _read_feature_config(path):
+    if not tf.io.gfile.exists(path):
+        return {}
+    with tf.io.gfile.GFile(path) as feature_config_file:
+        return json.load(feature_config_file)
+
+
+def _write_feature_config(feature_config, path):
+    tf.io.gfile.makedirs(os.path.dirname(path))
+    with tf.io.gfile.GFile(path + '.tmp', 'w') as feature_config_file:
+        json.dump(feature_config, feature_config_file, indent = 2)
+    tf.io.gfile.rename(path + '.tmp', path, overwrite = True)
+
+
+def update_feature_config(stats, path, **options):
+    """
+    regenerate the feature config at path unless it was generated from the
+    same statistics and options, returns the config and whether it changed
+    """
+    current = _read_feature_config(path)
+    feature_config = generate_feature_config(stats, **options)
+    if current == feature_config:
+        return feature_config, False
+    _write_feature_config(feature_config, path)
+    for name, size in feature_config['vocab_sizes'].items():
+        if size != current.get('vocab_sizes', {}).get(name):
+            logging.info("Vocabulary size of %s: %s", name, size)
+    return feature_config, True
+
+
+# %%
+@component
+def FeatureConfigGen(
+        statistics: InputArtifact[standard_artifacts.ExampleStatistics],
+        schema: InputArtifact[standard_artifacts.Schema],
+        transform_schema: OutputArtifact[standard_artifacts.Schema]):
+    """
+    Generate the feature config from the train split statistics. The
+    schema is passed on unchanged with the feature config next to it, so
+    Transform depends on the statistics the sizes were derived from.
+    """
+    stats = tfdv.load_statistics(os.path.join(
+        artifact_utils.get_split_uri([statistics], 'train'), STATS_FILE_NAME))
+    feature_config = generate_feature_config(stats)
+    for name, size in feature_config['vocab_sizes'].items():
+        logging.info("Vocabulary size of %s: %s", name, size)
+
+    tf.io.gfile.copy(os.path.join(schema.uri, SCHEMA_FILE_NAME),
+                    os.path.join(transform_schema.uri, SCHEMA_FILE_NAME), overwrite = True)
+    _write_feature_config(feature_config,
+                        os.path.join(transform_schema.uri, FEATURE_CONFIG_FILE_NAME))
+
+
+# %%
+class FeatureConfigTransformExecutor(transform_executor.Executor):
+    """
+    Transform executor building features.preprocessing_fn with the feature
+    config of its schema artifact, instead of the module file's. The graph
+    is built here on the launcher, so Beam workers never need the file.
+    """
+
+    def Do(self, input_dict, output_dict, exec_properties):
+        self._feature_config = features.load_feature_config(
+            artifact_utils.get_single_uri(input_dict['schema']))
+        super().Do(input_dict, output_dict, exec_properties)
+        #the Trainer and numpy_transform read the sizes the graph was built with from here
+        _write_feature_config(self._feature_config, os.path.join(
+            artifact_utils.get_single_uri(output_dict['transform_graph']), FEATURE_CONFIG_FILE_NAME))
+
+    def _GetPreprocessingFn(self, inputs, unused_outputs):
+        return functools.partial(features.preprocessing_fn, feature_config = self._feature_config)
+
+
+class FeatureConfigTransform(Transform):
+    """Transform with the schema and feature config of FeatureConfigGen"""
+    EXECUTOR_SPEC = executor_spec.ExecutorClassSpec(FeatureConfigTransformExecutor)
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('statistics', help = 'statistics file of the train split')
+    parser.add_argument('--output', required = True)
+    parser.add_argument('--min-frequency', type = int, default = config.CATEGORICAL_MIN_FREQUENCY)
+    parser.add_argument('--oov-buckets', type = int, default = config.CATEGORICAL_OOV_BUCKETS)
+    args = parser.parse_args()
+
+    feature_config, changed = update_feature_config(
+        tfdv.load_statistics(args.statistics), args.output,
+        min_frequency = args.min_frequency, oov_buckets = args.oov_buckets)
+    print(json.dumps(feature_config['vocab_sizes'], indent = 2))
+    print("{} {}".format("wrote" if changed else "unchanged,", args.output))
@@ -0,0 +1,427 @@
+"""Feature spec and tf.Transform preprocessing shared by the pipeline.
+
+module.py (the TFX module file) and data_preprocessing.py both import from
+here, and numpy_transform.py mirrors preprocessing_fn outside of Beam.
+The feature constants are imported by light tools too, so tensorflow and
+tensorflow_transform are only imported by the functions using them.
+The vocabulary sizes come from the feature config feature_config.py derives
+from the statistics. It is passed in as the feature_config argument, read
+from the transform_schema artifact by Transform and from the transform_graph
+artifact by the Trainer, and the sizes of config.py apply without it.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import List, Tuple, Union
+
+from consumer_complaint.config import config
+
+
+LABEL_KEY = "consumer_disputed"
+
+# "one_hot" writes dense float one-hots, "ids" int64 ids the model embeds
+CATEGORICAL_ENCODINGS = ("one_hot", "ids")
+CATEGORICAL_ENCODING = config.CATEGORICAL_ENCODING
+if CATEGORICAL_ENCODING not in CATEGORICAL_ENCODINGS:
+    raise ValueError(
+        "Unknown CATEGORICAL_ENCODING {}, choose one of {}".format(
+            CATEGORICAL_ENCODING, CATEGORICAL_ENCODINGS
+        )
+    )
+
+# "per_feature" runs an analyzer per feature, "fused" shares them, see
+# preprocessing_fn
+TRANSFORM_ANALYZERS_MODES = ("per_feature", "fused")
+TRANSFORM_ANALYZERS = config.TRANSFORM_ANALYZERS
+if TRANSFORM_ANALYZERS not in TRANSFORM_ANALYZERS_MODES:
+    raise ValueError(
+        "Unknown TRANSFORM_ANALYZERS {}, choose one of {}".format(
+            TRANSFORM_ANALYZERS, TRANSFORM_ANALYZERS_MODES
+        )
+    )
+
+# vocabulary of all the categorical features with fused analyzers, every
+# value is prefixed with its feature name and the separator
+SHARED_VOCABULARY_NAME = "categorical"
+SHARED_VOCABULARY_SEPARATOR = "\x1f"
+
+
+# feature name, most values kept (compute_and_apply_vocabulary's top_k),
+# see vocab_sizes for the sizes derived from the statistics.
+# The high cardinality features are only read as ids, see config.py.
+ONE_HOT_FEATURES = dict(config.CATEGORICAL_VOCAB_SIZES)
+if CATEGORICAL_ENCODING == "ids":
+    ONE_HOT_FEATURES.update(config.HIGH_CARDINALITY_VOCAB_SIZES)
+
+# feature name, bucket count
+BUCKET_FEATURES = {"zip_code": 10}
+
+# feature name, value is unused
+TEXT_FEATURES = {"consumer_complaint_narrative": None}
+
+# raw features the model reads, the inputs of the raw features signature
+SERVING_FEATURES = (
+    list(ONE_HOT_FEATURES) + list(BUCKET_FEATURES) + list(TEXT_FEATURES)
+)
+
+# the feature config feature_config.py derives from the statistics, written
+# into the transform_schema artifact and passed on to the transform_graph
+FEATURE_CONFIG_FILE_NAME = "feature_config.json"
+
+
+def load_feature_config(artifact_dir: str) -> dict:
+    """The feature config of a transform_schema or transform_graph artifact.
+
+    Empty when the artifact has none, the sizes of config.py then apply.
+    """
+    import tensorflow as tf
+
+    path = os.path.join(artifact_dir, FEATURE_CONFIG_FILE_NAME)
+    if not tf.io.gfile.exists(path):
+        return {}
+    with tf.io.gfile.GFile(path) as feature_config_file:
+        return json.load(feature_config_file)
+
+
+def vocab_sizes(feature_config: dict = None) -> dict:
+    """Feature name, vocabulary size of the categorical features."""
+    sizes = (feature_config or {}).get("vocab_sizes", {})
+    return {key: sizes.get(key, dim) for key, dim in ONE_HOT_FEATURES.items()}
+
+
+def min_frequency(feature_config: dict = None) -> int:
+    """Values seen fewer times are out of vocabulary."""
+    return (feature_config or {}).get(
+        "min_frequency", config.CATEGORICAL_MIN_FREQUENCY
+    )
+
+
+def oov_buckets(feature_config: dict = None) -> int:
+    """Out of vocabulary values are hashed into this many ids.
+
+    With one-hots 0 buckets gives them a zero row.
+    """
+    num_oov_buckets = (feature_config or {}).get(
+        "oov_buckets", config.CATEGORICAL_OOV_BUCKETS
+    )
+    if CATEGORICAL_ENCODING == "ids" and num_oov_buckets < 1:
+        raise ValueError(
+            "The ids encoding needs at least one out of vocabulary bucket"
+        )
+    return num_oov_buckets
+
+
+# an invalid config.py fails at import
+oov_buckets()
+
+
+def transformed_name(key: str) -> str:
+    return key + "_xf"
+
+
+def fill_in_missing(x: Union[tf.Tensor, tf.SparseTensor]) -> tf.Tensor:
+    """Replace missing values in a SparseTensor.
+
+    Fills in missing values of `x` with '' or 0, and converts to a
+    dense tensor.
+
+    Args:
+      x: A `SparseTensor` of rank 2.  Its dense shape should have
+        size at most 1 in the second dimension.
+
+    Returns:
+      A rank 1 tensor where missing values of `x` have been filled in.
+    """
+    import tensorflow as tf
+
+    if isinstance(x, tf.sparse.SparseTensor):
+        default_value = "" if x.dtype == tf.string else 0
+        x = tf.sparse.to_dense(
+            tf.SparseTensor(x.indices, x.values, [x.dense_shape[0], 1]),
+            default_value,
+        )
+    return tf.squeeze(x, axis=1)
+
+
+def convert_num_to_one_hot(
+    label_tensor: tf.Tensor, num_labels: int = 2
+) -> tf.Tensor:
+    """
+    Convert a label (0 or 1) into a one-hot vector
+    Args:
+        int: label_tensor (0 or 1)
+    Returns
+        label tensor
+    """
+    import tensorflow as tf
+
+    one_hot_tensor = tf.one_hot(label_tensor, num_labels)
+    return tf.reshape(one_hot_tensor, [-1, num_labels])
+
+
+def categorical_num_ids(key: str, feature_config: dict = None) -> int:
+    """Number of ids, or one-hot width, of a categorical or bucket feature.
+
+    Vocabulary features keep dim + 1 values (the empty string of missing
+    values included), followed by the out of vocabulary buckets. Bucket
+    features have up to dim + 1 buckets.
+    """
+    if key in BUCKET_FEATURES:
+        return BUCKET_FEATURES[key] + 1
+    return vocab_sizes(feature_config)[key] + 1 + oov_buckets(feature_config)
+
+
+def wide_inputs(
+    units: int, feature_config: dict = None
+) -> Tuple[List[tf.Tensor], tf.Tensor]:
+    """Keras inputs of the categorical and bucket features and the wide layer.
+
+    With one-hots the wide layer is a relu Dense layer on their concatenation.
+    With ids it is the same layer as a sum of per feature embedding lookups
+    plus a bias, since a one-hot times a weight matrix is the row of its id.
+    That skips the matmul over all the zeros. The widths follow
+    feature_config, the one the transform graph was built with.
+
+    Returns:
+      The list of inputs and the output of the wide layer.
+    """
+    import tensorflow as tf
+
+    class Bias(tf.keras.layers.Layer):
+        """the bias of the one-hot Dense layer"""
+
+        def build(self, input_shape):
+            self.bias = self.add_weight(
+                "bias", shape=(input_shape[-1],), initializer="zeros"
+            )
+
+        def call(self, inputs):
+            return tf.nn.bias_add(inputs, self.bias)
+
+    inputs, embeddings = [], []
+    for key in {**ONE_HOT_FEATURES, **BUCKET_FEATURES}.keys():
+        if CATEGORICAL_ENCODING == "ids":
+            ids = tf.keras.Input(
+                shape=(1,), name=transformed_name(key), dtype=tf.int64
+            )
+            inputs.append(ids)
+            embeddings.append(
+                tf.keras.layers.Embedding(
+                    categorical_num_ids(key, feature_config), units
+                )(tf.reshape(ids, [-1]))
+            )
+        else:
+            inputs.append(
+                tf.keras.Input(
+                    shape=(categorical_num_ids(key, feature_config),),
+                    name=transformed_name(key),
+                )
+            )
+
+    if CATEGORICAL_ENCODING == "ids":
+        wide = tf.keras.layers.Activation("relu")(
+            Bias()(tf.keras.layers.add(embeddings))
+        )
+    else:
+        wide = tf.keras.layers.Dense(units, activation="relu")(
+            tf.keras.layers.concatenate(inputs)
+        )
+    return inputs, wide
+
+
+def convert_zip_code(zipcode: tf.Tensor) -> tf.Tensor:
+    """
+    Convert a zipcode string to float32 representation. In the dataset the
+    zipcodes are anonymized by repacing the last digits with X. We are
+    replacing those characters with 0 to simplify the bucketing later on,
+    and missing zipcodes with 00000.
+
+    Args:
+        str: zipcode
+    Returns:
+        zipcode: float32
+    """
+    import tensorflow as tf
+
+    zipcode = tf.where(
+        tf.equal(zipcode, ""), tf.fill(tf.shape(zipcode), "00000"), zipcode
+    )
+    zipcode = tf.strings.regex_replace(zipcode, r"X", "0")
+    zipcode = tf.strings.to_number(zipcode, out_type=tf.float32)
+    return zipcode
+
+
+def shared_vocabulary_values(
+    vocabulary: List[str], key: str, feature_config: dict = None
+) -> List[str]:
+    """The vocabulary of one feature out of the shared vocabulary.
+
+    The shared vocabulary is sorted by frequency like a per feature one, so
+    the first dim + 1 values of the feature are the ones top_k keeps.
+    """
+    prefix = key + SHARED_VOCABULARY_SEPARATOR
+    values = [
+        value[len(prefix) :] for value in vocabulary if value.startswith(prefix)
+    ]
+    return values[: vocab_sizes(feature_config)[key] + 1]
+
+
+def _shared_vocabulary_lookup(key: str, size: int, num_oov_buckets: int):
+    """lookup_fn of tft.apply_vocabulary, shared_vocabulary_values in the graph.
+
+    The values are looked up unprefixed, so the ids and the out of
+    vocabulary buckets are the same as with a per feature vocabulary of
+    size values.
+    """
+    import tensorflow as tf
+
+    prefix = key + SHARED_VOCABULARY_SEPARATOR
+
+    def lookup_fn(x, vocabulary_path):
+        vocabulary = tf.strings.split(tf.io.read_file(vocabulary_path), "\n")
+        vocabulary = tf.boolean_mask(
+            vocabulary,
+            tf.equal(tf.strings.substr(vocabulary, 0, len(prefix)), prefix),
+        )[: size + 1]
+        vocabulary = tf.strings.substr(
+            vocabulary, len(prefix), tf.strings.length(vocabulary) - len(prefix)
+        )
+        initializer = tf.lookup.KeyValueTensorInitializer(
+            vocabulary, tf.range(tf.size(vocabulary, out_type=tf.int64))
+        )
+        if num_oov_buckets:
+            table = tf.lookup.StaticVocabularyTable(initializer, num_oov_buckets)
+        else:
+            table = tf.lookup.StaticHashTable(initializer, default_value=-1)
+        return table.lookup(x), table.size()
+
+    return lookup_fn
+
+
+def _categorical_ids(inputs: dict, feature_config: dict = None) -> dict:
+    """Vocabulary ids of the categorical features, see preprocessing_fn."""
+    import tensorflow as tf
+    import tensorflow_transform as tft
+
+    sizes = vocab_sizes(feature_config)
+    num_oov_buckets = oov_buckets(feature_config)
+
+    values = {key: fill_in_missing(inputs[key]) for key in ONE_HOT_FEATURES}
+    if TRANSFORM_ANALYZERS == "per_feature":
+        return {
+            key: tft.compute_and_apply_vocabulary(
+                value,
+                top_k=sizes[key] + 1,
+                frequency_threshold=min_frequency(feature_config),
+                num_oov_buckets=num_oov_buckets,
+                vocab_filename=key,
+            )
+            for key, value in values.items()
+        }
+
+    shared_vocabulary = tft.vocabulary(
+        tf.concat(
+            [
+                tf.strings.join([key + SHARED_VOCABULARY_SEPARATOR, value])
+                for key, value in values.items()
+            ],
+            axis=0,
+        ),
+        frequency_threshold=min_frequency(feature_config),
+        vocab_filename=SHARED_VOCABULARY_NAME,
+    )
+    return {
+        key: tft.apply_vocabulary(
+            value,
+            shared_vocabulary,
+            lookup_fn=_shared_vocabulary_lookup(key, sizes[key], num_oov_buckets),
+        )
+        for key, value in values.items()
+    }
+
+
+def _bucket_ids(inputs: dict) -> dict:
+    """Bucket ids of the bucket features, see preprocessing_fn."""
+    import tensorflow as tf
+    import tensorflow_transform as tft
+
+    values = {}
+    for key in BUCKET_FEATURES.keys():
+        dense_feature = fill_in_missing(inputs[key])
+        if key == "zip_code" and dense_feature.dtype == tf.string:
+            dense_feature = convert_zip_code(dense_feature)
+        else:
+            dense_feature = tf.cast(dense_feature, tf.float32)
+        values[key] = dense_feature
+
+    if TRANSFORM_ANALYZERS == "per_feature":
+        return {
+            key: tft.bucketize(
+                value, BUCKET_FEATURES[key], always_return_num_quantiles=False
+            )
+            for key, value in values.items()
+        }
+
+    bucket_ids = {}
+    for bucket_count in sorted(set(BUCKET_FEATURES.values())):
+        keys = [key for key in values if BUCKET_FEATURES[key] == bucket_count]
+        buckets = tft.bucketize(
+            tf.stack([values[key] for key in keys], axis=1),
+            bucket_count,
+            always_return_num_quantiles=False,
+            elementwise=True,
+        )
+        for index, key in enumerate(keys):
+            bucket_ids[key] = buckets[:, index]
+    return bucket_ids
+
+
+def preprocessing_fn(inputs: tf.Tensor, feature_config: dict = None) -> tf.Tensor:
+    """tf.transform's callback function for preprocessing inputs.
+
+    Vocabularies are named after their feature (or SHARED_VOCABULARY_NAME),
+    so numpy_transform.py can read them back from the transform output. Categorical and bucket
+    features are one-hots or int64 ids depending on CATEGORICAL_ENCODING.
+    The vocabularies keep the values seen at least min_frequency times, up
+    to the vocab_sizes of feature_config, and out of vocabulary values are
+    hashed into oov_buckets ids.
+
+    With TRANSFORM_ANALYZERS = "fused" a single vocabulary analyzer counts
+    the values of all the categorical features, prefixed with their feature
+    name, into the SHARED_VOCABULARY_NAME vocabulary, and every feature
+    looks its ids up in its part of it. The bucket features with the same
+    bucket count share one elementwise quantiles analyzer. The Beam job then
+    makes one pass and one shuffle over the data for all the vocabularies
+    instead of one per feature.
+
+    Args:
+      inputs: map from feature keys to raw not-yet-transformed features.
+      feature_config: the feature config of feature_config.py, None for the
+        sizes of config.py.
+
+    Returns:
+      Map from string feature key to transformed feature operations.
+    """
+    outputs = {}
+
+    ids = CATEGORICAL_ENCODING == "ids"
+    int_values = {
+        **_categorical_ids(inputs, feature_config),
+        **_bucket_ids(inputs),
+    }
+    for key, int_value in int_values.items():
+        if ids:
+            outputs[transformed_name(key)] = int_value
+        else:
+            outputs[transformed_name(key)] = convert_num_to_one_hot(
+                int_value, num_labels=categorical_num_ids(key, feature_config)
+            )
+
+    for key in TEXT_FEATURES.keys():
+        outputs[transformed_name(key)] = fill_in_missing(inputs[key])
+
+    outputs[transformed_name(LABEL_KEY)] = fill_in_missing(inputs[LABEL_KEY])
+
+    return outputs
@@ -0,0 +1,196 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Cumulative statistics for span based (incremental) ingestion.
+StatisticsGen only computes statistics for the newest span, this component
+merges them into a cumulative DatasetFeatureStatisticsList cached on disk,
+so SchemaGen still sees the full history without rescanning it.
+"""
+
+# %%
+import json
+import os
+from typing import Text
+import tensorflow as tf
+import tensorflow_data_validation as tfdv
+from tensorflow_metadata.proto.v0 import statistics_pb2
+from tfx.dsl.component.experimental.annotations import InputArtifact, OutputArtifact, Parameter
+from tfx.dsl.component.experimental.decorators import component
+from tfx.types import artifact_utils, standard_artifacts
+from consumer_complaint.config import config
+
+STATS_FILE_NAME = 'stats_tfrecord'
+SPANS_FILE_NAME = 'merged_spans.json'
+SPANS_DIR_NAME = 'spans'
+
+
+# %%
+def _feature_key(feature):
+    return tuple(feature.path.step) or (feature.name,)
+
+
+def _merge_common_stats(merged, new):
+    """merge count based CommonStatistics of the same feature"""
+    merged.min_num_values = min(merged.min_num_values, new.min_num_values)
+    merged.max_num_values = max(merged.max_num_values, new.max_num_values)
+    merged.num_non_missing += new.num_non_missing
+    merged.num_missing += new.num_missing
+    merged.tot_num_values += new.tot_num_values
+    if merged.num_non_missing:
+        merged.avg_num_values = merged.tot_num_values / merged.num_non_missing
+
+
+def _merge_num_stats(merged, new):
+    """
+    Pooled mean and standard deviation are exact, median and histograms
+    cannot be merged from the summaries so they follow the newest span
+    """
+    merged_count = merged.common_stats.tot_num_values
+    new_count = new.common_stats.tot_num_values
+    total = merged_count + new_count
+    if total:
+        mean = (merged_count * merged.mean + new_count * new.mean) / total
+        second_moment = (merged_count * (merged.std_dev ** 2 + merged.mean ** 2)
+                        + new_count * (new.std_dev ** 2 + new.mean ** 2)) / total
+        merged.std_dev = max(second_moment - mean ** 2, 0.0) ** 0.5
+        merged.mean = mean
+    merged.min = min(merged.min, new.min)
+    merged.max = max(merged.max, new.max)
+    merged.num_zeros += new.num_zeros
+    merged.median = new.median
+    del merged.histograms[:]
+    merged.histograms.extend(new.histograms)
+    _merge_common_stats(merged.common_stats, new.common_stats)
+
+
+def _merge_string_stats(merged, new):
+    """sum the top value frequencies and rebuild the rank histogram from them"""
+    merged_count = merged.common_stats.tot_num_values
+    new_count = new.common_stats.tot_num_values
+    if merged_count + new_count:
+        merged.avg_length = ((merged_count * merged.avg_length + new_count * new.avg_length)
+                            / (merged_count + new_count))
+    frequencies = {}
+    for top_value in list(merged.top_values) + list(new.top_values):
+        frequencies[top_value.value] = frequencies.get(top_value.value, 0) + top_value.frequency
+    ranked = sorted(frequencies.items(), key = lambda item: -item[1])
+    num_top_values = max(len(merged.top_values), len(new.top_values))
+    num_buckets = max(len(merged.rank_histogram.buckets), len(new.rank_histogram.buckets))
+    #unique counts of two spans overlap, the larger one is a lower bound
+    merged.unique = max(merged.unique, new.unique, len(frequencies))
+
+    del merged.top_values[:]
+    for value, frequency in ranked[:num_top_values]:
+        merged.top_values.add(value = value, frequency = frequency)
+    del merged.rank_histogram.buckets[:]
+    for rank, (value, frequency) in enumerate(ranked[:num_buckets]):
+        merged.rank_histogram.buckets.add(low_rank = rank, high_rank = rank,
+                                        label = value, sample_count = frequency)
+    _merge_common_stats(merged.common_stats, new.common_stats)
+
+
+def merge_dataset_statistics(merged, new):
+    """merge the DatasetFeatureStatistics new into merged, in place"""
+    merged.num_examples += new.num_examples
+    merged.weighted_num_examples += new.weighted_num_examples
+    features = {_feature_key(feature): feature for feature in merged.features}
+    for new_feature in new.features:
+        feature = features.get(_feature_key(new_feature))
+        if feature is None:
+            merged.features.add().CopyFrom(new_feature)
+        elif new_feature.HasField('num_stats'):
+            _merge_num_stats(feature.num_stats, new_feature.num_stats)
+        elif new_feature.HasField('string_stats'):
+            _merge_string_stats(feature.string_stats, new_feature.string_stats)
+        elif new_feature.HasField('bytes_stats'):
+            _merge_common_stats(feature.bytes_stats.common_stats, new_feature.bytes_stats.common_stats)
+    return merged
+
+
+def merge_statistics(merged, new):
+    """merge two DatasetFeatureStatisticsList, datasets are matched by name"""
+    datasets = {dataset.name: dataset for dataset in merged.datasets}
+    for new_dataset in new.datasets:
+        if new_dataset.name in datasets:
+            merge_dataset_statistics(datasets[new_dataset.name], new_dataset)
+        else:
+            merged.datasets.add().CopyFrom(new_dataset)
+    return merged
+
+
+# %%
+def _write_statistics(stats, file_path):
+    tf.io.gfile.makedirs(os.path.dirname(file_path))
+    with tf.io.TFRecordWriter(file_path) as writer:
+        writer.write(stats.SerializeToString())
+
+
+def _span_statistics_path(cache_dir, span, split):
+    return os.path.join(cache_dir, SPANS_DIR_NAME, 'span-{}'.format(span),
+                        'Split-{}'.format(split), STATS_FILE_NAME)
+
+
+def _load_merged_spans(cache_dir):
+    """{span: version} of the spans in the cumulative statistics"""
+    spans_path = os.path.join(cache_dir, SPANS_FILE_NAME)
+    if not tf.io.gfile.exists(spans_path):
+        return {}
+    with tf.io.gfile.GFile(spans_path) as spans_file:
+        return {int(span): version for span, version in json.load(spans_file).items()}
+
+
+def _rebuild_statistics(cache_dir, spans, split):
+    """merge the cached statistics of every span again, oldest span first"""
+    merged_stats = statistics_pb2.DatasetFeatureStatisticsList()
+    for span in sorted(spans):
+        span_path = _span_statistics_path(cache_dir, span, split)
+        if tf.io.gfile.exists(span_path):
+            merge_statistics(merged_stats, tfdv.load_statistics(span_path))
+    return merged_stats
+
+
+@component
+def CumulativeStatisticsGen(
+        statistics: InputArtifact[standard_artifacts.ExampleStatistics],
+        examples: InputArtifact[standard_artifacts.Examples],
+        cumulative_statistics: OutputArtifact[standard_artifacts.ExampleStatistics],
+        cache_dir: Parameter[Text] = config.CUMULATIVE_STATS_DIR_PATH):
+    """
+    Merge the statistics of the newest span into the cached cumulative statistics.
+    Spans are keyed by (span, version): a span that was already merged (e.g. a rerun
+    of the same export) is not counted twice, and a newer ver-<N> of a merged span
+    replaces the older version, the cumulative statistics are then merged again
+    from the statistics of every span, which are cached next to them.
+    """
+    merged_spans = _load_merged_spans(cache_dir)
+    span, version = examples.span, examples.version
+    merged_version = merged_spans.get(span)
+    is_new_span = merged_version is None
+    is_new_version = not is_new_span and version > merged_version
+    split_names = artifact_utils.decode_split_names(statistics.split_names)
+
+    for split in split_names:
+        new_stats = tfdv.load_statistics(
+            os.path.join(artifact_utils.get_split_uri([statistics], split), STATS_FILE_NAME))
+        cache_path = os.path.join(cache_dir, 'Split-{}'.format(split), STATS_FILE_NAME)
+        if is_new_span or is_new_version:
+            _write_statistics(new_stats, _span_statistics_path(cache_dir, span, split))
+        if is_new_version:
+            merged_stats = _rebuild_statistics(cache_dir, merged_spans, split)
+        elif tf.io.gfile.exists(cache_path):
+            merged_stats = tfdv.load_statistics(cache_path)
+            if is_new_span:
+                merge_statistics(merged_stats, new_stats)
+        else:
+            merged_stats = statistics_pb2.DatasetFeatureStatisticsList()
+            merged_stats.CopyFrom(new_stats)
+        _write_statistics(merged_stats, cache_path)
+        _write_statistics(merged_stats, os.path.join(
+            artifact_utils.get_split_uri([cumulative_statistics], split), STATS_FILE_NAME))
+
+    if is_new_span or is_new_version:
+        merged_spans[span] = version
+        with tf.io.gfile.GFile(os.path.join(cache_dir, SPANS_FILE_NAME), 'w') as spans_file:
+            json.dump({str(span): version for span, version in sorted(merged_spans.items())},
+                    spans_file)
+    cumulative_statistics.split_names = statistics.split_names
@@ -0,0 +1,341 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Local inference service for the model Pusher writes to config.SERVING_MODEL_DIR.
+Requests are collected into micro batches (up to max_batch_size examples or
+max_wait_ms after the first request) and every batch is one call of the
+serving_default signature, run by a pool of worker threads. A new version
+directory written by Pusher is picked up without a restart. The served
+examples feed a serving_stats.ServingStatsCollector, which exports statistics
+of the traffic to config.SERVING_STATS_DIR_PATH (--no-serving-stats turns it off).
+
+Endpoints, shaped like TensorFlow Serving so its clients work unchanged:
+    HTTP  POST /v1/models/consumer_complaint:predict
+          {"instances": [{"product": "...", ...}]} or {"examples": [{"b64": "..."}]}
+          {"signature_name": "serving_raw", "inputs": {"product": [...], ...}}
+    gRPC  tensorflow.serving.PredictionService/Predict with an "examples" input,
+          or one input per raw feature for the serving_raw signature
+
+    python -m practice_example.inference_server
+    python -m practice_example.inference_server --model-dir <config.COMPACT_SERVING_MODEL_DIR>
+
+The compact model of compact_model.py has the same signatures, so it is served
+the same way.
+"""
+
+# %%
+import argparse
+import base64
+import json
+import os
+import queue
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import grpc
+import tensorflow as tf
+from absl import logging
+from tensorflow_serving.apis import predict_pb2, prediction_service_pb2_grpc
+from consumer_complaint.config import config
+from practice_example.serving_stats import ServingStatsCollector
+
+
+# %%
+def _to_feature(value):
+    if isinstance(value, bytes):
+        return tf.train.Feature(bytes_list = tf.train.BytesList(value = [value]))
+    if isinstance(value, str):
+        return tf.train.Feature(bytes_list = tf.train.BytesList(value = [value.encode('utf-8')]))
+    if isinstance(value, int):
+        return tf.train.Feature(int64_list = tf.train.Int64List(value = [value]))
+    return tf.train.Feature(float_list = tf.train.FloatList(value = [value]))
+
+
+def instance_to_example(instance):
+    """serialize a {feature name: value} dict into a tf.Example"""
+    example = tf.train.Example(features = tf.train.Features(feature = {
+        name: _to_feature(value) for name, value in instance.items() if value is not None}))
+    return example.SerializeToString()
+
+
+# %%
+class ModelManager:
+    """Holds the latest pushed model version and swaps in newer ones."""
+
+    def __init__(self, model_dir = config.SERVING_MODEL_DIR,
+                poll_seconds = config.INFERENCE_POLL_SECONDS):
+        self.model_dir = model_dir
+        self.version = None
+        self._loaded = None
+        self._signatures = None
+        self._lock = threading.Lock()
+        self.reload()
+        if poll_seconds:
+            threading.Thread(target = self._poll, args = (poll_seconds,), daemon = True).start()
+
+    def latest_version(self):
+        versions = [int(name) for name in tf.io.gfile.listdir(self.model_dir)
+                    if name.strip('/').isdigit()]
+        if not versions:
+            raise FileNotFoundError("No model version found in {}".format(self.model_dir))
+        return max(versions)
+
+    def reload(self):
+        """load the latest version if it is newer than the one being served"""
+        version = self.latest_version()
+        if version == self.version:
+            return False
+        loaded = tf.saved_model.load(os.path.join(self.model_dir, str(version)))
+        with self._lock:
+            self._loaded, self._signatures, self.version = loaded, loaded.signatures, version
+        logging.info("Serving model version %s", version)
+        return True
+
+    def _poll(self, poll_seconds):
+        while True:
+            time.sleep(poll_seconds)
+            try:
+                self.reload()
+            except Exception:
+                #a version directory Pusher is still writing, try again next time
+                logging.exception("Model reload failed")
+
+    def predict(self, serialized_examples):
+        with self._lock:
+            signatures, version = self._signatures, self.version
+        outputs = signatures['serving_default'](examples = tf.constant(serialized_examples))['outputs']
+        return outputs.numpy(), version
+
+    def raw_input_specs(self):
+        """{raw feature name: TensorSpec} of the raw features signature"""
+        with self._lock:
+            signatures = self._signatures
+        return signatures[config.RAW_SIGNATURE_NAME].structured_input_signature[1]
+
+    def predict_columns(self, columns):
+        """predict {feature name: values} columns through the raw features signature"""
+        with self._lock:
+            signatures, version = self._signatures, self.version
+        signature = signatures[config.RAW_SIGNATURE_NAME]
+        input_specs = signature.structured_input_signature[1]
+        inputs = {key: tf.constant(columns[key], dtype = spec.dtype)
+                for key, spec in input_specs.items()}
+        return signature(**inputs)['outputs'].numpy(), version
+
+    def predict_raw(self, rows):
+        """predict {feature name: value} rows through the raw features signature"""
+        if not rows:
+            raise ValueError("No rows to predict")
+        columns = {key: [row[key] for row in rows] for key in rows[0]}
+        return self.predict_columns(columns)
+
+
+#malformed requests, answered with 400 (INVALID_ARGUMENT over grpc) instead of 500
+CLIENT_ERRORS = (KeyError, TypeError, ValueError, tf.errors.InvalidArgumentError)
+
+
+# %%
+class _Request:
+    __slots__ = ('examples', 'future')
+
+    def __init__(self, examples):
+        self.examples = examples
+        self.future = futures.Future()
+
+
+class MicroBatcher:
+    """Groups concurrent requests into batches for a pool of worker threads."""
+
+    def __init__(self, predict_fn, max_batch_size = config.INFERENCE_MAX_BATCH_SIZE,
+                max_wait_ms = config.INFERENCE_MAX_WAIT_MS,
+                num_workers = config.INFERENCE_NUM_WORKERS):
+        self._predict_fn = predict_fn
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        for _ in range(num_workers):
+            threading.Thread(target = self._work, daemon = True).start()
+
+    def submit(self, serialized_examples):
+        """returns a future of (predictions, model version)"""
+        request = _Request(serialized_examples)
+        self._queue.put(request)
+        return request.future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        num_examples = len(batch[0].examples)
+        deadline = time.monotonic() + self._max_wait
+        while num_examples < self._max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout = timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_examples += len(request.examples)
+        return batch
+
+    def _predict_one_by_one(self, batch):
+        """after a failed batch, so a bad request only fails itself"""
+        for request in batch:
+            try:
+                request.future.set_result(self._predict_fn(request.examples))
+            except Exception as error:
+                request.future.set_exception(error)
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            examples = [example for request in batch for example in request.examples]
+            try:
+                predictions, version = self._predict_fn(examples)
+            except Exception as error:
+                if len(batch) > 1:
+                    self._predict_one_by_one(batch)
+                else:
+                    batch[0].future.set_exception(error)
+                continue
+            offset = 0
+            for request in batch:
+                size = len(request.examples)
+                request.future.set_result((predictions[offset:offset + size], version))
+                offset += size
+
+
+# %%
+def columns_to_rows(columns):
+    """{feature name: values} columns into {feature name: value} rows"""
+    keys = list(columns)
+    return [dict(zip(keys, values)) for values in zip(*columns.values())]
+
+
+def _make_http_handler(batcher, raw_batcher, model_name):
+    predict_path = '/v1/models/{}:predict'.format(model_name)
+
+    class PredictHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            if self.path != predict_path:
+                self._send_json(404, {'error': 'unknown path {}'.format(self.path)})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if body.get('signature_name') == config.RAW_SIGNATURE_NAME:
+                    future = raw_batcher.submit(columns_to_rows(body['inputs']))
+                elif 'examples' in body:
+                    future = batcher.submit([base64.b64decode(example['b64'])
+                                            for example in body['examples']])
+                else:
+                    future = batcher.submit([instance_to_example(instance)
+                                            for instance in body['instances']])
+                predictions, version = future.result()
+            except CLIENT_ERRORS as error:
+                self._send_json(400, {'error': str(error)})
+                return
+            except Exception as error:
+                logging.exception("Prediction failed")
+                self._send_json(500, {'error': str(error)})
+                return
+            self._send_json(200, {'predictions': predictions.tolist(), 'model_version': version})
+
+        def log_message(self, format, *args):
+            #one log line per request would cost more than the prediction
+            pass
+
+    return PredictHandler
+
+
+class PredictionServicer(prediction_service_pb2_grpc.PredictionServiceServicer):
+    """TensorFlow Serving compatible Predict over the micro batcher"""
+
+    def __init__(self, batcher, raw_batcher, model_name):
+        self._batcher = batcher
+        self._raw_batcher = raw_batcher
+        self._model_name = model_name
+
+    def Predict(self, request, context):
+        try:
+            columns = {key: tf.make_ndarray(tensor).reshape(-1).tolist()
+                        for key, tensor in request.inputs.items()}
+            if request.model_spec.signature_name == config.RAW_SIGNATURE_NAME:
+                future = self._raw_batcher.submit(columns_to_rows(columns))
+            else:
+                future = self._batcher.submit(columns['examples'])
+            predictions, version = future.result()
+        except CLIENT_ERRORS as error:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        except Exception as error:
+            logging.exception("Prediction failed")
+            context.abort(grpc.StatusCode.INTERNAL, str(error))
+        response = predict_pb2.PredictResponse()
+        response.model_spec.name = self._model_name
+        response.model_spec.signature_name = request.model_spec.signature_name
+        response.model_spec.version.value = version
+        response.outputs['outputs'].CopyFrom(tf.make_tensor_proto(predictions))
+        return response
+
+
+# %%
+def serve(model_dir = config.SERVING_MODEL_DIR, model_name = config.INFERENCE_MODEL_NAME,
+        http_port = config.INFERENCE_HTTP_PORT, grpc_port = config.INFERENCE_GRPC_PORT,
+        max_batch_size = config.INFERENCE_MAX_BATCH_SIZE,
+        max_wait_ms = config.INFERENCE_MAX_WAIT_MS,
+        num_workers = config.INFERENCE_NUM_WORKERS,
+        poll_seconds = config.INFERENCE_POLL_SECONDS,
+        stats_export_dir = config.SERVING_STATS_DIR_PATH):
+    """stats_export_dir: where serving statistics go, None to not collect them"""
+    model_manager = ModelManager(model_dir, poll_seconds)
+    predict_fn, raw_predict_fn = model_manager.predict, model_manager.predict_raw
+    if stats_export_dir:
+        feature_dtypes = {key: spec.dtype for key, spec in model_manager.raw_input_specs().items()}
+        collector = ServingStatsCollector(feature_dtypes, export_dir = stats_export_dir)
+        predict_fn = collector.wrap(predict_fn, collector.observe_examples)
+        raw_predict_fn = collector.wrap(raw_predict_fn, collector.observe_rows)
+    batcher = MicroBatcher(predict_fn, max_batch_size, max_wait_ms, num_workers)
+    raw_batcher = MicroBatcher(raw_predict_fn, max_batch_size, max_wait_ms, num_workers)
+
+    grpc_server = grpc.server(futures.ThreadPoolExecutor(max_workers = 4 * max_batch_size))
+    prediction_service_pb2_grpc.add_PredictionServiceServicer_to_server(
+        PredictionServicer(batcher, raw_batcher, model_name), grpc_server)
+    grpc_server.add_insecure_port('[::]:{}'.format(grpc_port))
+    grpc_server.start()
+
+    http_server = ThreadingHTTPServer(('', http_port), _make_http_handler(batcher, raw_batcher, model_name))
+    logging.info("Serving %s on http port %s and grpc port %s", model_name, http_port, grpc_port)
+    try:
+        http_server.serve_forever()
+    finally:
+        grpc_server.stop(grace = None)
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-dir', default = config.SERVING_MODEL_DIR)
+    parser.add_argument('--http-port', type = int, default = config.INFERENCE_HTTP_PORT)
+    parser.add_argument('--grpc-port', type = int, default = config.INFERENCE_GRPC_PORT)
+    parser.add_argument('--max-batch-size', type = int, default = config.INFERENCE_MAX_BATCH_SIZE)
+    parser.add_argument('--max-wait-ms', type = float, default = config.INFERENCE_MAX_WAIT_MS)
+    parser.add_argument('--num-workers', type = int, default = config.INFERENCE_NUM_WORKERS)
+    parser.add_argument('--poll-seconds', type = float, default = config.INFERENCE_POLL_SECONDS)
+    parser.add_argument('--stats-export-dir', default = config.SERVING_STATS_DIR_PATH)
+    parser.add_argument('--no-serving-stats', action = 'store_true')
+    args = parser.parse_args()
+
+    logging.set_verbosity(logging.INFO)
+    serve(model_dir = args.model_dir, http_port = args.http_port, grpc_port = args.grpc_port,
+        max_batch_size = args.max_batch_size, max_wait_ms = args.max_wait_ms,
+        num_workers = args.num_workers, poll_seconds = args.poll_seconds,
+        stats_export_dir = None if args.no_serving_stats else args.stats_export_dir)
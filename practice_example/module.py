@@ -1,135 +1,58 @@
 import os
+import tempfile
+import time
 
-from typing import Union
+from absl import logging
 
 import tensorflow as tf
 import tensorflow_hub as hub
 import tensorflow_transform as tft
 
-
-LABEL_KEY = "consumer_disputed"
-
-################
-# Transform code
-################
-
-# feature name, feature dimensionality
-ONE_HOT_FEATURES = {
-    "product": 11,
-    "sub_product": 45,
-    "company_response": 5,
-    "state": 60,
-    "issue": 90,
+from consumer_complaint.config import config
+from practice_example import (
+    compact_model,
+    distributed,
+    embedding_cache,
+    tfhub_store,
+)
+
+# the feature spec and preprocessing_fn are shared with data_preprocessing.py,
+# Transform picks preprocessing_fn up from this module
+from practice_example.features import (  # noqa: F401
+    LABEL_KEY,
+    SERVING_FEATURES,
+    TEXT_FEATURES,
+    load_feature_config,
+    preprocessing_fn,
+    transformed_name,
+    wide_inputs,
+)
+
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# input pipeline settings per dataset, see _input_fn_kwargs
+INPUT_DEFAULTS = {
+    "train": {
+        "batch_size": 64,
+        "num_parallel_reads": AUTOTUNE,
+        "shuffle_buffer_size": 10000,
+        "cache": None,
+    },
+    "eval": {
+        "batch_size": 64,
+        "num_parallel_reads": AUTOTUNE,
+        "shuffle_buffer_size": 0,
+        "cache": None,
+    },
 }
 
-# feature name, bucket count
-BUCKET_FEATURES = {"zip_code": 10}
-
-# feature name, value is unused
-TEXT_FEATURES = {"consumer_complaint_narrative": None}
-
-
-os.environ["TFHUB_CACHE_DIR"] = 'tmp/tfhub'
-
-
-def transformed_name(key: str) -> str:
-    return key + "_xf"
 
+os.environ["TFHUB_CACHE_DIR"] = config.TFHUB_MODULE_STORE_PATH
 
-def fill_in_missing(x: Union[tf.Tensor, tf.SparseTensor]) -> tf.Tensor:
-    """Replace missing values in a SparseTensor.
 
-    Fills in missing values of `x` with '' or 0, and converts to a
-    dense tensor.
-
-    Args:
-      x: A `SparseTensor` of rank 2.  Its dense shape should have
-        size at most 1 in the second dimension.
-
-    Returns:
-      A rank 1 tensor where missing values of `x` have been filled in.
-    """
-    if isinstance(x, tf.sparse.SparseTensor):
-        default_value = "" if x.dtype == tf.string else 0
-        x = tf.sparse.to_dense(
-            tf.SparseTensor(x.indices, x.values, [x.dense_shape[0], 1]),
-            default_value,
-        )
-    return tf.squeeze(x, axis=1)
-
-
-def convert_num_to_one_hot(
-    label_tensor: tf.Tensor, num_labels: int = 2
-) -> tf.Tensor:
-    """
-    Convert a label (0 or 1) into a one-hot vector
-    Args:
-        int: label_tensor (0 or 1)
-    Returns
-        label tensor
-    """
-    one_hot_tensor = tf.one_hot(label_tensor, num_labels)
-    return tf.reshape(one_hot_tensor, [-1, num_labels])
-
-
-def convert_zip_code(zipcode: str) -> tf.float32:
-    """
-    Convert a zipcode string to int64 representation. In the dataset the
-    zipcodes are anonymized by repacing the last 3 digits to XXX. We are
-    replacing those characters to 000 to simplify the bucketing later on.
-
-    Args:
-        str: zipcode
-    Returns:
-        zipcode: int64
-    """
-    if zipcode == "":
-        zipcode = "00000"
-    zipcode = tf.strings.regex_replace(zipcode, r"X{0,5}", "0")
-    zipcode = tf.strings.to_number(zipcode, out_type=tf.float32)
-    return zipcode
-
-
-def preprocessing_fn(inputs: tf.Tensor) -> tf.Tensor:
-    """tf.transform's callback function for preprocessing inputs.
-
-    Args:
-      inputs: map from feature keys to raw not-yet-transformed features.
-
-    Returns:
-      Map from string feature key to transformed feature operations.
-    """
-    outputs = {}
-
-    for key in ONE_HOT_FEATURES.keys():
-        dim = ONE_HOT_FEATURES[key]
-        int_value = tft.compute_and_apply_vocabulary(
-            fill_in_missing(inputs[key]), top_k=dim + 1
-        )
-        outputs[transformed_name(key)] = convert_num_to_one_hot(
-            int_value, num_labels=dim + 1
-        )
-
-    for key, bucket_count in BUCKET_FEATURES.items():
-
-        dense_feature = fill_in_missing(inputs[key])
-        if key == "zip_code" and dense_feature.dtype == tf.string:
-            dense_feature = convert_zip_code(dense_feature)
-        else:
-            dense_feature = tf.cast(dense_feature, tf.float32)
-
-        temp_feature = tft.bucketize(dense_feature, bucket_count,
-                                     always_return_num_quantiles=False)
-        outputs[transformed_name(key)] = convert_num_to_one_hot(
-            temp_feature, num_labels=bucket_count + 1
-        )
-
-    for key in TEXT_FEATURES.keys():
-        outputs[transformed_name(key)] = fill_in_missing(inputs[key])
-
-    outputs[transformed_name(LABEL_KEY)] = fill_in_missing(inputs[LABEL_KEY])
-
-    return outputs
+def embedding_name(key: str) -> str:
+    return transformed_name(key) + "_embedding"
 
 
 ################
@@ -137,49 +60,60 @@ def preprocessing_fn(inputs: tf.Tensor) -> tf.Tensor:
 ################
 
 
-def get_model(show_summary: bool = True) -> tf.keras.models.Model:
+def get_model(
+    show_summary: bool = True,
+    precomputed_embeddings: bool = False,
+    feature_config: dict = None,
+) -> tf.keras.models.Model:
     """
     This function defines a Keras model and returns the model as a Keras object.
-    """
 
-    # one-hot categorical features
-    input_features = []
-    for key, dim in ONE_HOT_FEATURES.items():
-        input_features.append(
-            tf.keras.Input(shape=(dim + 1,), name=transformed_name(key))
-        )
+    With precomputed_embeddings the narrative input is the 512-d sentence
+    embedding read from the embedding cache instead of the raw text. The
+    encoder is then kept on the model as `text_encoder` for serving.
+    The encoder comes from the local module store and is loaded once per
+    process; the time spent loading it and building the graph is logged.
+    feature_config sets the widths of the categorical inputs, see
+    features.wide_inputs.
+    """
+    start = time.perf_counter()
+    encoder = tfhub_store.load_module(config.USE_MODULE_URL)
+    module_load_seconds = time.perf_counter() - start
 
-    # adding bucketized features
-    for key, dim in BUCKET_FEATURES.items():
-        input_features.append(
-            tf.keras.Input(shape=(dim + 1,), name=transformed_name(key))
-        )
+    # categorical and bucketized features, one-hots or ids
+    input_features, wide = wide_inputs(16, feature_config)
 
     # adding text input features
     input_texts = []
     for key in TEXT_FEATURES.keys():
-        input_texts.append(
-            tf.keras.Input(
-                shape=(1,), name=transformed_name(key), dtype=tf.string
+        if precomputed_embeddings:
+            input_texts.append(
+                tf.keras.Input(
+                    shape=(config.EMBEDDING_DIM,), name=embedding_name(key)
+                )
+            )
+        else:
+            input_texts.append(
+                tf.keras.Input(
+                    shape=(1,), name=transformed_name(key), dtype=tf.string
+                )
             )
-        )
 
     # embed text features
-    MODULE_URL = "https://tfhub.dev/google/universal-sentence-encoder/4"
-    embed = hub.KerasLayer(MODULE_URL)
-    reshaped_narrative = tf.reshape(input_texts[0], [-1])
-    embed_narrative = embed(reshaped_narrative)
-    deep_ff = tf.keras.layers.Reshape((512,), input_shape=(1, 512))(
-        embed_narrative
-    )
+    embed = hub.KerasLayer(encoder)
+    if precomputed_embeddings:
+        deep_ff = input_texts[0]
+    else:
+        reshaped_narrative = tf.reshape(input_texts[0], [-1])
+        embed_narrative = embed(reshaped_narrative)
+        deep_ff = tf.keras.layers.Reshape((512,), input_shape=(1, 512))(
+            embed_narrative
+        )
 
     deep = tf.keras.layers.Dense(256, activation="relu")(deep_ff)
     deep = tf.keras.layers.Dense(64, activation="relu")(deep)
     deep = tf.keras.layers.Dense(16, activation="relu")(deep)
 
-    wide_ff = tf.keras.layers.concatenate(input_features)
-    wide = tf.keras.layers.Dense(16, activation="relu")(wide_ff)
-
     both = tf.keras.layers.concatenate([deep, wide])
 
     output = tf.keras.layers.Dense(1, activation="sigmoid")(both)
@@ -196,6 +130,13 @@ def get_model(show_summary: bool = True) -> tf.keras.models.Model:
             tf.keras.metrics.AUC(), #adding the AUC metric to the book repo's code
         ],
     )
+    if precomputed_embeddings:
+        keras_model.text_encoder = embed
+    logging.info(
+        "get_model startup: module load %.2fs, graph build %.2fs",
+        module_load_seconds,
+        time.perf_counter() - start - module_load_seconds,
+    )
     if show_summary:
         keras_model.summary()
 
@@ -203,11 +144,44 @@ def get_model(show_summary: bool = True) -> tf.keras.models.Model:
 
 
 def _gzip_reader_fn(filenames):
-    """Small utility returning a record reader that can read gzip'ed files."""
-    return tf.data.TFRecordDataset(filenames, compression_type="GZIP")
+    """Small utility returning a record reader that can read gzip'ed files.
+
+    When given several shards, they are read in parallel.
+    """
+    return tf.data.TFRecordDataset(
+        filenames,
+        compression_type="GZIP",
+        num_parallel_reads=AUTOTUNE,
+    )
 
 
-def _get_serve_tf_examples_fn(model, tf_transform_output):
+def _embed_texts(features, encode_fn):
+    """Replaces the transformed narratives with their sentence embeddings."""
+    for key in TEXT_FEATURES.keys():
+        texts = tf.reshape(features.pop(transformed_name(key)), [-1])
+        features[embedding_name(key)] = encode_fn(texts)
+    return features
+
+
+def _predict_raw_features(model, raw_features, precomputed_embeddings):
+    """Transforms the raw features and runs the model on them."""
+    transformed_features = model.tft_layer(raw_features)
+    if precomputed_embeddings:
+        # the cache holds the embeddings of the normalized narratives
+        transformed_features = _embed_texts(
+            transformed_features,
+            lambda texts: model.text_encoder(
+                embedding_cache.normalize_texts(texts)
+            ),
+        )
+
+    outputs = model(transformed_features)
+    return {"outputs": outputs}
+
+
+def _get_serve_tf_examples_fn(
+    model, tf_transform_output, precomputed_embeddings=False
+):
     """Returns a function that parses a serialized tf.Example."""
 
     model.tft_layer = tf_transform_output.transform_features_layer()
@@ -221,15 +195,94 @@ def _get_serve_tf_examples_fn(model, tf_transform_output):
             serialized_tf_examples, feature_spec
         )
 
-        transformed_features = model.tft_layer(parsed_features)
-
-        outputs = model(transformed_features)
-        return {"outputs": outputs}
+        return _predict_raw_features(
+            model, parsed_features, precomputed_embeddings
+        )
 
     return serve_tf_examples_fn
 
 
-def _input_fn(file_pattern, tf_transform_output, batch_size=64):
+def _get_serve_raw_features_fn(
+    model, tf_transform_output, precomputed_embeddings=False
+):
+    """Returns a function that takes the raw features as named dense tensors.
+
+    Clients send one rank 1 tensor per feature in SERVING_FEATURES, so they
+    neither build tf.Examples nor does the server parse them again.
+    Empty strings and zeros count as missing values, like in fill_in_missing.
+    """
+    if not hasattr(model, "tft_layer"):
+        model.tft_layer = tf_transform_output.transform_features_layer()
+    feature_spec = tf_transform_output.raw_feature_spec()
+
+    @tf.function
+    def serve_raw_features_fn(**raw_features):
+        """Returns the output to be used in the raw features signature."""
+        features = {}
+        for key, value in raw_features.items():
+            if isinstance(feature_spec[key], tf.io.VarLenFeature):
+                features[key] = tf.sparse.from_dense(
+                    tf.reshape(value, [-1, 1])
+                )
+            else:
+                features[key] = value
+        return _predict_raw_features(model, features, precomputed_embeddings)
+
+    return serve_raw_features_fn
+
+
+def _raw_features_input_specs(tf_transform_output):
+    """Named TensorSpecs of the raw features signature."""
+    feature_spec = tf_transform_output.raw_feature_spec()
+    return {
+        key: tf.TensorSpec(
+            shape=[None], dtype=feature_spec[key].dtype, name=key
+        )
+        for key in SERVING_FEATURES
+    }
+
+
+def _serving_signatures(
+    model, tf_transform_output, precomputed_embeddings=False
+):
+    """The tf.Example and the raw features signatures of the exported model."""
+    return {
+        "serving_default": _get_serve_tf_examples_fn(
+            model, tf_transform_output, precomputed_embeddings
+        ).get_concrete_function(
+            tf.TensorSpec(shape=[None], dtype=tf.string, name="examples")
+        ),
+        config.RAW_SIGNATURE_NAME: _get_serve_raw_features_fn(
+            model, tf_transform_output, precomputed_embeddings
+        ).get_concrete_function(
+            **_raw_features_input_specs(tf_transform_output)
+        ),
+    }
+
+
+def _cached_encode_fn(cache_dir):
+    """Returns a function looking narratives up in the embedding cache."""
+    cache = embedding_cache.EmbeddingCache(cache_dir)
+
+    def encode_fn(texts):
+        embeddings = tf.numpy_function(cache.lookup, [texts], tf.float32)
+        embeddings.set_shape([None, cache.embedding_dim])
+        return embeddings
+
+    return encode_fn
+
+
+def _input_fn(
+    file_pattern,
+    tf_transform_output,
+    batch_size=64,
+    embedding_cache_dir=None,
+    num_parallel_reads=AUTOTUNE,
+    shuffle_buffer_size=10000,
+    cache=None,
+    input_context=None,
+    steps=None,
+):
     """Generates features and label for tuning/training.
 
     Args:
@@ -237,6 +290,18 @@ def _input_fn(file_pattern, tf_transform_output, batch_size=64):
     tf_transform_output: A TFTransformOutput.
     batch_size: representing the number of consecutive elements of returned
       dataset to combine in a single batch
+    embedding_cache_dir: when set, narratives are replaced by their cached
+      sentence embeddings, for models built with precomputed_embeddings
+    num_parallel_reads: number of transformed shards read interleaved.
+    shuffle_buffer_size: records shuffled before batching, 0 disables it.
+    cache: None, "memory" to cache the parsed batches in memory, or a file
+      path to cache them on disk. The order is fixed after the first pass,
+      so this is meant for the eval set.
+    steps: batches read per pass, e.g. fn_args.eval_steps. With cache set,
+      only the first steps batches are cached, so the cache is complete
+      even when steps stops short of the end of the files.
+    input_context: a tf.distribute.InputContext. Each worker then reads its
+      own slice of the shards, with a per replica batch size.
 
       Returns:
         A dataset that contains (features, indices) tuple where features is a
@@ -246,54 +311,276 @@ def _input_fn(file_pattern, tf_transform_output, batch_size=64):
     transformed_feature_spec = (
         tf_transform_output.transformed_feature_spec().copy()
     )
+    label_key = transformed_name(LABEL_KEY)
 
-    dataset = tf.data.experimental.make_batched_features_dataset(
-        file_pattern=file_pattern,
-        batch_size=batch_size,
-        features=transformed_feature_spec,
-        reader=_gzip_reader_fn,
-        label_key=transformed_name(LABEL_KEY),
+    def parse_batch(serialized_examples):
+        # parsing after batching runs one vectorized parse per batch
+        features = tf.io.parse_example(
+            serialized_examples, transformed_feature_spec
+        )
+        return features, features.pop(label_key)
+
+    patterns = file_pattern
+    if isinstance(file_pattern, str):
+        patterns = [file_pattern]
+    filenames = sorted(
+        filename
+        for pattern in patterns
+        for filename in tf.io.gfile.glob(pattern)
+    )
+    shard_records = False
+    if input_context:
+        batch_size = input_context.get_per_replica_batch_size(batch_size)
+        num_shards = input_context.num_input_pipelines
+        shard_index = input_context.input_pipeline_id
+        # shard by file, or by record when there are fewer files than workers
+        shard_records = len(filenames) < num_shards
+        if not shard_records:
+            filenames = filenames[shard_index::num_shards]
+
+    # sharding by record needs the same record order on every worker, so
+    # the files are then neither shuffled nor interleaved nondeterministically,
+    # the records are only shuffled after sharding
+    files = tf.data.Dataset.from_tensor_slices(filenames)
+    if shuffle_buffer_size and not shard_records:
+        files = files.shuffle(len(filenames))
+    dataset = files.interleave(
+        _gzip_reader_fn,
+        cycle_length=num_parallel_reads,
+        num_parallel_calls=AUTOTUNE,
+        deterministic=shuffle_buffer_size == 0 or shard_records,
+    )
+    if shard_records:
+        dataset = dataset.shard(num_shards, shard_index)
+    if shuffle_buffer_size:
+        dataset = dataset.shuffle(shuffle_buffer_size)
+    dataset = dataset.batch(batch_size).map(
+        parse_batch, num_parallel_calls=AUTOTUNE
     )
 
-    return dataset
+    if embedding_cache_dir:
+        encode_fn = _cached_encode_fn(embedding_cache_dir)
+        dataset = dataset.map(
+            lambda features, label: (_embed_texts(features, encode_fn), label),
+            num_parallel_calls=AUTOTUNE,
+        )
 
+    # a cache is only written once a pass reaches the end of its input
+    if cache and steps:
+        dataset = dataset.take(steps)
+    if cache == "memory":
+        dataset = dataset.cache()
+    elif cache:
+        dataset = dataset.cache(cache)
+
+    return dataset.repeat().prefetch(AUTOTUNE)
+
+
+def _input_fn_kwargs(custom_config, prefix):
+    """Input pipeline settings for the "train" or "eval" dataset.
+
+    Every key of INPUT_DEFAULTS can be overridden through custom_config,
+    either for both datasets or per dataset as e.g. "eval_batch_size".
+    """
+    kwargs = {}
+    for key, default in INPUT_DEFAULTS[prefix].items():
+        kwargs[key] = custom_config.get(
+            "{}_{}".format(prefix, key), custom_config.get(key, default)
+        )
+    return kwargs
+
+
+def _fit_with_coordinator(strategy, model, dataset_fn, steps):
+    """Custom training loop for parameter server training.
+
+    Keras model.fit does not support ParameterServerStrategy on
+    tensorflow 2.4, so the chief schedules the steps on the workers.
+    """
+    coordinator = tf.distribute.experimental.coordinator.ClusterCoordinator(
+        strategy
+    )
+    per_worker_dataset = coordinator.create_per_worker_dataset(dataset_fn)
+    per_worker_iterator = iter(per_worker_dataset)
+
+    @tf.function
+    def train_step(iterator):
+        def step_fn(features, labels):
+            with tf.GradientTape() as tape:
+                predictions = model(features, training=True)
+                labels = tf.reshape(tf.cast(labels, tf.float32), [-1, 1])
+                loss = tf.nn.compute_average_loss(
+                    tf.keras.losses.binary_crossentropy(labels, predictions)
+                )
+            gradients = tape.gradient(loss, model.trainable_variables)
+            model.optimizer.apply_gradients(
+                zip(gradients, model.trainable_variables)
+            )
+            return loss
+
+        return strategy.run(step_fn, args=next(iterator))
+
+    for _ in range(steps):
+        coordinator.schedule(train_step, args=(per_worker_iterator,))
+    coordinator.join()
 
-# TFX Trainer will call this function.
-def run_fn(fn_args):
-    """Train the model based on given args.
+
+def _train_and_export(fn_args):
+    """Trains the model and exports it, on the cluster given by TF_CONFIG.
 
     Args:
     fn_args: Holds args used to train the model as name/value pairs.
     """
     tf_transform_output = tft.TFTransformOutput(fn_args.transform_output)
+    # the vocabulary sizes the transform graph was built with
+    feature_config = load_feature_config(fn_args.transform_output)
+    custom_config = fn_args.custom_config or {}
+    # the pre-embedding stage (embedding_cache.py) has to run before training
+    embedding_cache_dir = custom_config.get("embedding_cache_dir")
+    precomputed_embeddings = bool(embedding_cache_dir)
+    distribution = custom_config.get("distribution")
+    # the compact model is distilled from the full model given as base_model
+    compact = bool(custom_config.get("compact_model"))
+    if compact and precomputed_embeddings:
+        raise ValueError(
+            "The compact model reads the narratives, it can't be trained on "
+            "precomputed embeddings"
+        )
+    if compact and distribution == distributed.PARAMETER_SERVER:
+        raise ValueError(
+            "The compact model is distilled with model.fit, which does not "
+            "support parameter server training"
+        )
+    if precomputed_embeddings and distribution == distributed.PARAMETER_SERVER:
+        raise ValueError(
+            "The cached embeddings are looked up with tf.numpy_function, which "
+            "can't run on the workers of parameter server training"
+        )
+    strategy = distributed.build_strategy(distribution)
+
+    def dataset_fn(file_pattern, split, steps):
+        def make_dataset(input_context=None):
+            return _input_fn(
+                file_pattern,
+                tf_transform_output,
+                embedding_cache_dir=embedding_cache_dir,
+                input_context=input_context,
+                steps=steps,
+                **_input_fn_kwargs(custom_config, split),
+            )
+
+        return make_dataset
+
+    with strategy.scope():
+        if compact:
+            model = compact_model.get_distiller(
+                fn_args.base_model, custom_config, feature_config
+            )
+        else:
+            model = get_model(
+                precomputed_embeddings=precomputed_embeddings,
+                feature_config=feature_config,
+            )
 
-    train_dataset = _input_fn(fn_args.train_files, tf_transform_output, 64)
-    eval_dataset = _input_fn(fn_args.eval_files, tf_transform_output, 64)
+    if distribution == distributed.PARAMETER_SERVER:
+        _fit_with_coordinator(
+            strategy,
+            model,
+            dataset_fn(fn_args.train_files, "train", fn_args.train_steps),
+            fn_args.train_steps,
+        )
+    else:
+        train_dataset_fn = dataset_fn(
+            fn_args.train_files, "train", fn_args.train_steps
+        )
+        eval_dataset_fn = dataset_fn(
+            fn_args.eval_files, "eval", fn_args.eval_steps
+        )
+        if distribution:
+            train_dataset = strategy.distribute_datasets_from_function(
+                train_dataset_fn
+            )
+            eval_dataset = strategy.distribute_datasets_from_function(
+                eval_dataset_fn
+            )
+        else:
+            train_dataset, eval_dataset = train_dataset_fn(), eval_dataset_fn()
+
+        callbacks = []
+        if distributed.is_chief():
+            log_dir = os.path.join(
+                os.path.dirname(fn_args.serving_model_dir), "logs"
+            )
+            callbacks.append(
+                tf.keras.callbacks.TensorBoard(
+                    log_dir=log_dir, update_freq="batch"
+                )
+            )
 
-    model = get_model()
+        model.fit(
+            train_dataset,
+            epochs=1,
+            steps_per_epoch=fn_args.train_steps,
+            validation_data=eval_dataset,
+            validation_steps=fn_args.eval_steps,
+            callbacks=callbacks,
+        )
 
-    log_dir = os.path.join(os.path.dirname(fn_args.serving_model_dir), "logs")
-    tensorboard_callback = tf.keras.callbacks.TensorBoard(
-        log_dir=log_dir, update_freq="batch"
+    if compact:
+        model = model.student
+    signatures = _serving_signatures(
+        model, tf_transform_output, precomputed_embeddings
     )
-    callbacks = [tensorboard_callback]
-
-    model.fit(
-        train_dataset,
-        epochs=1,
-        steps_per_epoch=fn_args.train_steps,
-        validation_data=eval_dataset,
-        validation_steps=fn_args.eval_steps,
-        callbacks=callbacks,
+    if compact:
+        signatures[
+            config.COMPACT_SIGNATURE_NAME
+        ] = compact_model.transformed_signature(model)
+    # every worker takes part in saving, only the chief writes the real model
+    serving_model_dir = fn_args.serving_model_dir
+    if not distributed.is_chief():
+        serving_model_dir = tempfile.mkdtemp()
+    model.save(serving_model_dir, save_format="tf", signatures=signatures)
+    if not distributed.is_chief():
+        tf.io.gfile.rmtree(serving_model_dir)
+        return
+    quantization = custom_config.get(
+        "compact_quantization", config.COMPACT_QUANTIZATION
     )
+    if compact and quantization:
+        compact_model.export_tflite(model, serving_model_dir, quantization)
 
-    signatures = {
-        "serving_default": _get_serve_tf_examples_fn(
-            model, tf_transform_output
-        ).get_concrete_function(
-            tf.TensorSpec(shape=[None], dtype=tf.string, name="examples")
-        ),
-    }
-    model.save(
-        fn_args.serving_model_dir, save_format="tf", signatures=signatures
-    )
+
+# TFX Trainer will call this function.
+def run_fn(fn_args):
+    """Train the model based on given args.
+
+    With custom_config["distribution"] set and no TF_CONFIG in the
+    environment, training runs on a cluster of local processes, see
+    distributed.py. With TF_CONFIG set, the worker and ps tasks of
+    parameter server training run a server for the chief instead. With
+    custom_config["compact_model"] set, the compact model of
+    compact_model.py is distilled from fn_args.base_model.
+
+    Args:
+    fn_args: Holds args used to train the model as name/value pairs.
+    """
+    custom_config = fn_args.custom_config or {}
+    distribution = custom_config.get("distribution")
+    if (
+        distribution == distributed.PARAMETER_SERVER
+        and distributed.task_info()[0] in ("worker", "ps")
+    ):
+        # with TF_CONFIG set on every host, only the chief trains, the
+        # workers and parameter servers serve it
+        distributed._run_server()
+    elif distribution and "TF_CONFIG" not in os.environ:
+        num_ps = 0
+        if distribution == distributed.PARAMETER_SERVER:
+            num_ps = custom_config.get("num_ps", 1)
+        distributed.run_local_cluster(
+            "practice_example.module._train_and_export",
+            distributed.fn_args_to_dict(fn_args),
+            custom_config.get("num_workers", 1),
+            num_ps,
+        )
+    else:
+        _train_and_export(fn_args)
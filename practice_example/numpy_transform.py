@@ -0,0 +1,187 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Vectorized NumPy/pandas version of features.preprocessing_fn.
+It applies the vocabularies and zip_code buckets of a finished Transform run
+to a DataFrame of raw rows without a Beam job, for batch scoring and for
+parity checks against tf.Transform.
+"""
+
+# %%
+import os
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from practice_example.features import (
+    LABEL_KEY,
+    CATEGORICAL_ENCODING,
+    ONE_HOT_FEATURES,
+    BUCKET_FEATURES,
+    TEXT_FEATURES,
+    categorical_num_ids,
+    transformed_name
+)
+from practice_example import features
+
+#zip codes are 5 digits, so every possible value can be probed
+ZIP_CODE_RANGE = 100000
+
+
+# %%
+def _to_raw_features(columns, feature_spec):
+    """{feature name: values} into the dense or sparse tensors tft expects"""
+    raw_features = {}
+    for key, values in columns.items():
+        tensor = tf.constant(values, dtype = feature_spec[key].dtype)
+        if isinstance(feature_spec[key], tf.io.VarLenFeature):
+            tensor = tf.sparse.from_dense(tf.reshape(tensor, [-1, 1]))
+        raw_features[key] = tensor
+    return raw_features
+
+
+def _probe_buckets(tf_transform_output, key):
+    """
+    tft.bucketize keeps its quantile boundaries inside the transform graph,
+    so they are recovered by transforming every possible zip code once.
+    Returns the zip codes where a bucket starts and the bucket ids.
+    """
+    feature_spec = tf_transform_output.raw_feature_spec()
+    zip_codes = np.arange(ZIP_CODE_RANGE)
+    columns = {name: ['x'] * ZIP_CODE_RANGE if spec.dtype == tf.string else [1] * ZIP_CODE_RANGE
+                for name, spec in feature_spec.items()}
+    columns[key] = (['{:05d}'.format(zip_code) for zip_code in zip_codes]
+                    if feature_spec[key].dtype == tf.string else zip_codes)
+    transformed = tf_transform_output.transform_raw_features(
+        _to_raw_features(columns, feature_spec))
+    bucket_ids = transformed[transformed_name(key)].numpy()
+    if bucket_ids.ndim == 2:
+        bucket_ids = np.argmax(bucket_ids, axis = 1)
+    starts = np.flatnonzero(np.diff(bucket_ids, prepend = -1))
+    return zip_codes[starts].astype(np.float32), bucket_ids[starts]
+
+
+def load_transform_params(tf_transform_output):
+    """vocabularies, bucket boundaries and feature config of a TFTransformOutput"""
+    feature_config = features.load_feature_config(
+        os.path.dirname(tf_transform_output.transform_savedmodel_dir.rstrip('/')))
+    if features.TRANSFORM_ANALYZERS == 'fused':
+        shared_vocabulary = [value.decode('utf-8') for value in
+                            tf_transform_output.vocabulary_by_name(features.SHARED_VOCABULARY_NAME)]
+        vocabularies = {key: features.shared_vocabulary_values(shared_vocabulary, key, feature_config)
+                        for key in ONE_HOT_FEATURES}
+    else:
+        vocabularies = {key: [value.decode('utf-8') for value in tf_transform_output.vocabulary_by_name(key)]
+                        for key in ONE_HOT_FEATURES}
+    buckets = {key: _probe_buckets(tf_transform_output, key) for key in BUCKET_FEATURES}
+    return {'vocabularies': vocabularies, 'buckets': buckets, 'feature_config': feature_config}
+
+
+# %%
+def _one_hot(indices, depth):
+    """like tf.one_hot, out of vocabulary (-1) becomes an all zero row"""
+    one_hot = np.zeros((len(indices), depth), dtype = np.float32)
+    rows = np.flatnonzero(indices >= 0)
+    one_hot[rows, indices[rows]] = 1.0
+    return one_hot
+
+
+def convert_zip_code(zip_codes):
+    """same as features.convert_zip_code on a pandas Series"""
+    if zip_codes.dtype != object:
+        return zip_codes.fillna(0).to_numpy(dtype = np.float32)
+    zip_codes = zip_codes.fillna('').astype(str).replace('', '00000')
+    return zip_codes.str.replace('X', '0', regex = False).to_numpy(dtype = np.float32)
+
+
+def _vocabulary_ids(values, vocabulary, num_oov_buckets):
+    """
+    like tft.apply_vocabulary, out of vocabulary values are hashed into the
+    ids after the vocabulary, or become -1 without oov buckets
+    """
+    indices = pd.Categorical(values, categories = vocabulary).codes.astype(np.int64)
+    oov = indices < 0
+    if num_oov_buckets and oov.any():
+        #the same fast hash tf.lookup.StaticVocabularyTable uses
+        indices[oov] = len(vocabulary) + tf.strings.to_hash_bucket_fast(
+            values[oov].to_numpy(dtype = object), num_oov_buckets).numpy()
+    return indices
+
+
+def transform_df(data, params):
+    """
+    Transform a DataFrame of raw rows like preprocessing_fn does.
+    Returns {transformed name: numpy array}
+    """
+    ids = CATEGORICAL_ENCODING == 'ids'
+    feature_config = params.get('feature_config')
+    outputs = {}
+    for key in ONE_HOT_FEATURES:
+        values = data[key].fillna('').astype(str)
+        indices = _vocabulary_ids(values, params['vocabularies'][key], features.oov_buckets(feature_config))
+        if ids:
+            outputs[transformed_name(key)] = indices
+        else:
+            outputs[transformed_name(key)] = _one_hot(indices, categorical_num_ids(key, feature_config))
+
+    for key, bucket_count in BUCKET_FEATURES.items():
+        starts, bucket_ids = params['buckets'][key]
+        values = convert_zip_code(data[key])
+        positions = np.maximum(np.searchsorted(starts, values, side = 'right') - 1, 0)
+        if ids:
+            outputs[transformed_name(key)] = bucket_ids[positions].astype(np.int64)
+        else:
+            outputs[transformed_name(key)] = _one_hot(bucket_ids[positions], bucket_count + 1)
+
+    for key in TEXT_FEATURES:
+        outputs[transformed_name(key)] = data[key].fillna('').astype(str).to_numpy(dtype = object)
+
+    if LABEL_KEY in data:
+        outputs[transformed_name(LABEL_KEY)] = data[LABEL_KEY].fillna(0).to_numpy()
+    return outputs
+
+
+# %%
+def parity_report(data, tf_transform_output, params = None):
+    """
+    Transform the same rows with tft and with transform_df.
+    Returns {transformed name: max absolute difference}, text features
+    count the rows that differ.
+    """
+    params = params or load_transform_params(tf_transform_output)
+    return _difference_report(_tft_transform_df(data, tf_transform_output), transform_df(data, params))
+
+
+def analyzers_parity_report(data, tf_transform_output, other_tf_transform_output):
+    """
+    Transform the same rows with two transform graphs, e.g. the ones of
+    per_feature and of fused analyzers (config.TRANSFORM_ANALYZERS) over the
+    same data. Returns {transformed name: difference} like parity_report.
+    """
+    return _difference_report(_tft_transform_df(data, tf_transform_output),
+                            _tft_transform_df(data, other_tf_transform_output))
+
+
+def _tft_transform_df(data, tf_transform_output):
+    """tft's {transformed name: numpy array}, strings decoded like transform_df's"""
+    feature_spec = tf_transform_output.raw_feature_spec()
+    columns = {key: data[key].fillna('' if spec.dtype == tf.string else 0).tolist()
+                for key, spec in feature_spec.items() if key in data}
+    transformed = tf_transform_output.transform_raw_features(_to_raw_features(columns, feature_spec))
+    outputs = {}
+    for name, values in transformed.items():
+        values = values.numpy()
+        if values.dtype == object:
+            values = np.array([value.decode('utf-8') for value in values], dtype = object)
+        outputs[name] = values
+    return outputs
+
+
+def _difference_report(expected, actual):
+    """text features count the rows that differ, the others the max absolute difference"""
+    report = {}
+    for name, values in actual.items():
+        if values.dtype == object:
+            report[name] = int((expected[name] != values).sum())
+        else:
+            report[name] = float(np.abs(expected[name].astype(np.float64) - values).max(initial = 0.0))
+    return report
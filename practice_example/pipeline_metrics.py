@@ -0,0 +1,293 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Per component timing and resource usage of a TFX pipeline run.
+run_instrumented wraps the executor of every component and records, for each
+execution:
+    wall and cpu seconds (cpu includes reaped child processes, e.g. the beam
+    multi_processing workers)
+    peak rss of this process and its child processes while the component ran
+    bytes of the input and output artifacts
+into a component_metrics table next to the MLMD tables in metadata.sqlite.
+Components the run took from the cache never reach their executor and are
+recorded with status 'cached' and no measurements.
+
+    python -m practice_example.pipeline_metrics report [--run-id RUN_ID]
+    python -m practice_example.pipeline_metrics diff RUN_ID RUN_ID
+
+The report commands only read sqlite, tensorflow and tfx are imported by
+the functions recording the metrics.
+"""
+
+# %%
+import argparse
+import os
+import resource
+import sqlite3
+import threading
+import time
+from absl import logging
+from consumer_complaint.config import config
+
+METRICS_TABLE = 'component_metrics'
+COMPLETE, FAILED, CACHED = 'complete', 'failed', 'cached'
+METRIC_COLUMNS = ('wall_seconds', 'cpu_seconds', 'peak_rss_bytes', 'bytes_read', 'bytes_written')
+RSS_SAMPLE_SECONDS = 0.2
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+# %%
+def connect(metadata_path = config.METADATA_PATH):
+    connection = sqlite3.connect(metadata_path)
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS {} ('
+        'run_id TEXT, component_id TEXT, status TEXT, started_at REAL, '
+        'wall_seconds REAL, cpu_seconds REAL, peak_rss_bytes INTEGER, '
+        'bytes_read INTEGER, bytes_written INTEGER)'.format(METRICS_TABLE))
+    return connection
+
+
+def _insert(metadata_path, row):
+    with connect(metadata_path) as connection:
+        connection.execute('INSERT INTO {} ({}) VALUES ({})'.format(
+            METRICS_TABLE, ', '.join(row), ', '.join('?' * len(row))), tuple(row.values()))
+    connection.close()
+
+
+def _cpu_seconds():
+    return sum(usage.ru_utime + usage.ru_stime for usage in (
+        resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def _process_tree_rss(pid = None):
+    """resident bytes of a process and all its descendants, read from /proc"""
+    pid = pid or os.getpid()
+    try:
+        with open('/proc/{}/statm'.format(pid)) as statm:
+            rss = int(statm.read().split()[1]) * _PAGE_SIZE
+        children = []
+        for task in os.listdir('/proc/{}/task'.format(pid)):
+            with open('/proc/{}/task/{}/children'.format(pid, task)) as task_children:
+                children.extend(int(child) for child in task_children.read().split())
+    except (FileNotFoundError, ProcessLookupError):
+        #the process exited while it was being read
+        return 0
+    return rss + sum(_process_tree_rss(child) for child in children)
+
+
+class _PeakRssSampler:
+    """samples the rss of the process tree in a background thread"""
+
+    def __init__(self, interval = RSS_SAMPLE_SECONDS):
+        self.peak = 0
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target = self._sample, daemon = True)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, _process_tree_rss())
+            if self._stopped.wait(self._interval):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+
+def _uri_bytes(uri):
+    import tensorflow as tf
+
+    if not tf.io.gfile.exists(uri):
+        return 0
+    if not tf.io.gfile.isdir(uri):
+        return tf.io.gfile.stat(uri).length
+    return sum(tf.io.gfile.stat(os.path.join(dir_path, file_name)).length
+                for dir_path, _, file_names in tf.io.gfile.walk(uri)
+                for file_name in file_names)
+
+
+def _artifact_bytes(artifact_dict):
+    return sum(_uri_bytes(artifact.uri) for artifacts in artifact_dict.values()
+                for artifact in artifacts)
+
+
+def _component_id(output_dict, default):
+    """output uris are <pipeline root>/<component id>/<output key>/<execution id>"""
+    for artifacts in output_dict.values():
+        for artifact in artifacts:
+            return os.path.basename(os.path.dirname(os.path.dirname(artifact.uri.rstrip('/'))))
+    return default
+
+
+# %%
+class _ExecutorInstrumentation:
+    """swaps Do of the executor classes for a measuring wrapper while active"""
+
+    def __init__(self, executor_classes, metadata_path, run_id):
+        self._executor_classes = executor_classes
+        self._metadata_path = metadata_path
+        self._run_id = run_id
+        self._originals = {}
+        #an executor subclass calls the Do of a wrapped parent, measure only the outer call
+        self._active = threading.local()
+        self.executed = set()
+
+    def _wrap(self, executor_class, do):
+        instrumentation = self
+
+        def instrumented_do(executor, input_dict, output_dict, exec_properties):
+            if getattr(instrumentation._active, 'depth', 0):
+                return do(executor, input_dict, output_dict, exec_properties)
+            instrumentation._active.depth = 1
+            component_id = _component_id(output_dict, executor_class.__name__)
+            row = {'run_id': instrumentation._run_id, 'component_id': component_id,
+                'status': FAILED, 'started_at': time.time()}
+            start, start_cpu = time.perf_counter(), _cpu_seconds()
+            try:
+                with _PeakRssSampler() as sampler:
+                    result = do(executor, input_dict, output_dict, exec_properties)
+                row['status'] = COMPLETE
+                return result
+            finally:
+                instrumentation._active.depth = 0
+                row.update({
+                    'wall_seconds': time.perf_counter() - start,
+                    'cpu_seconds': _cpu_seconds() - start_cpu,
+                    'peak_rss_bytes': sampler.peak,
+                    'bytes_read': _artifact_bytes(input_dict),
+                    'bytes_written': _artifact_bytes(output_dict),
+                })
+                instrumentation.executed.add(component_id)
+                _insert(instrumentation._metadata_path, row)
+                logging.info("%s %s in %.1fs", component_id, row['status'], row['wall_seconds'])
+
+        return instrumented_do
+
+    def __enter__(self):
+        for executor_class in self._executor_classes:
+            self._originals[executor_class] = executor_class.__dict__.get('Do')
+            executor_class.Do = self._wrap(executor_class, executor_class.Do)
+        return self
+
+    def __exit__(self, *exc_info):
+        for executor_class, original in self._originals.items():
+            if original is None:
+                del executor_class.Do
+            else:
+                executor_class.Do = original
+
+
+def run_instrumented(tfx_pipeline, runner = None, run_id = None):
+    """
+    Run the pipeline (with LocalDagRunner by default) and record the metrics
+    of every component. Returns the run id
+    """
+    from tfx.components.base import base_executor, executor_spec
+    from tfx.orchestration.local import local_dag_runner
+
+    run_id = run_id or time.strftime('%Y%m%dT%H%M%S')
+    metadata_path = tfx_pipeline.metadata_connection_config.sqlite.filename_uri
+    #resolver and importer nodes only have a driver, their EmptyExecutor never
+    #runs, so they would count as a cache hit on every run
+    components = [component for component in tfx_pipeline.components
+                if isinstance(component.executor_spec, executor_spec.ExecutorClassSpec)
+                and not issubclass(component.executor_spec.executor_class, base_executor.EmptyExecutor)]
+    executor_classes = list(dict.fromkeys(
+        component.executor_spec.executor_class for component in components))
+
+    with _ExecutorInstrumentation(executor_classes, metadata_path, run_id) as instrumentation:
+        (runner or local_dag_runner.LocalDagRunner()).run(tfx_pipeline)
+    for component in components:
+        if component.id not in instrumentation.executed:
+            _insert(metadata_path, {'run_id': run_id, 'component_id': component.id,
+                                    'status': CACHED, 'started_at': time.time()})
+    return run_id
+
+
+# %%
+def load_run(run_id = None, metadata_path = config.METADATA_PATH):
+    """{component id: row dict} of a run, the latest run by default"""
+    with connect(metadata_path) as connection:
+        connection.row_factory = sqlite3.Row
+        if run_id is None:
+            latest = connection.execute(
+                'SELECT run_id FROM {} ORDER BY started_at DESC LIMIT 1'.format(METRICS_TABLE)).fetchone()
+            if latest is None:
+                raise LookupError("No instrumented runs in {}".format(metadata_path))
+            run_id = latest['run_id']
+        rows = connection.execute('SELECT * FROM {} WHERE run_id = ? ORDER BY started_at'.format(
+            METRICS_TABLE), (run_id,)).fetchall()
+    connection.close()
+    if not rows:
+        raise LookupError("No run {} in {}".format(run_id, metadata_path))
+    return run_id, {row['component_id']: dict(row) for row in rows}
+
+
+def _format_metric(column, value):
+    if value is None:
+        return '-'
+    if column.endswith('bytes') or column.startswith('bytes'):
+        return '{:.1f}MB'.format(value / 2 ** 20)
+    return '{:.1f}s'.format(value)
+
+
+def format_report(run_id, rows):
+    lines = ['run {}'.format(run_id),
+            '{:<36} {:<9}'.format('component', 'status')
+            + ''.join(' {:>15}'.format(column) for column in METRIC_COLUMNS)]
+    for component_id, row in rows.items():
+        lines.append('{:<36} {:<9}'.format(component_id, row['status']) + ''.join(
+            ' {:>15}'.format(_format_metric(column, row[column])) for column in METRIC_COLUMNS))
+    executed = [row for row in rows.values() if row['status'] != CACHED]
+    lines.append('{} executed, {} cached, {:.1f}s wall'.format(
+        len(executed), len(rows) - len(executed),
+        sum(row['wall_seconds'] or 0 for row in executed)))
+    return '\n'.join(lines)
+
+
+def format_diff(base_run_id, base_rows, run_id, rows):
+    """
+    relative change of every metric from the base run, components cached in
+    either run are listed with their statuses instead of being compared
+    """
+    lines = ['{} -> {}'.format(base_run_id, run_id),
+            '{:<36}'.format('component') + ''.join(' {:>15}'.format(column) for column in METRIC_COLUMNS)]
+    for component_id in list(dict.fromkeys(list(base_rows) + list(rows))):
+        base, row = base_rows.get(component_id), rows.get(component_id)
+        statuses = [entry['status'] if entry else 'missing' for entry in (base, row)]
+        if statuses != [COMPLETE, COMPLETE]:
+            lines.append('{:<36} {} -> {}'.format(component_id, *statuses))
+            continue
+        changes = []
+        for column in METRIC_COLUMNS:
+            if not base[column]:
+                changes.append(' {:>15}'.format('-'))
+            else:
+                changes.append(' {:>+14.1f}%'.format(100 * (row[column] - base[column]) / base[column]))
+        lines.append('{:<36}'.format(component_id) + ''.join(changes))
+    return '\n'.join(lines)
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--metadata-path', default = config.METADATA_PATH)
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    report_parser = subparsers.add_parser('report', help = 'metrics of one run, the latest by default')
+    report_parser.add_argument('--run-id')
+    diff_parser = subparsers.add_parser('diff', help = 'change of every metric between two runs')
+    diff_parser.add_argument('base_run_id')
+    diff_parser.add_argument('run_id')
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        print(format_report(*load_run(args.run_id, args.metadata_path)))
+    else:
+        print(format_diff(*load_run(args.base_run_id, args.metadata_path),
+                        *load_run(args.run_id, args.metadata_path)))
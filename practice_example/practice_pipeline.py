@@ -2,34 +2,33 @@
 
 # %%
 import os
-from typing import Text
+from typing import Dict, List, Text
 import tensorflow_model_analysis as tfma
 from tfx.components import (
     CsvExampleGen,
     Evaluator,
+    FileBasedExampleGen,
     ExampleValidator,
     Pusher,
     ResolverNode,
     SchemaGen,
     StatisticsGen,
     Trainer,
-    Transform,
 )
 import tfx
 from tfx.orchestration.local import local_dag_runner
-from tfx.extensions.google_cloud_ai_platform.trainer import executor \
-        as aip_trainer_executor
-from tfx.extensions.google_cloud_ai_platform.pusher import executor \
-        as aip_pusher_executor
 from consumer_complaint.config import config
 from tfx.components.base import executor_spec
+from tfx.components.example_gen.custom_executors import parquet_executor
 from tfx.components.trainer.executor import GenericExecutor
-from tfx.dsl.experimental import latest_blessed_model_resolver
+from tfx.dsl.experimental import latest_artifacts_resolver, latest_blessed_model_resolver
 from tfx.proto import pusher_pb2, trainer_pb2, example_gen_pb2
 from tfx.types import Channel
-from tfx.types.standard_artifacts import Model, ModelBlessing
+from tfx.types.standard_artifacts import Model, ModelBlessing, TransformCache
+from practice_example.incremental_statistics import CumulativeStatisticsGen
+from practice_example.feature_config import FeatureConfigGen, FeatureConfigTransform
+from practice_example import pipeline_metrics
 from tfx.orchestration import metadata, pipeline
-from tfx.orchestration.experimental.interactive.interactive_context import InteractiveContext
 
 
 # %%
@@ -38,10 +37,27 @@ def init_components(data_dir, module_file,
                     ai_platform_training_args=None,
                     ai_platform_serving_args=None,
                     training_steps = 1000,
-                    eval_steps = 200):
+                    eval_steps = 200,
+                    data_format = 'csv',
+                    incremental = False,
+                    with_version = False,
+                    custom_config = None,
+                    compact_model = False,
+                    compact_serving_model_dir = config.COMPACT_SERVING_MODEL_DIR):
 
     """
     This function is to initialize tfx components
+    With data_format = 'parquet', data_dir is the parquet dataset directory
+    written by columnar_data.csv_to_parquet_writer
+    With incremental = True, data_dir holds export-<span>(/ver-<version>)
+    snapshots and only the latest one is ingested. Its statistics are merged
+    into the cached cumulative statistics, and Transform reuses the analyzer
+    cache of earlier spans.
+    custom_config is passed on to module.run_fn, e.g.
+    {"embedding_cache_dir": config.EMBEDDING_CACHE_DIR_PATH}
+    With compact_model = True, a compact model for CPU serving is distilled
+    from the trained model and pushed to compact_serving_model_dir, see
+    init_compact_components
     """
 
     if serving_model_dir and ai_platform_serving_args:
@@ -61,12 +77,70 @@ def init_components(data_dir, module_file,
         )
     )
 
-    example_gen = CsvExampleGen(input_base=data_dir, output_config=output)
+    input_config = None
+    if incremental:
+        pattern = (config.SPAN_VERSION_INPUT_PATTERN if with_version
+                   else config.SPAN_INPUT_PATTERN)
+        input_config = example_gen_pb2.Input(
+            splits=[
+                example_gen_pb2.Input.Split(name="single_split", pattern=pattern)
+            ]
+        )
+
+    if data_format == 'parquet':
+        example_gen = FileBasedExampleGen(
+            input_base=data_dir,
+            input_config=input_config,
+            output_config=output,
+            custom_executor_spec=executor_spec.ExecutorClassSpec(
+                parquet_executor.Executor
+            ),
+        )
+    else:
+        example_gen = CsvExampleGen(input_base=data_dir,
+                                    input_config=input_config,
+                                    output_config=output)
 
     statistics_gen = StatisticsGen(examples=example_gen.outputs["examples"])
 
+    schema_statistics = statistics_gen.outputs["statistics"]
+    #Transform reuses the analyzer results of the examples it has already
+    #analyzed, e.g. when only the module file changed
+    cache_resolver = ResolverNode(
+        instance_name="latest_transform_cache_resolver",
+        resolver_class=latest_artifacts_resolver.LatestArtifactsResolver,
+        analyzer_cache=Channel(type=TransformCache),
+    )
+    transform_kwargs = {
+        "examples": example_gen.outputs["examples"],
+        "analyzer_cache": cache_resolver.outputs["analyzer_cache"],
+    }
+    incremental_components = []
+    if incremental:
+        cumulative_statistics_gen = CumulativeStatisticsGen(
+            statistics=statistics_gen.outputs["statistics"],
+            examples=example_gen.outputs["examples"],
+        )
+        schema_statistics = cumulative_statistics_gen.outputs["cumulative_statistics"]
+
+        #Transform analyzes a window of recent spans, the analyzer cache
+        #means only spans it has not seen before are actually read
+        span_resolver = ResolverNode(
+            instance_name="latest_spans_resolver",
+            resolver_class=latest_artifacts_resolver.LatestArtifactsResolver,
+            resolver_configs={
+                "desired_num_of_artifacts": config.TRANSFORM_SPAN_WINDOW
+            },
+            examples=example_gen.outputs["examples"],
+        )
+        transform_kwargs["examples"] = span_resolver.outputs["examples"]
+        incremental_components = [
+            cumulative_statistics_gen,
+            span_resolver,
+        ]
+
     schema_gen = SchemaGen(
-        statistics=statistics_gen.outputs["statistics"],
+        statistics=schema_statistics,
         infer_feature_shape=False,
     )
 
@@ -75,10 +149,18 @@ def init_components(data_dir, module_file,
         schema=schema_gen.outputs["schema"],
     )
 
-    transform = Transform(
-        examples=example_gen.outputs["examples"],
+    #vocabulary sizes of the categorical features follow the statistics,
+    #they travel with the schema to Transform and with the transform graph
+    #to the Trainer
+    feature_config_gen = FeatureConfigGen(
+        statistics=schema_statistics,
         schema=schema_gen.outputs["schema"],
+    )
+
+    transform = FeatureConfigTransform(
+        schema=feature_config_gen.outputs["transform_schema"],
         module_file=module_file,
+        **transform_kwargs,
     )
 
     training_kwargs = {
@@ -91,6 +173,9 @@ def init_components(data_dir, module_file,
     }
 
     if ai_platform_training_args:
+        #the AI Platform extensions pull in the google cloud clients, only load them when used
+        from tfx.extensions.google_cloud_ai_platform.trainer import executor \
+                as aip_trainer_executor
 
         training_kwargs.update(
             {
@@ -98,6 +183,7 @@ def init_components(data_dir, module_file,
                     aip_trainer_executor.GenericExecutor
                 ),
                 "custom_config": {
+                    **(custom_config or {}),
                     aip_trainer_executor.TRAINING_ARGS_KEY: ai_platform_training_args  # noqa
                 },
             }
@@ -107,17 +193,23 @@ def init_components(data_dir, module_file,
             {
                 "custom_executor_spec": executor_spec.ExecutorClassSpec(
                     GenericExecutor
-                )
+                ),
+                "custom_config": custom_config,
             }
         )
 
     trainer = Trainer(**training_kwargs)
 
+    #only the models of this trainer blessed by the main evaluator, the
+    #compact trainer and evaluator write to the same pipeline context
     model_resolver = ResolverNode(
         instance_name="latest_blessed_model_resolver",
         resolver_class=latest_blessed_model_resolver.LatestBlessedModelResolver,
-        model=Channel(type=Model),
-        model_blessing=Channel(type=ModelBlessing),
+        model=Channel(type=Model, producer_component_id=trainer.id,
+                      output_key="model"),
+        model_blessing=Channel(type=ModelBlessing,
+                               producer_component_id=Evaluator.get_id(),
+                               output_key="blessing"),
     )
 
     #model_resolver for tfx==0.30.0 
@@ -184,7 +276,8 @@ def init_components(data_dir, module_file,
     }
 
     if ai_platform_serving_args:
-        
+        from tfx.extensions.google_cloud_ai_platform.pusher import executor \
+                as aip_pusher_executor
 
         pusher_kwargs.update(
             {
@@ -213,40 +306,202 @@ def init_components(data_dir, module_file,
 
     pusher = Pusher(**pusher_kwargs)
 
+    compact_components = []
+    if compact_model:
+        compact_components = init_compact_components(
+            example_gen, trainer, training_kwargs, compact_serving_model_dir
+        )
 
     #compile all components in a list
     components = [
         example_gen,
         statistics_gen,
+        *incremental_components,
+        cache_resolver,
         schema_gen,
         example_validator,
+        feature_config_gen,
         transform,
         trainer,
         model_resolver,
         evaluator,
         pusher,
+        *compact_components,
     ]
     return components
 
 
+def init_compact_components(example_gen, trainer, training_kwargs,
+                            serving_model_dir = config.COMPACT_SERVING_MODEL_DIR,
+                            accuracy_tolerance = config.COMPACT_ACCURACY_TOLERANCE):
+    """
+    A second Trainer distilling the compact model of compact_model.py from
+    the model of trainer, an Evaluator comparing the two and a Pusher.
+    The compact model is blessed when its accuracy is at most
+    accuracy_tolerance below the full model's
+    """
+    compact_trainer = Trainer(
+        instance_name="compact_trainer",
+        base_model=trainer.outputs["model"],
+        **{
+            **training_kwargs,
+            "custom_config": {
+                **(training_kwargs["custom_config"] or {}),
+                "compact_model": True,
+            },
+        },
+    )
+
+    eval_config = tfma.EvalConfig(
+        model_specs=[
+            tfma.ModelSpec(name="candidate", label_key="consumer_disputed"),
+            tfma.ModelSpec(
+                name="baseline", label_key="consumer_disputed", is_baseline=True
+            ),
+        ],
+        slicing_specs=[tfma.SlicingSpec()],
+        metrics_specs=[
+            tfma.MetricsSpec(
+                metrics=[
+                tfma.MetricConfig(class_name='ExampleCount'),
+                tfma.MetricConfig(
+                    class_name='BinaryAccuracy',
+                    threshold=tfma.MetricThreshold(
+                        value_threshold=tfma.GenericValueThreshold(
+                            lower_bound={'value': 0.5}
+                            ),
+                        #candidate - baseline may drop down to -accuracy_tolerance
+                        change_threshold=tfma.GenericChangeThreshold(
+                            direction=tfma.MetricDirection.HIGHER_IS_BETTER,
+                            absolute={"value": -accuracy_tolerance},
+                        ),
+                        )
+                    ),
+                ]
+            )
+        ],
+    )
+
+    compact_evaluator = Evaluator(
+        instance_name="compact_evaluator",
+        examples=example_gen.outputs["examples"],
+        model=compact_trainer.outputs["model"],
+        baseline_model=trainer.outputs["model"],
+        eval_config=eval_config,
+    )
+
+    compact_pusher = Pusher(
+        instance_name="compact_pusher",
+        model=compact_trainer.outputs["model"],
+        model_blessing=compact_evaluator.outputs["blessing"],
+        push_destination=pusher_pb2.PushDestination(
+            filesystem=pusher_pb2.PushDestination.Filesystem(
+                base_directory=serving_model_dir
+            )
+        ),
+    )
+    return [compact_trainer, compact_evaluator, compact_pusher]
+
+
 # %%
-def init_pipeline(components, 
-                pipeline_root: Text, 
-                direct_num_workers: int) -> pipeline.Pipeline:
+DIRECT_RUNNING_MODES = ("in_memory", "multi_threading", "multi_processing")
+BEAM_PROFILES = DIRECT_RUNNING_MODES + ("flink", "spark", "portable")
+
+
+def beam_pipeline_args(profile: Text = config.BEAM_PROFILE,
+                       num_workers: int = None) -> List[Text]:
+    """
+    Beam pipeline args of an execution profile
+    in_memory, multi_threading, multi_processing: the DirectRunner modes
+    flink, spark: the portable runners with an embedded local job server
+    portable: a job server already running at config.BEAM_JOB_ENDPOINT
+    num_workers defaults to the number of available cores, in_memory always
+    runs a single worker
+    """
+    num_workers = num_workers or os.cpu_count()
+    if profile == "in_memory":
+        return ["--direct_running_mode=in_memory", "--direct_num_workers=1"]
+    if profile in DIRECT_RUNNING_MODES:
+        return [
+            f"--direct_running_mode={profile}",
+            f"--direct_num_workers={num_workers}",
+        ]
+    #the sdk harness runs in this process, so no docker image is needed
+    if profile == "flink":
+        return [
+            "--runner=FlinkRunner",
+            f"--flink_master={config.BEAM_FLINK_MASTER}",
+            f"--parallelism={num_workers}",
+            "--environment_type=LOOPBACK",
+        ]
+    if profile == "spark":
+        master_url = config.BEAM_SPARK_MASTER_URL.format(num_workers=num_workers)
+        return [
+            "--runner=SparkRunner",
+            f"--spark_master_url={master_url}",
+            "--environment_type=LOOPBACK",
+        ]
+    if profile == "portable":
+        return [
+            "--runner=PortableRunner",
+            f"--job_endpoint={config.BEAM_JOB_ENDPOINT}",
+            "--environment_type=LOOPBACK",
+        ]
+    raise ValueError(
+        f"Unknown beam profile {profile}, choose one of {BEAM_PROFILES}"
+    )
+
+
+def set_component_beam_args(component, args: List[Text]):
+    """
+    Beam args of a single component, on top of the pipeline's. Beam keeps
+    the last value of a repeated flag, so these win.
+    """
+    if hasattr(component, "with_beam_pipeline_args"):
+        component.with_beam_pipeline_args(args)
+    elif hasattr(component.executor_spec, "add_extra_flags"):
+        component.executor_spec.add_extra_flags(args)
+    else:
+        raise NotImplementedError(
+            f"{component.id} takes no component level beam args in tfx "
+            f"{tfx.__version__}"
+        )
+
+
+def init_pipeline(components,
+                pipeline_root: Text,
+                direct_num_workers: int = None,
+                profile: Text = config.BEAM_PROFILE,
+                component_profiles: Dict[Text, Dict] = None) -> pipeline.Pipeline:
+    """
+    direct_num_workers defaults to the number of available cores
+    component_profiles overrides the profile per component id, e.g.
+    {"StatisticsGen": {"profile": "multi_processing", "num_workers": 8},
+    "FeatureConfigTransform": {"profile": "multi_processing", "num_workers": 8}},
+    it defaults to config.BEAM_COMPONENT_PROFILES
+    """
+    if component_profiles is None:
+        component_profiles = config.BEAM_COMPONENT_PROFILES
+    component_ids = {component.id for component in components}
+    unknown_ids = set(component_profiles) - component_ids
+    if unknown_ids:
+        raise ValueError(f"No components with ids {sorted(unknown_ids)}")
+
+    for component in components:
+        if component.id in component_profiles:
+            set_component_beam_args(
+                component, beam_pipeline_args(**component_profiles[component.id])
+            )
 
-    beam_arg = [
-        f"--direct_num_workers={direct_num_workers}",
-        f"--direct_running_mode=multi_processing",
-    ]
     tfx_pipeline = pipeline.Pipeline(
         pipeline_name=config.PIPELINE_NAME,
-        pipeline_root=config.PIPELINE_ROOT,
+        pipeline_root=pipeline_root,
         components=components,
         enable_cache=True,
         metadata_connection_config=metadata.sqlite_metadata_connection_config(
-            config.METADATA_PATH
+            os.path.join(pipeline_root, "metadata.sqlite")
         ),
-        beam_pipeline_args=beam_arg,
+        beam_pipeline_args=beam_pipeline_args(profile, direct_num_workers),
     )
     return tfx_pipeline
 
@@ -258,7 +513,7 @@ if __name__ == "__main__":
                                 config.SERVING_MODEL_DIR,
                                 )
 # %%
-    tfx_pipeline = init_pipeline(tfx_components, config.PIPELINE_ROOT, 4)
+    tfx_pipeline = init_pipeline(tfx_components, config.PIPELINE_ROOT)
     
 
 
@@ -266,7 +521,10 @@ if __name__ == "__main__":
     #the localDagRunner() doesn't work in ipykernel, so you would have to run 
     # this in terminal 
     #or you have to run context.run(component) within ipykernel
-    local_dag_runner.LocalDagRunner().run(tfx_pipeline)
+    #per component wall/cpu time, peak rss and artifact bytes go to
+    #metadata.sqlite, see `python -m practice_example.pipeline_metrics report`
+    pipeline_metrics.run_instrumented(tfx_pipeline,
+                                      local_dag_runner.LocalDagRunner())
 
 
 
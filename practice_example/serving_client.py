@@ -0,0 +1,54 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Client helpers for the serving_raw signature. A batch is sent as one column
+per raw feature, so no tf.Example is built on the client or parsed on the
+server. Works against inference_server.py and TensorFlow Serving alike.
+"""
+
+# %%
+import json
+import urllib.request
+import grpc
+import numpy as np
+import tensorflow as tf
+from tensorflow_serving.apis import predict_pb2, prediction_service_pb2_grpc
+from consumer_complaint.config import config
+
+
+# %%
+def predict_columnar_http(columns, host = 'localhost', port = config.INFERENCE_HTTP_PORT,
+                        model_name = config.INFERENCE_MODEL_NAME, timeout = 10):
+    """
+    columns: {feature name: list of values}, one list per raw feature
+    returns the predictions as an (n, 1) array
+    """
+    body = json.dumps({'signature_name': config.RAW_SIGNATURE_NAME, 'inputs': columns})
+    request = urllib.request.Request(
+        'http://{}:{}/v1/models/{}:predict'.format(host, port, model_name),
+        data = body.encode('utf-8'), headers = {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout = timeout) as response:
+        return np.array(json.load(response)['predictions'])
+
+
+class ColumnarPredictClient:
+    """gRPC client reusing one channel across requests"""
+
+    def __init__(self, host = 'localhost', port = config.INFERENCE_GRPC_PORT,
+                model_name = config.INFERENCE_MODEL_NAME):
+        self._channel = grpc.insecure_channel('{}:{}'.format(host, port))
+        self._stub = prediction_service_pb2_grpc.PredictionServiceStub(self._channel)
+        self._model_name = model_name
+
+    def predict(self, columns, timeout = 10):
+        """same as predict_columnar_http, over the PredictionService API"""
+        request = predict_pb2.PredictRequest()
+        request.model_spec.name = self._model_name
+        request.model_spec.signature_name = config.RAW_SIGNATURE_NAME
+        for key, values in columns.items():
+            request.inputs[key].CopyFrom(tf.make_tensor_proto(values))
+        response = self._stub.Predict(request, timeout = timeout)
+        return tf.make_ndarray(response.outputs['outputs'])
+
+    def close(self):
+        self._channel.close()
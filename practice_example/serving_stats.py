@@ -0,0 +1,294 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Statistics of the traffic the served model actually sees, for skew checks
+against the training data (tfdv_skew_validator, skew_monitor).
+The collector wraps the predict functions of inference_server. A request only
+hands its batch to a queue (a few microseconds), a background thread parses
+the batches and updates bounded memory sketches:
+    categorical features,     SpaceSaving top-k counts, zip_code is kept as
+    zip_code                  the masked string ("294XX") like the string
+                              stats of the training StatisticsGen
+    narrative length          log bucketed quantile sketch with 1% relative
+                              error, plus exact count, mean, std dev, min and max
+Every export_seconds the statistics of the day so far are written as a
+DatasetFeatureStatisticsList (tfdv.load_statistics reads it) to
+<export_dir>/<yyyy-mm-dd>/stats_tfrecord and as the day's 'serving' summary
+of the skew_monitor store. When the queue is full, batches are dropped and
+counted instead of slowing requests down.
+"""
+
+# %%
+import collections
+import datetime
+import math
+import os
+import queue
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+from absl import logging
+from tensorflow_metadata.proto.v0 import statistics_pb2
+from consumer_complaint.config import config
+from practice_example import skew_monitor
+from practice_example.features import ONE_HOT_FEATURES, TEXT_FEATURES
+
+SERVING_DATASET_NAME = 'serving'
+STATS_FILE_NAME = 'stats_tfrecord'
+NUM_TOP_VALUES = 20
+NUM_QUANTILES = 10
+
+
+# %%
+class SpaceSaving:
+    """
+    Top-k value counts in at most capacity counters. A value that is not
+    tracked replaces the smallest counter and inherits its count, so counts
+    overestimate by at most total / capacity.
+    """
+
+    def __init__(self, capacity = config.SERVING_STATS_TOP_K):
+        self.capacity = capacity
+        self.counts = {}
+
+    def update(self, value_counts):
+        for value, count in value_counts.items():
+            if value in self.counts:
+                self.counts[value] += count
+            elif len(self.counts) < self.capacity:
+                self.counts[value] = count
+            else:
+                smallest = min(self.counts, key = self.counts.get)
+                self.counts[value] = self.counts.pop(smallest) + count
+
+    def top(self, k = None):
+        return sorted(self.counts.items(), key = lambda item: -item[1])[:k]
+
+
+class QuantileSketch:
+    """
+    Log bucketed histogram of non-negative values: bucket i holds
+    (gamma^(i - 1), gamma^i], zeros have their own bucket. Any quantile is
+    within relative_accuracy of the true value, memory grows with
+    log(max / min) only.
+    """
+
+    def __init__(self, relative_accuracy = config.SERVING_STATS_RELATIVE_ACCURACY):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bucket_counts = collections.Counter()
+        self.num_zeros = 0
+        self.count, self.total, self.total_squares = 0, 0.0, 0.0
+        self.min, self.max = math.inf, -math.inf
+
+    def update(self, values):
+        values = np.maximum(np.asarray(values, dtype = np.float64), 0.0)
+        if not len(values):
+            return
+        positive = values[values > 0]
+        self.num_zeros += len(values) - len(positive)
+        keys, counts = np.unique(np.ceil(np.log(positive) / self._log_gamma).astype(np.int64),
+                                return_counts = True)
+        self.bucket_counts.update(dict(zip(keys.tolist(), counts.tolist())))
+        self.count += len(values)
+        self.total += values.sum()
+        self.total_squares += np.square(values).sum()
+        self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+
+    def buckets(self):
+        """(low, high, count) in ascending order, the zero bucket first"""
+        buckets = [(0.0, 0.0, self.num_zeros)] if self.num_zeros else []
+        for key in sorted(self.bucket_counts):
+            buckets.append((self.gamma ** (key - 1), self.gamma ** key, self.bucket_counts[key]))
+        return buckets
+
+    def quantiles(self, fractions):
+        buckets = self.buckets()
+        cumulative = np.cumsum([count for _, _, count in buckets])
+        positions = np.searchsorted(cumulative, np.asarray(fractions) * self.count, side = 'left')
+        values = []
+        for position in np.minimum(positions, len(buckets) - 1):
+            low, high, _ = buckets[position]
+            #the middle of a bucket in relative terms
+            values.append(0.0 if high == 0 else 2 * high / (self.gamma + 1))
+        return np.clip(values, self.min, self.max)
+
+
+# %%
+def _string_values(values):
+    """
+    values of a string feature as bytes, whatever dtype the model input has,
+    e.g. the python ints of rows for an int64 zip_code input
+    """
+    if values.dtype.kind == 'S':
+        return values
+    if values.dtype == object:
+        return np.array([value if isinstance(value, bytes) else str(value).encode('utf-8')
+                        for value in values], dtype = object)
+    return np.char.encode(values.astype(str), 'utf-8')
+
+
+class ServingStatsCollector:
+    """
+    feature_dtypes: {raw feature name: tf dtype}, e.g. from
+    ModelManager.raw_input_specs(). Categorical features are the one hot
+    features and zip_code, the narrative length gets a quantile sketch.
+    """
+
+    def __init__(self, feature_dtypes, export_dir = config.SERVING_STATS_DIR_PATH,
+                export_seconds = config.SERVING_STATS_EXPORT_SECONDS,
+                max_pending_batches = 1000, summary_store = None):
+        self.feature_dtypes = dict(feature_dtypes)
+        self.export_dir = export_dir
+        self.export_seconds = export_seconds
+        self.summary_store = summary_store or skew_monitor.SummaryStore()
+        self.dropped_batches = 0
+        self._queue = queue.Queue(maxsize = max_pending_batches)
+        self._lock = threading.Lock()
+        self._reset(datetime.date.today())
+        threading.Thread(target = self._work, daemon = True).start()
+
+    def _reset(self, day):
+        self.day, self.num_examples = day, 0
+        self._categorical = {key: SpaceSaving() for key in [*ONE_HOT_FEATURES, 'zip_code']
+                            if key in self.feature_dtypes}
+        self._numeric = {key + '_length': QuantileSketch() for key in TEXT_FEATURES}
+        self._missing = collections.Counter()
+
+    # request path, has to stay cheap
+    def observe_examples(self, serialized_examples):
+        self._put(('examples', serialized_examples))
+
+    def observe_rows(self, rows):
+        self._put(('rows', rows))
+
+    def _put(self, observation):
+        try:
+            self._queue.put_nowait(observation)
+        except queue.Full:
+            self.dropped_batches += 1
+
+    def wrap(self, predict_fn, observe):
+        """predict_fn that also hands its input to observe"""
+        def observed_predict_fn(inputs):
+            outputs = predict_fn(inputs)
+            observe(inputs)
+            return outputs
+        return observed_predict_fn
+
+    # collector thread
+    def _columns(self, kind, batch):
+        """{feature: numpy array of the present values} and the batch size"""
+        if kind == 'rows':
+            columns = {key: np.array([row.get(key) for row in batch
+                                    if row.get(key) not in (None, '', b'')], dtype = object)
+                        for key in self.feature_dtypes}
+            for key, values in columns.items():
+                if values.dtype == object and len(values) and isinstance(values[0], str):
+                    columns[key] = np.char.encode(values.astype(str), 'utf-8')
+            return columns, len(batch)
+        parsed = tf.io.parse_example(tf.constant(batch), {
+            key: tf.io.VarLenFeature(dtype) for key, dtype in self.feature_dtypes.items()})
+        return {key: tensor.values.numpy() for key, tensor in parsed.items()}, len(batch)
+
+    def _update(self, kind, batch):
+        columns, batch_size = self._columns(kind, batch)
+        with self._lock:
+            self.num_examples += batch_size
+            for key, values in columns.items():
+                values = values[values != b''] if values.dtype.kind in 'OS' else values
+                self._missing[key] += batch_size - len(values)
+                if key in self._categorical:
+                    self._categorical[key].update(collections.Counter(_string_values(values).tolist()))
+                elif key in TEXT_FEATURES:
+                    self._numeric[key + '_length'].update([len(value) for value in values])
+
+    def _work(self):
+        next_export = time.monotonic() + self.export_seconds
+        while True:
+            try:
+                kind, batch = self._queue.get(timeout = max(next_export - time.monotonic(), 0))
+                self._update(kind, batch)
+            except queue.Empty:
+                pass
+            except Exception:
+                logging.exception("Serving statistics update failed")
+            if time.monotonic() >= next_export:
+                next_export = time.monotonic() + self.export_seconds
+                try:
+                    self.export()
+                except Exception:
+                    logging.exception("Serving statistics export failed")
+
+    # export
+    def _common_stats(self, common_stats, key):
+        num_missing = self._missing[key]
+        common_stats.num_non_missing = self.num_examples - num_missing
+        common_stats.num_missing = num_missing
+        common_stats.min_num_values = common_stats.max_num_values = 1
+        common_stats.avg_num_values = 1.0
+        common_stats.tot_num_values = self.num_examples - num_missing
+
+    def statistics(self):
+        """the day so far as a DatasetFeatureStatisticsList"""
+        stats = statistics_pb2.DatasetFeatureStatisticsList()
+        with self._lock:
+            dataset = stats.datasets.add(name = SERVING_DATASET_NAME, num_examples = self.num_examples)
+            for key, sketch in self._categorical.items():
+                feature = dataset.features.add(type = statistics_pb2.FeatureNameStatistics.STRING)
+                feature.path.step.append(key)
+                string_stats = feature.string_stats
+                self._common_stats(string_stats.common_stats, key)
+                ranked = sketch.top()
+                string_stats.unique = len(ranked)
+                if ranked:
+                    string_stats.avg_length = (sum(len(value) * count for value, count in ranked)
+                                            / sum(count for _, count in ranked))
+                for value, count in ranked[:NUM_TOP_VALUES]:
+                    string_stats.top_values.add(value = value.decode('utf-8', 'replace'), frequency = count)
+                for rank, (value, count) in enumerate(ranked):
+                    string_stats.rank_histogram.buckets.add(
+                        low_rank = rank, high_rank = rank,
+                        label = value.decode('utf-8', 'replace'), sample_count = count)
+
+            for key, sketch in self._numeric.items():
+                if not sketch.count:
+                    continue
+                feature = dataset.features.add(type = statistics_pb2.FeatureNameStatistics.FLOAT)
+                feature.path.step.append(key)
+                num_stats = feature.num_stats
+                missing_key = key[:-len('_length')] if key.endswith('_length') else key
+                self._common_stats(num_stats.common_stats, missing_key)
+                mean = sketch.total / sketch.count
+                num_stats.mean = mean
+                num_stats.std_dev = max(sketch.total_squares / sketch.count - mean ** 2, 0.0) ** 0.5
+                num_stats.min, num_stats.max = sketch.min, sketch.max
+                num_stats.num_zeros = sketch.num_zeros
+                num_stats.median = float(sketch.quantiles([0.5])[0])
+                standard = num_stats.histograms.add(type = statistics_pb2.Histogram.STANDARD)
+                for low, high, count in sketch.buckets():
+                    standard.buckets.add(low_value = low, high_value = high, sample_count = count)
+                edges = sketch.quantiles(np.linspace(0, 1, NUM_QUANTILES + 1))
+                quantiles = num_stats.histograms.add(type = statistics_pb2.Histogram.QUANTILES)
+                for low, high in zip(edges[:-1], edges[1:]):
+                    quantiles.buckets.add(low_value = low, high_value = high,
+                                        sample_count = sketch.count / NUM_QUANTILES)
+        return stats
+
+    def export(self):
+        """write the day so far, start over when the day has changed"""
+        stats = self.statistics()
+        day = self.day.isoformat()
+        stats_path = os.path.join(self.export_dir, day, STATS_FILE_NAME)
+        tf.io.gfile.makedirs(os.path.dirname(stats_path))
+        with tf.io.TFRecordWriter(stats_path) as writer:
+            writer.write(stats.SerializeToString())
+        self.summary_store.put(SERVING_DATASET_NAME,
+                            skew_monitor.DistributionSummary.from_statistics(stats), day)
+        logging.info("Exported serving statistics of %s examples, %s batches dropped",
+                    self.num_examples, self.dropped_batches)
+        if datetime.date.today() != self.day:
+            with self._lock:
+                self._reset(datetime.date.today())
+        return stats_path
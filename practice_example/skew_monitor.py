@@ -0,0 +1,289 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Skew and drift monitoring for every feature at once, without tfdv.validate_statistics.
+Statistics (cached DatasetFeatureStatisticsList or streamed counts) are
+reduced to a DistributionSummary: the value counts of every categorical
+feature and the histogram of every numeric feature, in a handful of flat
+numpy arrays. Summaries are kept per day in a SummaryStore, one compressed
+npz file each, and two summaries are compared in one vectorized pass:
+    l_infinity       largest difference of a value's share, categorical features
+    jensen_shannon   base 2 Jensen-Shannon divergence, all features
+A feature is an anomaly when a distance is above its threshold, like the
+infinity_norm threshold of tfdv_skew_validator and tfdv_drift_validator.
+
+    python -m practice_example.skew_monitor summarize <stats path> --name serving
+    python -m practice_example.skew_monitor check --baseline train --name serving --linf-threshold 0.01
+"""
+
+# %%
+import argparse
+import datetime
+import os
+import numpy as np
+from consumer_complaint.config import config
+
+CATEGORICAL, NUMERIC = 0, 1
+L_INFINITY, JENSEN_SHANNON = 'l_infinity', 'jensen_shannon'
+
+
+# %%
+class DistributionSummary:
+    """
+    Value counts of all features, flattened: entry i belongs to feature
+    feature_index[i]. Categorical entries have a label, numeric entries are
+    histogram buckets [low, high).
+    """
+
+    def __init__(self, features, kinds, feature_index, labels, counts, lows, highs):
+        self.features = np.asarray(features, dtype = str)
+        self.kinds = np.asarray(kinds, dtype = np.int8)
+        self.feature_index = np.asarray(feature_index, dtype = np.int64)
+        self.labels = np.asarray(labels, dtype = str)
+        self.counts = np.asarray(counts, dtype = np.float64)
+        self.lows = np.asarray(lows, dtype = np.float64)
+        self.highs = np.asarray(highs, dtype = np.float64)
+
+    @classmethod
+    def from_distributions(cls, categorical = None, numeric = None):
+        """
+        categorical: {feature: {label: count}}
+        numeric: {feature: (bucket edges, bucket counts)}, len(edges) == len(counts) + 1
+        """
+        features, kinds, columns = [], [], {key: [] for key in
+                                            ('feature_index', 'labels', 'counts', 'lows', 'highs')}
+        for feature, value_counts in sorted((categorical or {}).items()):
+            columns['feature_index'].append(np.full(len(value_counts), len(features)))
+            columns['labels'].append(list(value_counts))
+            columns['counts'].append(list(value_counts.values()))
+            columns['lows'].append(np.full(len(value_counts), np.nan))
+            columns['highs'].append(np.full(len(value_counts), np.nan))
+            features.append(feature)
+            kinds.append(CATEGORICAL)
+        for feature, (edges, counts) in sorted((numeric or {}).items()):
+            edges = np.asarray(edges, dtype = np.float64)
+            columns['feature_index'].append(np.full(len(counts), len(features)))
+            columns['labels'].append([''] * len(counts))
+            columns['counts'].append(counts)
+            columns['lows'].append(edges[:-1])
+            columns['highs'].append(edges[1:])
+            features.append(feature)
+            kinds.append(NUMERIC)
+        arrays = {key: np.concatenate(values) if values else np.zeros(0)
+                for key, values in columns.items()}
+        arrays['labels'] = arrays['labels'].astype(str)
+        return cls(features, kinds, **arrays)
+
+    @classmethod
+    def from_statistics(cls, stats, dataset_index = 0):
+        """
+        summary of one dataset of a DatasetFeatureStatisticsList, categorical
+        features from the rank histogram, numeric ones from the standard histogram
+        """
+        categorical, numeric = {}, {}
+        for feature in stats.datasets[dataset_index].features:
+            name = '.'.join(feature.path.step) or feature.name
+            if feature.HasField('string_stats'):
+                buckets = feature.string_stats.rank_histogram.buckets
+                if buckets:
+                    categorical[name] = {bucket.label: bucket.sample_count for bucket in buckets}
+                else:
+                    categorical[name] = {top_value.value: top_value.frequency
+                                        for top_value in feature.string_stats.top_values}
+            elif feature.HasField('num_stats'):
+                for histogram in feature.num_stats.histograms:
+                    if histogram.type == histogram.STANDARD and histogram.buckets:
+                        buckets = histogram.buckets
+                        edges = [buckets[0].low_value] + [bucket.high_value for bucket in buckets]
+                        numeric[name] = (edges, [bucket.sample_count for bucket in buckets])
+        return cls.from_distributions(categorical, numeric)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        #np.savez_compressed appends .npz to names without it
+        with open(path + '.tmp', 'wb') as summary_file:
+            np.savez_compressed(summary_file, **self.__dict__)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle = False) as arrays:
+            return cls(**{key: arrays[key] for key in arrays.files})
+
+
+class SummaryStore:
+    """daily summaries as <store_path>/<name>/<yyyy-mm-dd>.npz"""
+
+    def __init__(self, store_path = config.SKEW_SUMMARY_STORE_PATH):
+        self.store_path = store_path
+
+    def _path(self, name, day):
+        return os.path.join(self.store_path, name, '{}.npz'.format(day))
+
+    def put(self, name, summary, day = None):
+        summary.save(self._path(name, day or datetime.date.today().isoformat()))
+
+    def get(self, name, day = None):
+        """the summary of a day, the latest one by default"""
+        return DistributionSummary.load(self._path(name, day or self.days(name)[-1]))
+
+    def days(self, name):
+        name_dir = os.path.join(self.store_path, name)
+        if not os.path.isdir(name_dir):
+            raise FileNotFoundError("No summaries named {} in {}".format(name, self.store_path))
+        return sorted(file_name[:-len('.npz')] for file_name in os.listdir(name_dir)
+                    if file_name.endswith('.npz'))
+
+
+# %%
+def _rebin(edges, counts, target_edges):
+    """counts of a histogram spread over other bucket edges, uniform within a bucket"""
+    cumulative = np.concatenate([[0.0], np.cumsum(counts)])
+    return np.diff(np.interp(target_edges, edges, cumulative))
+
+
+def _aligned(baseline, current, features):
+    """
+    the distributions of both summaries over shared entries: categorical
+    entries are the union of labels, numeric ones the baseline buckets plus
+    a bucket on either side for current values out of their range.
+    Returns (feature position, baseline counts, current counts) per entry.
+    """
+    positions = {feature: position for position, feature in enumerate(features)}
+    feature_ids, keys, sides, counts = [], [], [], []
+    for side, summary in enumerate((baseline, current)):
+        categorical = summary.kinds[summary.feature_index] == CATEGORICAL
+        names = summary.features[summary.feature_index[categorical]]
+        shared = np.isin(names, features)
+        #features is sorted, so its positions are found by binary search
+        ids = np.searchsorted(features, names[shared])
+        feature_ids.append(ids)
+        keys.append(np.char.add(np.char.add(ids.astype(str), '\x1f'), summary.labels[categorical][shared]))
+        sides.append(np.full(len(ids), side))
+        counts.append(summary.counts[categorical][shared])
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse = True)
+    aligned = np.zeros((2, len(keys)))
+    np.add.at(aligned, (np.concatenate(sides), inverse), np.concatenate(counts))
+    entry_features = np.zeros(len(keys), dtype = np.int64)
+    entry_features[inverse] = np.concatenate(feature_ids)
+
+    #numeric features are few, their histograms are rebinned one by one
+    for feature in features:
+        base_index = np.flatnonzero(baseline.features == feature)[0]
+        if baseline.kinds[base_index] != NUMERIC:
+            continue
+        current_index = np.flatnonzero(current.features == feature)[0]
+        if current.kinds[current_index] != NUMERIC:
+            continue
+        base = baseline.feature_index == base_index
+        cur = current.feature_index == current_index
+        base_edges = np.append(baseline.lows[base], baseline.highs[base][-1:])
+        cur_edges = np.append(current.lows[cur], current.highs[cur][-1:])
+        #values outside the baseline range get a bucket of their own instead of being dropped
+        below = cur_edges[:1] if cur_edges[0] < base_edges[0] else np.zeros(0)
+        above = cur_edges[-1:] if cur_edges[-1] > base_edges[-1] else np.zeros(0)
+        base_counts = np.concatenate([np.zeros(len(below)), baseline.counts[base], np.zeros(len(above))])
+        cur_counts = _rebin(cur_edges, current.counts[cur], np.concatenate([below, base_edges, above]))
+        aligned = np.concatenate([aligned, np.stack([base_counts, cur_counts])], axis = 1)
+        entry_features = np.concatenate([entry_features, np.full(len(base_counts), positions[feature])])
+    return entry_features, aligned[0], aligned[1]
+
+
+def distances(baseline, current):
+    """
+    l_infinity and jensen_shannon distance of every feature both summaries share.
+    Returns {feature: {'kind': 'categorical' or 'numeric', distance name: value}}
+    """
+    features = sorted(set(baseline.features) & set(current.features))
+    if not features:
+        return {}
+    entry_features, base, cur = _aligned(baseline, current, features)
+    num_features = len(features)
+    base_share = base / np.maximum(np.bincount(entry_features, base, num_features), 1e-12)[entry_features]
+    cur_share = cur / np.maximum(np.bincount(entry_features, cur, num_features), 1e-12)[entry_features]
+
+    l_infinity = np.zeros(num_features)
+    np.maximum.at(l_infinity, entry_features, np.abs(base_share - cur_share))
+    mean_share = (base_share + cur_share) / 2
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        terms = (np.where(base_share > 0, base_share * np.log2(base_share / mean_share), 0.0)
+                + np.where(cur_share > 0, cur_share * np.log2(cur_share / mean_share), 0.0)) / 2
+    jensen_shannon = np.bincount(entry_features, terms, num_features)
+
+    kinds = {feature: kind for feature, kind in zip(baseline.features, baseline.kinds)}
+    results = {}
+    for position, feature in enumerate(features):
+        feature, kind = str(feature), kinds[feature]
+        results[feature] = {'kind': 'categorical' if kind == CATEGORICAL else 'numeric',
+                            JENSEN_SHANNON: float(jensen_shannon[position])}
+        if kind == CATEGORICAL:
+            results[feature][L_INFINITY] = float(l_infinity[position])
+    return results
+
+
+def _threshold(thresholds, feature):
+    if isinstance(thresholds, dict):
+        return thresholds.get(feature)
+    return thresholds
+
+
+def find_anomalies(baseline, current, linf_threshold = None, js_threshold = None):
+    """
+    features whose distance is above its threshold. Thresholds are one value
+    for every feature or {feature: threshold}, None skips the check.
+    Returns {feature: {distance name: (value, threshold)}}
+    """
+    anomalies = {}
+    for feature, feature_distances in distances(baseline, current).items():
+        for name, thresholds in ((L_INFINITY, linf_threshold), (JENSEN_SHANNON, js_threshold)):
+            threshold = _threshold(thresholds, feature)
+            if threshold is not None and feature_distances.get(name, 0.0) > threshold:
+                anomalies.setdefault(feature, {})[name] = (feature_distances[name], threshold)
+    return anomalies
+
+
+def skew_anomalies(train_summary, serve_summary, linf_threshold = None, js_threshold = None):
+    """training data against serving traffic, see data_validation.tfdv_skew_validator"""
+    return find_anomalies(train_summary, serve_summary, linf_threshold, js_threshold)
+
+
+def drift_anomalies(previous_summary, summary, linf_threshold = None, js_threshold = None):
+    """a day against the previous one, see data_validation.tfdv_drift_validator"""
+    return find_anomalies(previous_summary, summary, linf_threshold, js_threshold)
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--store-path', default = config.SKEW_SUMMARY_STORE_PATH)
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    summarize_parser = subparsers.add_parser('summarize', help = 'store the summary of a statistics file')
+    summarize_parser.add_argument('stats_path')
+    summarize_parser.add_argument('--name', required = True)
+    summarize_parser.add_argument('--day')
+    check_parser = subparsers.add_parser('check', help = 'skew against a baseline, or drift from the day before')
+    check_parser.add_argument('--name', required = True)
+    check_parser.add_argument('--baseline', help = 'name of the baseline summaries, drift check without')
+    check_parser.add_argument('--day')
+    check_parser.add_argument('--linf-threshold', type = float)
+    check_parser.add_argument('--js-threshold', type = float)
+    args = parser.parse_args()
+
+    store = SummaryStore(args.store_path)
+    if args.command == 'summarize':
+        import tensorflow_data_validation as tfdv
+        store.put(args.name, DistributionSummary.from_statistics(tfdv.load_statistics(args.stats_path)), args.day)
+    else:
+        day = args.day or store.days(args.name)[-1]
+        if args.baseline:
+            anomalies = skew_anomalies(store.get(args.baseline), store.get(args.name, day),
+                                    args.linf_threshold, args.js_threshold)
+        else:
+            previous_days = [previous for previous in store.days(args.name) if previous < day]
+            anomalies = drift_anomalies(store.get(args.name, previous_days[-1]), store.get(args.name, day),
+                                        args.linf_threshold, args.js_threshold)
+        for feature, feature_anomalies in sorted(anomalies.items()):
+            for name, (value, threshold) in feature_anomalies.items():
+                print("{:<32} {:<15} {:.4f} > {}".format(feature, name, value, threshold))
+        print("{} anomalies".format(len(anomalies)))
@@ -0,0 +1,86 @@
+#python3.8.4
+#./venv/bin/python
+"""
+Managed local store for TF-Hub modules, so trainers start without network access.
+Modules are downloaded once with the prefetch command:
+
+    python -m practice_example.tfhub_store prefetch
+
+and resolved from the store's manifest afterwards, which never touches the
+network. Loaded modules are shared across calls within the same process.
+"""
+
+# %%
+import argparse
+import json
+import os
+import time
+from absl import logging
+from consumer_complaint.config import config
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+#handle -> loaded SavedModel, reused across get_model calls in one process
+_LOADED_MODULES = {}
+
+
+# %%
+def _read_manifest(store_path):
+    manifest_path = os.path.join(store_path, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def resolve_module(handle, store_path = config.TFHUB_MODULE_STORE_PATH):
+    """local directory of a prefetched module, local directories are returned as is"""
+    if os.path.isdir(handle):
+        return handle
+    module_dir = _read_manifest(store_path).get(handle)
+    if module_dir is None:
+        raise FileNotFoundError(
+            "{} is not in the module store at {}, run "
+            "`python -m practice_example.tfhub_store prefetch` first".format(handle, store_path))
+    return os.path.join(store_path, module_dir)
+
+
+def load_module(handle, store_path = config.TFHUB_MODULE_STORE_PATH):
+    """load a module from the store once per process"""
+    import tensorflow_hub as hub
+
+    if handle not in _LOADED_MODULES:
+        start = time.perf_counter()
+        _LOADED_MODULES[handle] = hub.load(resolve_module(handle, store_path))
+        logging.info("Loaded %s in %.2fs", handle, time.perf_counter() - start)
+    return _LOADED_MODULES[handle]
+
+
+# %%
+def prefetch(handles, store_path = config.TFHUB_MODULE_STORE_PATH):
+    """download and extract modules into the store and record them in its manifest"""
+    import tensorflow_hub as hub
+
+    os.makedirs(store_path, exist_ok = True)
+    os.environ['TFHUB_CACHE_DIR'] = store_path
+    manifest = _read_manifest(store_path)
+    for handle in handles:
+        module_dir = hub.resolve(handle)
+        manifest[handle] = os.path.relpath(module_dir, store_path)
+        print("{} -> {}".format(handle, module_dir))
+    with open(os.path.join(store_path, MANIFEST_FILE_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent = 2, sort_keys = True)
+    return manifest
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__,
+                                    formatter_class = argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    prefetch_parser = subparsers.add_parser('prefetch', help = 'download modules into the store')
+    prefetch_parser.add_argument('--handle', action = 'append', dest = 'handles')
+    prefetch_parser.add_argument('--store-path', default = config.TFHUB_MODULE_STORE_PATH)
+    args = parser.parse_args()
+
+    prefetch(args.handles or [config.USE_MODULE_URL], args.store_path)